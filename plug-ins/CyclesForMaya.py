@@ -1,3 +1,4 @@
+import importlib
 import inspect
 import os
 import sys
@@ -14,45 +15,12 @@ pluginDir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe
 sys.path.append(pluginDir)
 sys.path.append(os.path.join(pluginDir, "renderer"))
 
-# Import modules for renderer, settings, material, lights and volumes
-from renderer import (
-    CyclesRenderSettings,
-    CyclesRenderer)
-
-from materials import (
-#    bump,
-#    blendbsdf,
-#    coating,
-#    conductor,
-#    dielectric,
-#    difftrans,
-    diffuse,
-#    mask,
-    mixturebsdf,
-    glossy,
-#    plastic,
-#    roughcoating,
-#    roughconductor,
-#    roughdielectric,
-#    roughdiffuse,
-#    roughplastic,
-    subsurface,
-#    thindielectric,
-#    twosided,
-#    ward,
-#    irawan,
-#    hk,
-#    dipole
-    )
-
-from lights import (
-    envmap,
-    sunsky,
-    arealight)
-
-from volumes import (
-    homogeneous,
-    heterogeneous)
+# Timed so slow plug-in loads show up in the startup log
+pluginLoadStart = time.time()
+
+# The renderer module only loads the scene export and UI modules, which pull in
+# pymel, on the first render or when Render Settings is first opened
+from renderer import CyclesRenderer
 
 global rendererModules
 global generalNodeModules
@@ -61,41 +29,51 @@ global materialNodeModules
 rendererModules = [
     CyclesRenderer]
 
-generalNodeModules = [
-    CyclesRenderSettings]
+# Node modules for settings, materials, lights and volumes. They're imported
+# and registered in this order when the plug-in is initialized.
+generalNodeModuleNames = [
+    "renderer.CyclesRenderSettings"]
 
-materialNodeModules = [
+materialNodeModuleNames = [
     # materials
-#    bump,
-#    blendbsdf,
-#    coating,
-#    conductor,
-#    dielectric,
-#    difftrans,
-    diffuse,
-#    mask,
-    mixturebsdf,
-    glossy,
-#    plastic,
-#    roughcoating,
-#    roughconductor,
-#    roughdielectric,
-#    roughdiffuse,
-#    roughplastic,
-    subsurface,
-#    thindielectric,
-#    twosided,
-#    ward,
-#    irawan,
-#    hk,
-#    dipole,
+#    "materials.bump",
+#    "materials.blendbsdf",
+#    "materials.coating",
+#    "materials.conductor",
+#    "materials.dielectric",
+#    "materials.difftrans",
+    "materials.diffuse",
+#    "materials.mask",
+    "materials.mixturebsdf",
+    "materials.glossy",
+#    "materials.plastic",
+#    "materials.roughcoating",
+#    "materials.roughconductor",
+#    "materials.roughdielectric",
+#    "materials.roughdiffuse",
+#    "materials.roughplastic",
+    "materials.subsurface",
+#    "materials.thindielectric",
+#    "materials.twosided",
+#    "materials.ward",
+#    "materials.irawan",
+#    "materials.hk",
+#    "materials.dipole",
     # lights
-    envmap,
-    sunsky,
-    arealight,
+    "lights.envmap",
+    "lights.sunsky",
+    "lights.arealight",
     # volumes
-    homogeneous,
-    heterogeneous]
+    "volumes.homogeneous",
+    "volumes.heterogeneous"]
+
+generalNodeModules = []
+materialNodeModules = []
+
+def importNodeModules(moduleNames):
+    return [importlib.import_module(moduleName) for moduleName in moduleNames]
+
+pluginImportTime = time.time() - pluginLoadStart
 
 # Initialize the script plug-in
 def initializePlugin(mobject):
@@ -105,13 +83,12 @@ def initializePlugin(mobject):
 
     mplugin = OpenMayaMPx.MFnPlugin(mobject)
 
-    # Load needed plugins
-    try:
-        if not cmds.pluginInfo( "objExport", query=True, loaded=True ):
-            cmds.loadPlugin( "objExport" )
-    except:
-            sys.stderr.write( "Failed to load objExport plugin\n" )
-            raise
+    # objExport is only loaded if the legacy OBJ geometry export is used
+    initializeStart = time.time()
+
+    generalNodeModules = importNodeModules(generalNodeModuleNames)
+    materialNodeModules = importNodeModules(materialNodeModuleNames)
+    importTime = time.time() - initializeStart
 
     # Register general nodes
     try:
@@ -146,7 +123,7 @@ def initializePlugin(mobject):
     # Register Renderer commands
     for rendererModule in rendererModules:
         try:
-            mplugin.registerCommand( rendererModule.kPluginCmdName, rendererModule.cmdCreator )
+            mplugin.registerCommand( rendererModule.kPluginCmdName, rendererModule.cmdCreator, rendererModule.syntaxCreator )
             print( "%s - Registered command  : %s" % (kPluginName, rendererModule.kPluginCmdName) )
         except:
             sys.stderr.write( "%s - Failed to register command: %s\n" % (kPluginName, rendererModule.kPluginCmdName) )
@@ -161,6 +138,11 @@ def initializePlugin(mobject):
             sys.stderr.write( "%s - Failed to register renderer: %s\n" % (kPluginName, rendererModule.kPluginCmdName) )
             raise
 
+    initializeTime = time.time() - initializeStart
+    print( "%s - Startup time        : %.3fs (plug-in import %.3fs, node imports %.3fs, registration %.3fs)" % (
+        kPluginName, pluginImportTime + initializeTime, pluginImportTime,
+        importTime, initializeTime - importTime) )
+
 # Uninitialize the script plug-in
 def uninitializePlugin(mobject):
     global rendererModules
@@ -168,6 +150,11 @@ def uninitializePlugin(mobject):
     global generalNodeModules
 
     mplugin = OpenMayaMPx.MFnPlugin(mobject)
+
+    # Kill any swatch renders that are still running
+    if 'CyclesSwatch' in sys.modules:
+        sys.modules['CyclesSwatch'].stopSwatchService()
+
     for rendererModule in rendererModules:
         try:
             cmds.renderer(rendererModule.kPluginCmdName, edit=True, unregisterRenderer=True)
@@ -195,3 +182,63 @@ def uninitializePlugin(mobject):
             sys.stderr.write( "Failed to deregister node: %s\n" % generalNodeModule.kPluginNodeName )
             raise
 
+
+#
+# Startup benchmark
+#
+# Run with mayapy to time the plug-in load, and the loads that are deferred
+# until they're needed, in fresh interpreters so nothing is already imported:
+#
+#   mayapy CyclesForMaya.py --runs 5
+#
+startupBenchmarkScript = """
+import sys
+import time
+
+import maya.standalone
+maya.standalone.initialize(name='python')
+import maya.cmds as cmds
+
+start = time.time()
+cmds.loadPlugin(%(pluginPath)r)
+print( 'plug-in load %%f' %% (time.time() - start) )
+
+start = time.time()
+sys.modules['renderer.CyclesRenderer'].loadRendererIO()
+print( 'scene export load %%f' %% (time.time() - start) )
+
+start = time.time()
+import CyclesRendererUI
+print( 'render settings UI load %%f' %% (time.time() - start) )
+"""
+
+def benchmarkStartup(runs):
+    import subprocess
+
+    script = startupBenchmarkScript % {'pluginPath' : os.path.abspath(__file__)}
+    timings = {}
+    names = []
+    for run in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", script])
+        for line in output.splitlines():
+            (name, separator, seconds) = line.rpartition(" ")
+            if name.endswith("load"):
+                if name not in timings:
+                    names.append(name)
+                    timings[name] = []
+                timings[name].append(float(seconds))
+
+    print( "%s - Startup over %d runs" % (kPluginName, runs) )
+    for name in names:
+        print( "  %-24s : mean %.3fs, min %.3fs, max %.3fs" % (name,
+            sum(timings[name])/len(timings[name]), min(timings[name]), max(timings[name])) )
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    p = OptionParser(usage='mayapy %prog [options]')
+    p.add_option('--runs', '-r', type='int', default=5,
+                 help='The number of fresh Maya sessions to time')
+    (options, args) = p.parse_args()
+
+    benchmarkStartup(options.runs)
@@ -0,0 +1,241 @@
+import os
+import platform
+import re
+import threading
+import time
+
+import maya.cmds as cmds
+import maya.utils
+
+from process import Process, ProcessList
+
+import CyclesProgress
+import CyclesSequenceManifest
+
+#
+# Batch rendering
+#
+# A sequence is split into chunks of consecutive frames, and each chunk is
+# rendered by a headless mayapy worker that opens the scene once and renders
+# its frames with the Cycles command. A number of workers run at a time. Each
+# worker is started in its own process group, so cancelling the batch render
+# kills the workers and the Cycles renders they started. The frames workers
+# finish, and the progress of the frames they're rendering, are reported back
+# to the session that submitted the render.
+#
+pluginDir = os.path.dirname(os.path.abspath(__file__))
+workerScript = os.path.join(pluginDir, "CyclesBatchWorker.py")
+pluginPath = os.path.join(os.path.dirname(pluginDir), "CyclesForMaya.py")
+
+frameFinishedRe = re.compile(r"Rendering frame (-?\d+) - end")
+renderProgressRe = re.compile(r"Render progress - (.*)")
+
+def getFrameChunks(frames, byFrame, chunkSize):
+    # Only consecutive frames share a chunk, so each worker renders a single range
+    chunks = []
+    for frame in frames:
+        if chunks and frame == chunks[-1][-1] + byFrame and len(chunks[-1]) < chunkSize:
+            chunks[-1].append(frame)
+        else:
+            chunks.append([frame])
+    return chunks
+
+def getMayapyPath(mayapyPath=None):
+    if mayapyPath:
+        return mayapyPath
+
+    executable = "mayapy.exe" if platform.system() == "Windows" else "mayapy"
+    mayaLocation = os.environ.get("MAYA_LOCATION")
+    if mayaLocation:
+        return os.path.join(mayaLocation, "bin", executable)
+    return executable
+
+def getBatchScene(batchDir):
+    scenePath = cmds.file(q=True, sceneName=True)
+    if scenePath and not cmds.file(q=True, modified=True):
+        return scenePath
+
+    # Workers need the scene as it is now. It's saved under the same name so
+    # the images keep their prefix.
+    if not os.path.exists(batchDir):
+        os.makedirs(batchDir)
+
+    sceneName = os.path.splitext(os.path.basename(scenePath))[0] if scenePath else "untitled"
+    snapshotPath = os.path.join(batchDir, sceneName + ".mb")
+    cmds.file(snapshotPath, exportAll=True, type="mayaBinary", preserveReferences=True, force=True)
+    print( "Batch render - Saved the scene for the workers : %s" % snapshotPath )
+
+    return snapshotPath
+
+def reportBatchProgress(message):
+    print( "Batch render - %s" % message )
+
+class BatchRender:
+    def __init__(self, mayapyPath, scenePath, projectDir, frames, byFrame=1, chunkSize=10, workers=2,
+                 manifestPath=None, logDir=None):
+        self.frames = frames
+        self.chunks = getFrameChunks(frames, byFrame, max(1, chunkSize))
+        self.workers = max(1, workers)
+        self.manifestPath = manifestPath
+        self.logDir = logDir
+
+        self.lock = threading.Lock()
+        self.sequenceProgress = CyclesProgress.SequenceProgress(len(frames))
+        self.frameStarts = {}
+        self.chunksFinished = 0
+        self.startTime = None
+        self.cancelled = False
+        self.thread = None
+
+        # Workers render in batch mode, where animations need the GIL released
+        env = dict(os.environ)
+        env["MAYA_RELEASE_PYTHON_GIL"] = "1"
+
+        self.processList = ProcessList("render a sequence in chunks",
+            blocking=False, max_concurrency=self.workers)
+        for chunk in self.chunks:
+            worker = Process(description="render frames %d to %d" % (chunk[0], chunk[-1]),
+                cmd=mayapyPath,
+                args=['-u', workerScript, pluginPath, projectDir, scenePath,
+                      str(chunk[0]), str(chunk[-1]), str(byFrame)],
+                env=env, non_blocking=True)
+            worker.echo = False
+            worker.own_process_group = True
+            worker.log_tail_lines = 1000
+            worker.log_callback = lambda line, chunk=chunk: self._workerOutput(chunk, line)
+            worker.finish_callback = lambda chunk=chunk: self._workerFinished(chunk)
+            self.processList.add_process(worker)
+
+    def formatStatus(self):
+        # Frames finish in parallel, so the time left is shared between the workers
+        eta = self.sequenceProgress.getETA()
+        remainingChunks = len(self.chunks) - self.chunksFinished
+        if eta is not None and remainingChunks > 0:
+            eta /= min(self.workers, remainingChunks)
+        return "%d of %d frames, elapsed %s, remaining %s" % (self.sequenceProgress.framesFinished,
+            len(self.frames), CyclesProgress.formatDuration(time.time() - self.startTime),
+            CyclesProgress.formatDuration(eta))
+
+    def _workerOutput(self, chunk, line):
+        now = time.time()
+
+        match = frameFinishedRe.search(line)
+        if match:
+            with self.lock:
+                frameStart = self.frameStarts.get(chunk[0], self.startTime)
+                self.frameStarts[chunk[0]] = now
+                self.sequenceProgress.frameFinished(now - frameStart)
+                status = self.formatStatus()
+            maya.utils.executeDeferred(reportBatchProgress, "frame %s finished - %s" % (match.group(1), status))
+            return
+
+        with self.lock:
+            # The first frame's time includes starting mayapy and opening the scene
+            self.frameStarts.setdefault(chunk[0], now)
+
+        match = renderProgressRe.search(line)
+        if match:
+            maya.utils.executeDeferred(reportBatchProgress, "frames %d to %d - %s" % (chunk[0], chunk[-1], match.group(1)))
+
+    def _workerFinished(self, chunk):
+        with self.lock:
+            self.chunksFinished += 1
+
+    def start(self):
+        self.startTime = time.time()
+        reportBatchProgress("%d frames in %d chunks, %d workers" % (len(self.frames), len(self.chunks), self.workers))
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.processList.execute()
+        except Exception, e:
+            maya.utils.executeDeferred(reportBatchProgress, "failed : %s" % e)
+
+        failedWorkers = [worker for worker in self.processList.processes if worker.status not in [0, None]]
+        for worker in failedWorkers:
+            if self.logDir:
+                if not os.path.exists(self.logDir):
+                    os.makedirs(self.logDir)
+                logName = os.path.join(self.logDir, "%s.log" % worker.description.replace(" ", "_"))
+                worker.write_log_to_disk(logName, format='txt')
+
+        failedFrames = []
+        if self.manifestPath:
+            manifest = CyclesSequenceManifest.mergeChunkManifests(self.manifestPath)
+            failedFrames = [frame for frame in self.frames
+                if manifest.frames.get(str(frame), {}).get('status') != 'complete']
+
+        if self.cancelled:
+            summary = "cancelled"
+        elif failedWorkers or failedFrames:
+            summary = "finished with errors"
+        else:
+            summary = "finished"
+        summary += " - %s" % self.formatStatus()
+        if failedWorkers:
+            summary += "\n\tfailed workers : %s" % ", ".join([worker.description for worker in failedWorkers])
+        if failedFrames:
+            summary += "\n\tframes not rendered : %s" % CyclesSequenceManifest.formatFrameRanges(failedFrames)
+        maya.utils.executeDeferred(reportBatchProgress, summary)
+
+    def cancel(self):
+        reportBatchProgress("cancelling")
+        self.cancelled = True
+        self.processList.kill("batch render cancelled")
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+        return not self.isRunning()
+
+#
+# Maya integration
+#
+def startBatchRender(renderSettings):
+    projectDir = cmds.workspace(q=True, fn=True)
+    batchDir = os.path.join(projectDir, "renderData", "batch")
+
+    if cmds.getAttr("defaultRenderGlobals.animation"):
+        startFrame = int(cmds.getAttr("defaultRenderGlobals.startFrame"))
+        endFrame = int(cmds.getAttr("defaultRenderGlobals.endFrame"))
+        byFrame = int(cmds.getAttr("defaultRenderGlobals.byFrameStep"))
+    else:
+        startFrame = endFrame = int(cmds.currentTime(q=True))
+        byFrame = 1
+    frames = range(startFrame, endFrame+1, byFrame)
+
+    imagePrefix = cmds.getAttr("defaultRenderGlobals.imageFilePrefix")
+    if imagePrefix is None:
+        imagePrefix = str('.'.join(os.path.split(cmds.file(q=True, sn=True))[-1].split('.')[:-1]))
+    manifestPath = CyclesSequenceManifest.getManifestPath(projectDir, imagePrefix)
+
+    # Frames rendered by an earlier batch render that was cancelled or failed part way are skipped
+    if cmds.getAttr("%s.%s" % (renderSettings, "resumeSequence")):
+        manifest = CyclesSequenceManifest.mergeChunkManifests(manifestPath)
+        (frames, invalidFrames) = manifest.getRemainingFrames(frames)
+        if not frames:
+            reportBatchProgress("every frame is already rendered : %s" % manifestPath)
+            return None
+
+    mayapyPath = getMayapyPath(cmds.getAttr("%s.%s" % (renderSettings, "mayapyPath")))
+    chunkSize = cmds.getAttr("%s.%s" % (renderSettings, "batchChunkSize"))
+    workers = cmds.getAttr("%s.%s" % (renderSettings, "batchWorkers"))
+
+    print( "Batch render - mayapy     : %s" % mayapyPath )
+    print( "Batch render - Chunk size : %s" % chunkSize )
+    print( "Batch render - Workers    : %s" % workers )
+    print( "Batch render - Frames     : %s" % CyclesSequenceManifest.formatFrameRanges(frames) )
+
+    scenePath = getBatchScene(batchDir)
+
+    batchRender = BatchRender(mayapyPath, scenePath, projectDir, frames, byFrame, chunkSize, workers,
+        manifestPath=manifestPath, logDir=batchDir)
+    batchRender.start()
+    return batchRender
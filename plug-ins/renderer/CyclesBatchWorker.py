@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+
+#
+# Batch render worker
+#
+# Run by mayapy for one chunk of a batch render. The scene is opened once and
+# the chunk's frames are rendered with the Cycles command, which prints the
+# progress that the submitting session follows.
+#
+#   mayapy -u CyclesBatchWorker.py plugin project scene startFrame endFrame byFrame
+#
+
+def main(arguments):
+    if len(arguments) != 6:
+        print( "Usage : CyclesBatchWorker.py plugin project scene startFrame endFrame byFrame" )
+        return 1
+
+    (pluginPath, projectDir, scenePath) = arguments[:3]
+    (startFrame, endFrame, byFrame) = map(int, arguments[3:])
+
+    workerStart = time.time()
+    import maya.standalone
+    maya.standalone.initialize(name='python')
+
+    import maya.cmds as cmds
+
+    try:
+        cmds.loadPlugin(pluginPath, quiet=True)
+        cmds.workspace(projectDir, openWorkspace=True)
+        cmds.file(scenePath, open=True, force=True)
+        print( "Batch worker - Opened %s in %.3fs" % (scenePath, time.time() - workerStart) )
+
+        cmds.Cycles(batch=True, startFrame=startFrame, endFrame=endFrame, byFrame=byFrame)
+    except Exception, e:
+        print( "Batch worker - Failed : %s" % e )
+        return 1
+
+    print( "Batch worker - Frames %d to %d finished in %.3fs" % (startFrame, endFrame, time.time() - workerStart) )
+
+    if hasattr(maya.standalone, 'uninitialize'):
+        maya.standalone.uninitialize()
+    return 0
+
+if __name__ == '__main__':
+    status = main(sys.argv[1:])
+
+    # Exit without Python's teardown, which can hang in some Maya versions
+    sys.stdout.flush()
+    os._exit(status)
@@ -0,0 +1,180 @@
+import datetime
+import math
+import multiprocessing
+import os
+import threading
+
+from process import Process, ProcessList
+import imagefile
+
+import CyclesSamplePasses
+
+#
+# Convergence
+#
+# A frame rendered until it converges is rendered in steps, each of which adds
+# a pass with its own seed to each of two halves, A and B, with the same number
+# of samples. After each step, the noise of the halves' average is estimated
+# from their difference, and the frame stops once the noise is under the
+# target in enough of the image. Noise falls with the square root of the
+# samples, so the next step is sized from how far the noise is from the
+# target. The halves are then merged into the frame, which matches a render
+# with all of their samples.
+#
+def getHalfFileName(fileName, half):
+    (base, extension) = os.path.splitext(fileName)
+    return "%s.half%s%s" % (base, "AB"[half], extension)
+
+def getNoiseQuantile(noise, fraction):
+    # The noise that the given fraction of the pixels are at or under
+    noise = sorted(noise)
+    return noise[max(0, min(len(noise) - 1, int(math.ceil(fraction*len(noise))) - 1))]
+
+def getNextSamples(samples, noise, targetNoise, increment, maxSamples):
+    if noise > 0.0 and targetNoise > 0.0:
+        predicted = int(math.ceil(samples*(noise/targetNoise)**2))
+    else:
+        predicted = samples + increment
+
+    # Early estimates are noisy themselves, so a step at most doubles the samples
+    return min(maxSamples, max(samples + increment, min(predicted, 2*samples)))
+
+class ConvergenceRender(ProcessList):
+    # Renders a frame on this host until it converges, with the settings made
+    # on it applied to each step's passes as CyclesSamplePasses does.
+    def __init__(self, cyclesPath, args, env, sceneFileName, imageName, targetNoise,
+                 fraction=0.95, minSamples=16, maxSamples=1024, increment=16,
+                 threads=0, oiiotoolPath=None, keepTempFiles=False):
+        ProcessList.__init__(self, "render until the noise is under %s" % targetNoise,
+            blocking=True, max_concurrency=2)
+
+        self.cyclesPath = cyclesPath
+        self.args = args
+        self.env = env
+        self.sceneFileName = sceneFileName
+        self.imageName = imageName
+        self.targetNoise = targetNoise
+        self.fraction = max(0.0, min(1.0, fraction))
+        self.minSamples = max(2, minSamples)
+        self.maxSamples = max(self.minSamples, maxSamples)
+        self.increment = max(2, increment)
+        self.oiiotoolPath = oiiotoolPath
+        self.keepTempFiles = keepTempFiles
+        self.merged = threading.Event()
+
+        # The two halves render at the same time, on half of the cores each
+        self.passThreads = max(1, (threads or multiprocessing.cpu_count()) // 2)
+
+        self.halfImageNames = [getHalfFileName(imageName, half) for half in range(2)]
+        self.halfSamples = [0, 0]
+        self.passSceneFileNames = []
+        self.passImageNames = []
+        self.steps = []
+        self.converged = False
+
+        print( "Convergence - Noise under %s in %.0f%% of the image, %d to %d samples" % (targetNoise,
+            self.fraction*100.0, self.minSamples, self.maxSamples) )
+
+    def getSamples(self):
+        return sum(self.halfSamples)
+
+    def addPass(self, samples, logCallback=None):
+        index = len(self.passSceneFileNames)
+        passSceneFileName = CyclesSamplePasses.writePassScene(self.sceneFileName, index)
+        passImageName = CyclesSamplePasses.getPassFileName(self.imageName, index)
+        self.passSceneFileNames.append(passSceneFileName)
+        self.passImageNames.append(passImageName)
+
+        render = Process(description="render convergence pass %d, %d samples" % (index, samples),
+            cmd=self.cyclesPath,
+            args=CyclesSamplePasses.getPassArgs(self.args, self.sceneFileName, self.imageName,
+                passSceneFileName, passImageName, samples, self.passThreads),
+            env=self.env)
+        CyclesSamplePasses.applyRenderSettings(self, render)
+        render.log_callback = logCallback
+        return self.add_process(render)
+
+    def accumulate(self, half, passImageName, samples):
+        halfImageName = self.halfImageNames[half]
+        if self.halfSamples[half] == 0:
+            if os.path.exists(halfImageName):
+                os.remove(halfImageName)
+            os.rename(passImageName, halfImageName)
+        else:
+            imagefile.merge_images([halfImageName, passImageName], [self.halfSamples[half], samples],
+                halfImageName, self.oiiotoolPath)
+            if not self.keepTempFiles:
+                os.remove(passImageName)
+        self.halfSamples[half] += samples
+
+    def execute(self):
+        self.merged.clear()
+        self._finished.clear()
+        thread = threading.Thread(target=self._render)
+        thread.daemon = True
+        thread.start()
+
+    def _renderStep(self, samples):
+        halfSamples = max(1, int(math.ceil((samples - self.getSamples())/2.0)))
+        passProgress = CyclesSamplePasses.PassProgress([halfSamples, halfSamples], self.log_callback)
+        renders = [self.addPass(halfSamples, passProgress.getCallback(half)) for half in range(2)]
+        self._executeChildren(renders)
+
+        self.watchdog_trips = [trip for render in self.processes for trip in render.watchdog_trips]
+        if self.status != 0 or self._cancelled:
+            return False
+
+        for (half, passImageName) in enumerate(self.passImageNames[-2:]):
+            self.accumulate(half, passImageName, halfSamples)
+        return True
+
+    def _render(self):
+        self.start = datetime.datetime.now()
+        self.status = 0
+        self._cancelled = False
+        try:
+            samples = self.minSamples
+            while self._renderStep(samples):
+                noise = getNoiseQuantile(imagefile.estimate_noise(self.halfImageNames[0],
+                    self.halfImageNames[1], self.oiiotoolPath), self.fraction)
+                self.steps.append((self.getSamples(), noise))
+                self.converged = noise <= self.targetNoise
+                print( "Convergence - %d samples, noise %.4f in %.0f%% of the image, target %s" % (
+                    self.getSamples(), noise, self.fraction*100.0, self.targetNoise) )
+
+                if self.converged or self.getSamples() >= self.maxSamples:
+                    break
+                samples = getNextSamples(self.getSamples(), noise, self.targetNoise,
+                    self.increment, self.maxSamples)
+
+            if self._cancelled:
+                self.status = -1
+            if self.status == 0:
+                if not self.converged:
+                    print( "Convergence - Stopped at the maximum of %d samples" % self.maxSamples )
+                CyclesSamplePasses.mergePasses(self.halfImageNames, self.halfSamples, self.imageName,
+                    self.oiiotoolPath, self.keepTempFiles)
+                self.process_keys.extend(self.getProcessKeys())
+        except Exception, e:
+            print( "Convergence - Unable to render until converged : %s" % e )
+            self.status = -1
+        finally:
+            for render in self.processes:
+                self._add_resources(render)
+            if not self.keepTempFiles:
+                for fileName in self.passSceneFileNames + self.passImageNames + self.halfImageNames:
+                    if os.path.exists(fileName):
+                        os.remove(fileName)
+            self.end = datetime.datetime.now()
+            self._finished.set()
+            self.merged.set()
+
+    def getProcessKeys(self):
+        return [('convergenceSamples', self.getSamples()),
+                ('convergenceNoise', "%.4f" % self.steps[-1][1]),
+                ('convergenceSteps', len(self.steps)),
+                ('converged', self.converged)]
+
+    def wait(self, timeout=None):
+        self.merged.wait(timeout)
+        return self.merged.is_set()
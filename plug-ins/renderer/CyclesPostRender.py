@@ -0,0 +1,336 @@
+import os
+import re
+import shlex
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+from Queue import Queue
+
+from process import Process
+import imagefile
+
+#
+# Post-render stages
+#
+# Stages do work on a frame's image after Cycles has rendered it and its data
+# window has been reset. A stage type is a registered class whose fromSettings
+# makes a stage from the render settings, or returns None when it's off. A
+# stage may ask for settings the exported scene needs, and its run method
+# changes the image in place and returns any other files it writes next to it.
+# A stage that fails leaves the rendered image as it was, with a warning, and
+# the frame still counts as rendered. The stages run on a thread of their own, so the
+# next frame renders while the last one is being processed, and the frame's
+# files are copied back to the project once its stages have finished.
+#
+postRenderStageTypes = []
+
+def registerPostRenderStage(stageType):
+    if stageType not in postRenderStageTypes:
+        postRenderStageTypes.append(stageType)
+
+def getPostRenderStages(getSetting, oiiotoolPath=None, keepTempFiles=False):
+    stages = []
+    for stageType in postRenderStageTypes:
+        stage = stageType.fromSettings(getSetting, oiiotoolPath, keepTempFiles)
+        if stage:
+            stages.append(stage)
+    return stages
+
+def getRequiredSettings(stages):
+    requiredSettings = {}
+    for stage in stages:
+        requiredSettings.update(stage.getRequiredSettings())
+    return requiredSettings
+
+class PostRenderStage:
+    # The base class of post-render stages
+    name = "post-render stage"
+
+    @classmethod
+    def fromSettings(cls, getSetting, oiiotoolPath=None, keepTempFiles=False):
+        return None
+
+    def getRequiredSettings(self):
+        # The render settings the exported scene needs, by attribute name
+        return {}
+
+    def run(self, imageName, logName):
+        # Changes the image in place, and returns the other files written
+        return []
+
+#
+# Denoising
+#
+# The denoiser is a locally installed executable, run with arguments made from
+# a template. {input} and {output} are the rendered and the denoised image.
+# {color} is a Portable Float Map of the image's color, extracted with oiiotool
+# unless the image already is one, for denoisers like Open Image Denoise's.
+# Those denoisers write a Portable Float Map, which is converted back to the
+# image's format. The Cycles export only writes the image's color, so there
+# are no albedo or normal passes to give the denoiser.
+#
+class DenoiseStage(PostRenderStage):
+    name = "denoise"
+
+    # The channels of the image each extracted pass is read from
+    passChannels = {
+        'color' : "R,G,B"
+    }
+
+    # Passes that denoisers read, but that the Cycles export doesn't write
+    unexportedPasses = ['albedo', 'normal']
+
+    @classmethod
+    def fromSettings(cls, getSetting, oiiotoolPath=None, keepTempFiles=False):
+        if not getSetting("denoise"):
+            return None
+        denoiserPath = getSetting("denoiserPath")
+        if not denoiserPath:
+            print( "Denoise - No denoiser path is set, the frames won't be denoised" )
+            return None
+        return cls(denoiserPath, getSetting("denoiserArgs"), oiiotoolPath,
+            getSetting("denoiseKeepNoisy"), keepTempFiles)
+
+    def __init__(self, denoiserPath, argsTemplate, oiiotoolPath=None, keepNoisy=False,
+                 keepTempFiles=False, env=None):
+        self.denoiserPath = denoiserPath
+        self.argsTemplate = argsTemplate or "{input} {output}"
+        self.oiiotoolPath = oiiotoolPath
+        self.keepNoisy = keepNoisy
+        self.keepTempFiles = keepTempFiles
+        self.env = env
+
+        self.fields = set(re.findall(r"\{(\w+)\}", self.argsTemplate))
+        unexportedFields = self.fields & set(self.unexportedPasses)
+        if unexportedFields:
+            raise ValueError("The Cycles export doesn't write the passes in the denoiser arguments : %s" %
+                ", ".join(sorted(unexportedFields)))
+        unknownFields = self.fields - set(['input', 'output'] + self.passChannels.keys())
+        if unknownFields:
+            raise ValueError("Unknown fields in the denoiser arguments : %s" % ", ".join(sorted(unknownFields)))
+
+    def getArgs(self, fileNames):
+        return [arg.format(**fileNames) for arg in shlex.split(self.argsTemplate, posix=(os.name != 'nt'))]
+
+    def run(self, imageName, logName):
+        (base, extension) = os.path.splitext(imageName)
+        passFields = sorted(self.fields & set(self.passChannels.keys()))
+
+        fileNames = {'input' : imageName}
+        tempFileNames = []
+        if passFields:
+            fileNames['output'] = "%s.denoised.pfm" % base
+        else:
+            fileNames['output'] = "%s.denoised%s" % (base, extension)
+        tempFileNames.append(fileNames['output'])
+
+        try:
+            for field in passFields:
+                if field == 'color' and extension.lower() == '.pfm':
+                    fileNames[field] = imageName
+                    continue
+                fileNames[field] = "%s.%s.pfm" % (base, field)
+                tempFileNames.append(fileNames[field])
+                imagefile.extract_channels(imageName, fileNames[field], self.passChannels[field],
+                    self.oiiotoolPath)
+
+            denoiser = Process(description="denoise an image",
+                cmd=self.denoiserPath,
+                args=self.getArgs(fileNames),
+                env=self.env)
+            denoiser.echo = False
+            denoiser.execute()
+
+            # Added to the render's log
+            if logName:
+                with open(logName, 'a') as logFile:
+                    denoiser.write_log(logFile, format='txt')
+
+            if denoiser.status != 0 or not os.path.exists(fileNames['output']):
+                raise ValueError("The denoiser returned %s : %s" % (denoiser.status,
+                    "\n".join(denoiser.log[-5:])))
+
+            denoisedImageName = fileNames['output']
+            if os.path.splitext(denoisedImageName)[1].lower() != extension.lower():
+                denoisedImageName = "%s.denoised%s" % (base, extension)
+                tempFileNames.append(denoisedImageName)
+                imagefile.extract_channels(fileNames['output'], denoisedImageName, "R,G,B",
+                    self.oiiotoolPath)
+
+            outputFiles = []
+            if self.keepNoisy:
+                noisyImageName = "%s.noisy%s" % (base, extension)
+                if os.path.exists(noisyImageName):
+                    os.remove(noisyImageName)
+                os.rename(imageName, noisyImageName)
+                outputFiles.append(noisyImageName)
+            else:
+                os.remove(imageName)
+            os.rename(denoisedImageName, imageName)
+            return outputFiles
+        finally:
+            if not self.keepTempFiles:
+                for tempFileName in tempFileNames:
+                    if os.path.exists(tempFileName):
+                        os.remove(tempFileName)
+
+registerPostRenderStage(DenoiseStage)
+
+class PostRenderQueue:
+    # Runs the stages on frames on a background thread, in the order they're put
+    def __init__(self, stages):
+        self.stages = stages
+        self.processed = []
+        self.failures = []
+
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._runStages)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, imageName, logName, finished=None, renderStatus=0):
+        # The stages only run on frames that rendered. finished is called with
+        # the image, the frame's files and the status once they have run.
+        self._queue.put((imageName, logName, finished, renderStatus))
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        self._queue.join()
+        with self._lock:
+            return list(self.failures)
+
+    def stop(self):
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _runStages(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            (imageName, logName, finished, status) = item
+            fileNames = [imageName, logName]
+            stages = self.stages if status == 0 else []
+            for stage in stages:
+                stageStart = time.time()
+                try:
+                    fileNames.extend(stage.run(imageName, logName))
+                    print( "Post-render - %s : %s (%.2fs)" % (stage.name, imageName, time.time() - stageStart) )
+                except Exception, e:
+                    # The rendered image is kept as it is
+                    print( "Post-render - Unable to %s, keeping the rendered image : %s - %s" % (
+                        stage.name, imageName, e) )
+                    with self._lock:
+                        self.failures.append((imageName, stage.name, str(e)))
+                    break
+
+            with self._lock:
+                self.processed.append((imageName, status))
+            if finished:
+                try:
+                    finished(imageName, fileNames, status)
+                except Exception, e:
+                    print( "Post-render - Unable to finish : %s - %s" % (imageName, e) )
+            self._queue.task_done()
+
+#
+# Denoiser check
+#
+# Runs the denoise stage on a frame with a stub denoiser, a Python script that
+# writes the image it's given with each value halved, or fails when asked to.
+# Checks that a denoised frame replaces the rendered one and keeps the noisy
+# image when asked, that a failed denoise keeps the rendered frame and is
+# reported, that passes the export doesn't write are refused, and that frames
+# finish in the order they're put.
+#
+#   PYTHONPATH=../util python CyclesPostRender.py
+#
+stubDenoiserScript = """
+import struct
+import sys
+
+(inputName, outputName) = sys.argv[1:3]
+if outputName.endswith('fail.denoised.pfm'):
+    sys.exit(1)
+with open(inputName, 'rb') as inputFile:
+    header = [inputFile.readline() for i in range(3)]
+    data = inputFile.read()
+values = struct.unpack('<%df' % (len(data)//4), data)
+with open(outputName, 'wb') as outputFile:
+    outputFile.write(''.join(header))
+    outputFile.write(struct.pack('<%df' % len(values), *[value/2.0 for value in values]))
+"""
+
+def writeCheckImage(imageName, values):
+    with open(imageName, 'wb') as imageFile:
+        imageFile.write("PF\n%d 1\n-1.0\n" % (len(values)//3))
+        imageFile.write(struct.pack("<%df" % len(values), *values))
+
+def readCheckImage(imageName):
+    with open(imageName, 'rb') as imageFile:
+        (channels, width, height, scale) = imagefile.read_pfm_header(imageFile)
+        return list(struct.unpack("<%df" % (channels*width*height), imageFile.read()))
+
+def isRefused(argsTemplate):
+    try:
+        DenoiseStage(sys.executable, argsTemplate)
+    except ValueError:
+        return True
+    return False
+
+def checkDenoise():
+    checkDir = tempfile.mkdtemp(prefix="postrender_")
+    try:
+        denoiserPath = os.path.join(checkDir, "denoiser.py")
+        with open(denoiserPath, 'w') as denoiserFile:
+            denoiserFile.write(stubDenoiserScript)
+
+        values = [0.5, 1.0, 2.0]*4
+        frameNames = []
+        for name in ["frame1", "frame2", "fail"]:
+            imageName = os.path.join(checkDir, "%s.pfm" % name)
+            writeCheckImage(imageName, values)
+            frameNames.append(imageName)
+
+        # As the default arguments do, with the color pass
+        stage = DenoiseStage(sys.executable, "%s {color} {output}" % denoiserPath, keepNoisy=True)
+        queue = PostRenderQueue([stage])
+        finished = []
+        for imageName in frameNames:
+            queue.put(imageName, None, lambda imageName, fileNames, status: finished.append(
+                (imageName, fileNames, status)))
+        failures = queue.wait()
+        queue.stop()
+
+        checks = [
+            ("frames finish in order", [imageName for (imageName, fileNames, status) in finished] == frameNames),
+            ("denoised frames replace the rendered ones",
+                all([readCheckImage(imageName) == [value/2.0 for value in values] for imageName in frameNames[:2]])),
+            ("noisy images are kept", all([os.path.exists(fileNames[-1]) and fileNames[-1].endswith(".noisy.pfm")
+                for (imageName, fileNames, status) in finished[:2]])),
+            ("a failed denoise leaves the image", readCheckImage(frameNames[2]) == values),
+            ("a failed denoise keeps the frame", finished[2][2] == 0 and finished[2][1] == [frameNames[2], None]),
+            ("a failed denoise is reported", [imageName for (imageName, stageName, error)
+                in failures] == [frameNames[2]]),
+            ("unexported passes are refused", isRefused("{input} {albedo} {output}")),
+            ("temporary files are removed", not [fileName for fileName in os.listdir(checkDir)
+                if ".denoised" in fileName])
+        ]
+    finally:
+        shutil.rmtree(checkDir, True)
+
+    for (description, passed) in checks:
+        print( "  %-42s : %s" % (description, "ok" if passed else "failed") )
+    return all([passed for (description, passed) in checks])
+
+if __name__ == '__main__':
+    sys.exit(0 if checkDenoise() else 1)
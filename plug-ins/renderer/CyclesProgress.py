@@ -0,0 +1,136 @@
+import re
+import time
+
+#
+# Render progress
+#
+# Cycles prints its status while it renders, as lines like
+#
+#   Progress 42.50   Path Tracing Tile 3/16, Sample 20/128
+#
+# Each status line is turned into a progress event with the fraction done, the
+# current sample and tile, the time elapsed and an estimate of the time left.
+# Events are printed at a limited rate in batch mode and drive the progress
+# window in the UI. Across an animation, the time taken by the finished frames
+# gives an estimate for the rest of the sequence.
+#
+
+# Output that changes as a render progresses
+progressPattern = r"Progress\s+[\d.]+%?|Sample\s+\d+/\d+|Tile\s+\d+/\d+"
+
+progressRe = re.compile(r"Progress\s+([\d.]+)")
+sampleRe = re.compile(r"Sample\s+(\d+)/(\d+)")
+tileRe = re.compile(r"Tile\s+(\d+)/(\d+)")
+
+def parseProgressLine(line):
+    progress = {}
+
+    match = progressRe.search(line)
+    if match:
+        progress['fraction'] = min(1.0, float(match.group(1))/100.0)
+
+    match = sampleRe.search(line)
+    if match:
+        progress['sample'] = int(match.group(1))
+        progress['samples'] = int(match.group(2))
+
+    match = tileRe.search(line)
+    if match:
+        progress['tile'] = int(match.group(1))
+        progress['tiles'] = int(match.group(2))
+
+    if not progress:
+        return None
+
+    # Older builds only report samples and tiles
+    if 'fraction' not in progress and progress.get('samples'):
+        (tile, tiles) = (progress.get('tile', 1), progress.get('tiles', 1))
+        done = (tile - 1)*progress['samples'] + progress['sample']
+        progress['fraction'] = min(1.0, float(done)/(tiles*progress['samples']))
+
+    return progress
+
+def formatDuration(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%dh%02dm%02ds" % (seconds/3600, (seconds/60) % 60, seconds % 60)
+    elif seconds >= 60:
+        return "%dm%02ds" % (seconds/60, seconds % 60)
+    return "%ds" % seconds
+
+def formatProgressEvent(event, sequenceETA=None):
+    status = "%5.1f%%" % (event['fraction']*100.0)
+    if 'samples' in event:
+        status += ", sample %d/%d" % (event['sample'], event['samples'])
+    if 'tiles' in event:
+        status += ", tile %d/%d" % (event['tile'], event['tiles'])
+    status += ", elapsed %s, remaining %s" % (formatDuration(event['elapsed']), formatDuration(event['eta']))
+    if sequenceETA is not None:
+        status += ", sequence remaining %s" % formatDuration(sequenceETA)
+    return status
+
+class RenderProgress:
+    def __init__(self, frame=None, printInterval=None, sequence=None):
+        self.frame = frame
+        self.printInterval = printInterval
+        self.sequence = sequence
+        self.start = time.time()
+        self.event = None
+        self.lastPrint = 0
+
+    def update(self, line):
+        progress = parseProgressLine(line)
+        if not progress or 'fraction' not in progress:
+            return None
+
+        now = time.time()
+        elapsed = now - self.start
+        fraction = progress['fraction']
+
+        event = dict(progress)
+        event['frame'] = self.frame
+        event['elapsed'] = elapsed
+        event['eta'] = elapsed*(1.0 - fraction)/fraction if fraction > 0.0 else None
+        self.event = event
+
+        if self.printInterval and now - self.lastPrint >= self.printInterval:
+            self.lastPrint = now
+            print( "Render progress - %s" % self.formatEvent(event) )
+
+        return event
+
+    def getSequenceETA(self, event=None):
+        if not self.sequence:
+            return None
+        if event is None:
+            event = self.event
+        return self.sequence.getETA(event['fraction'] if event else 0.0)
+
+    def formatEvent(self, event=None):
+        if event is None:
+            event = self.event
+        return formatProgressEvent(event, self.getSequenceETA(event))
+
+class SequenceProgress:
+    def __init__(self, frameCount):
+        self.frameCount = frameCount
+        self.framesFinished = 0
+        self.renderSeconds = 0.0
+
+    def frameFinished(self, seconds):
+        self.framesFinished += 1
+        self.renderSeconds += seconds
+
+    def getETA(self, currentFraction=0.0):
+        # Unknown until a frame has finished
+        if not self.framesFinished:
+            return None
+        secondsPerFrame = self.renderSeconds/self.framesFinished
+        remainingFrames = self.frameCount - self.framesFinished - currentFraction
+        return max(0.0, remainingFrames*secondsPerFrame)
+
+    def formatStatus(self):
+        return "%d of %d frames, remaining %s" % (self.framesFinished, self.frameCount,
+            formatDuration(self.getETA()))
@@ -229,6 +229,83 @@ class CyclesRenderSetting(OpenMayaMPx.MPxNode):
     mMultichannelShapeIndex = OpenMaya.MObject()
     mMultichannelPrimIndex = OpenMaya.MObject()
 
+    # Motion blur variables
+    mMotionBlur = OpenMaya.MObject()
+    mMotionBlurSteps = OpenMaya.MObject()
+    mMotionBlurShutter = OpenMaya.MObject()
+
+    # Hair variables
+    mHairPreviewFraction = OpenMaya.MObject()
+
+    # Texture conversion variables
+    mTextureConversion = OpenMaya.MObject()
+    mMaketxPath = OpenMaya.MObject()
+    mTextureCacheDir = OpenMaya.MObject()
+    mTextureConversionWorkers = OpenMaya.MObject()
+
+    # Texture proxy variables
+    mTextureQuality = OpenMaya.MObject()
+    mTextureProxyBudget = OpenMaya.MObject()
+
+    # Texture prefetch variables
+    mTexturePrefetchFrames = OpenMaya.MObject()
+    mTexturePrefetchScratchDir = OpenMaya.MObject()
+
+    # Staging variables
+    mStagingDir = OpenMaya.MObject()
+
+    # Scene description variables
+    mPipeSceneDescription = OpenMaya.MObject()
+
+    # Sequence variables
+    mResumeSequence = OpenMaya.MObject()
+
+    # Watchdog variables
+    mRenderNoOutputTimeout = OpenMaya.MObject()
+    mRenderNoProgressTimeout = OpenMaya.MObject()
+    mRenderTimeout = OpenMaya.MObject()
+    mRenderRetries = OpenMaya.MObject()
+    mRenderRetryDelay = OpenMaya.MObject()
+
+    # Swatch variables
+    mSwatchCacheDir = OpenMaya.MObject()
+    mSwatchSize = OpenMaya.MObject()
+    mSwatchSamples = OpenMaya.MObject()
+    mSwatchWorkers = OpenMaya.MObject()
+    mSwatchDebounce = OpenMaya.MObject()
+
+    # Batch variables
+    mMayapyPath = OpenMaya.MObject()
+    mBatchChunkSize = OpenMaya.MObject()
+    mBatchWorkers = OpenMaya.MObject()
+
+    # Render queue variables
+    mRenderQueueDir = OpenMaya.MObject()
+    mRenderQueueLocalAgents = OpenMaya.MObject()
+
+    # Sample pass variables
+    mSamplePasses = OpenMaya.MObject()
+
+    # Time budget variables
+    mRenderTimeBudget = OpenMaya.MObject()
+    mTimeBudgetMinSamples = OpenMaya.MObject()
+    mTimeBudgetMaxSamples = OpenMaya.MObject()
+    mTimeBudgetPilotSamples = OpenMaya.MObject()
+    mTimeBudgetCacheDir = OpenMaya.MObject()
+
+    # Convergence variables
+    mConvergenceNoise = OpenMaya.MObject()
+    mConvergenceFraction = OpenMaya.MObject()
+    mConvergenceMinSamples = OpenMaya.MObject()
+    mConvergenceMaxSamples = OpenMaya.MObject()
+    mConvergenceIncrement = OpenMaya.MObject()
+
+    # Denoise variables
+    mDenoise = OpenMaya.MObject()
+    mDenoiserPath = OpenMaya.MObject()
+    mDenoiserArgs = OpenMaya.MObject()
+    mDenoiseKeepNoisy = OpenMaya.MObject()
+
     def __init__(self):
         OpenMayaMPx.MPxNode.__init__(self)
 
@@ -508,6 +585,106 @@ def nodeInitializer():
         CyclesRenderSetting.addBooleanAttribute(nAttr, "mMultichannelShapeIndex", "multichannelShapeIndex", "mcsi", False)
         CyclesRenderSetting.addBooleanAttribute(nAttr, "mMultichannelPrimIndex", "multichannelPrimIndex", "mcpi", False)
 
+        # Motion blur variables
+        CyclesRenderSetting.addBooleanAttribute(nAttr, "mMotionBlur", "motionBlur", "mblr", False)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mMotionBlurSteps", "motionBlurSteps", "mbst", 3)
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mMotionBlurShutter", "motionBlurShutter", "mbsh", 0.5)
+
+        # Hair variables
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mHairPreviewFraction", "hairPreviewFraction", "hpvf", 1.0)
+
+        # Texture conversion variables
+        defaultMaketxPath = os.getenv( "MAKETX_PATH" )
+        if not defaultMaketxPath:
+            defaultMaketxPath = ""
+
+        # Shared between scenes and shots. Left empty, a directory under the Maya user directory is used.
+        defaultTextureCacheDir = os.getenv( "CYCLES_TEXTURE_CACHE" )
+        if not defaultTextureCacheDir:
+            defaultTextureCacheDir = ""
+
+        CyclesRenderSetting.addBooleanAttribute(nAttr, "mTextureConversion", "textureConversion", "txcv", False)
+        CyclesRenderSetting.addStringAttribute(sAttr, "mMaketxPath", "maketxPath", "mktxp", defaultMaketxPath)
+        CyclesRenderSetting.addStringAttribute(sAttr, "mTextureCacheDir", "textureCacheDir", "txcd", defaultTextureCacheDir)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mTextureConversionWorkers", "textureConversionWorkers", "txcw", 4)
+
+        # Texture proxy variables
+        CyclesRenderSetting.addStringAttribute(sAttr, "mTextureQuality", "textureQuality", "txq", "Full resolution")
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mTextureProxyBudget", "textureProxyBudget", "txpb", 4096)
+
+        # Texture prefetch variables
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mTexturePrefetchFrames", "texturePrefetchFrames", "txpf", 0)
+        CyclesRenderSetting.addStringAttribute(sAttr, "mTexturePrefetchScratchDir", "texturePrefetchScratchDir", "txpsd", "")
+
+        # Staging variables
+        # Local scratch directory to render in. Left empty, renders go straight to the project.
+        defaultStagingDir = os.getenv( "CYCLES_STAGING_DIR" )
+        if not defaultStagingDir:
+            defaultStagingDir = ""
+
+        CyclesRenderSetting.addStringAttribute(sAttr, "mStagingDir", "stagingDir", "stgd", defaultStagingDir)
+
+        # Scene description variables
+        CyclesRenderSetting.addBooleanAttribute(nAttr, "mPipeSceneDescription", "pipeSceneDescription", "psd", False)
+
+        # Sequence variables
+        CyclesRenderSetting.addBooleanAttribute(nAttr, "mResumeSequence", "resumeSequence", "rsq", False)
+
+        # Watchdog variables
+        # Limits in seconds. Renders that hit one are killed and retried. 0 turns a limit off.
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mRenderNoOutputTimeout", "renderNoOutputTimeout", "rnot", 0)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mRenderNoProgressTimeout", "renderNoProgressTimeout", "rnpt", 0)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mRenderTimeout", "renderTimeout", "rto", 0)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mRenderRetries", "renderRetries", "rrt", 1)
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mRenderRetryDelay", "renderRetryDelay", "rrd", 10.0)
+
+        # Swatch variables
+        # Material previews rendered in the background. Settling time is in seconds.
+        CyclesRenderSetting.addStringAttribute(sAttr, "mSwatchCacheDir", "swatchCacheDir", "swcd", "")
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mSwatchSize", "swatchSize", "swsz", 128)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mSwatchSamples", "swatchSamples", "swsm", 32)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mSwatchWorkers", "swatchWorkers", "swwk", 2)
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mSwatchDebounce", "swatchDebounce", "swdb", 0.3)
+
+        # Batch variables
+        # Batch renders run chunks of frames in mayapy. An empty path uses the mayapy next to Maya.
+        CyclesRenderSetting.addStringAttribute(sAttr, "mMayapyPath", "mayapyPath", "mpyp", "")
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mBatchChunkSize", "batchChunkSize", "bchs", 10)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mBatchWorkers", "batchWorkers", "bwrk", 2)
+
+        # Render queue variables
+        # Frames are submitted to the render queue in this directory when set. Without a
+        # daemon running for it, the local agents are started for the render.
+        CyclesRenderSetting.addStringAttribute(sAttr, "mRenderQueueDir", "renderQueueDir", "rqdr", "")
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mRenderQueueLocalAgents", "renderQueueLocalAgents", "rqla", 1)
+
+        # Sample pass variables
+        # More than one pass splits the sample count between renders with their own seeds
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mSamplePasses", "samplePasses", "smpp", 1)
+
+        # Time budget variables
+        # A budget in seconds picks the sample count from a pilot render. 0 uses the sample count.
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mRenderTimeBudget", "renderTimeBudget", "rtbg", 0.0)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mTimeBudgetMinSamples", "timeBudgetMinSamples", "tbmn", 16)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mTimeBudgetMaxSamples", "timeBudgetMaxSamples", "tbmx", 4096)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mTimeBudgetPilotSamples", "timeBudgetPilotSamples", "tbps", 8)
+        CyclesRenderSetting.addStringAttribute(sAttr, "mTimeBudgetCacheDir", "timeBudgetCacheDir", "tbcd", "")
+
+        # Convergence variables
+        # A noise target renders in steps until the noise is under it in a fraction of the image. 0 turns it off.
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mConvergenceNoise", "convergenceNoise", "cvns", 0.0)
+        CyclesRenderSetting.addFloatAttribute(nAttr,   "mConvergenceFraction", "convergenceFraction", "cvfr", 0.95)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mConvergenceMinSamples", "convergenceMinSamples", "cvmn", 16)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mConvergenceMaxSamples", "convergenceMaxSamples", "cvmx", 1024)
+        CyclesRenderSetting.addIntegerAttribute(nAttr, "mConvergenceIncrement", "convergenceIncrement", "cvin", 16)
+
+        # Denoise variables
+        # The denoiser's arguments take {input}, {output} and the {color} pass
+        CyclesRenderSetting.addBooleanAttribute(nAttr, "mDenoise", "denoise", "dnoi", False)
+        CyclesRenderSetting.addStringAttribute(sAttr, "mDenoiserPath", "denoiserPath", "dnpt", "")
+        CyclesRenderSetting.addStringAttribute(sAttr, "mDenoiserArgs", "denoiserArgs", "dnag", "--hdr {color} -o {output}")
+        CyclesRenderSetting.addBooleanAttribute(nAttr, "mDenoiseKeepNoisy", "denoiseKeepNoisy", "dnkn", False)
+
     except:
         sys.stderr.write("Failed to create and add attributes\n")
         raise
@@ -734,6 +911,83 @@ def nodeInitializer():
         CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMultichannelShapeIndex)
         CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMultichannelPrimIndex)
 
+        # Motion blur variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMotionBlur)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMotionBlurSteps)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMotionBlurShutter)
+
+        # Hair variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mHairPreviewFraction)
+
+        # Texture conversion variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTextureConversion)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMaketxPath)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTextureCacheDir)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTextureConversionWorkers)
+
+        # Texture proxy variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTextureQuality)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTextureProxyBudget)
+
+        # Texture prefetch variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTexturePrefetchFrames)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTexturePrefetchScratchDir)
+
+        # Staging variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mStagingDir)
+
+        # Scene description variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mPipeSceneDescription)
+
+        # Sequence variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mResumeSequence)
+
+        # Watchdog variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderNoOutputTimeout)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderNoProgressTimeout)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderTimeout)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderRetries)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderRetryDelay)
+
+        # Swatch variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mSwatchCacheDir)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mSwatchSize)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mSwatchSamples)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mSwatchWorkers)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mSwatchDebounce)
+
+        # Batch variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mMayapyPath)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mBatchChunkSize)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mBatchWorkers)
+
+        # Render queue variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderQueueDir)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderQueueLocalAgents)
+
+        # Sample pass variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mSamplePasses)
+
+        # Time budget variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mRenderTimeBudget)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTimeBudgetMinSamples)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTimeBudgetMaxSamples)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTimeBudgetPilotSamples)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mTimeBudgetCacheDir)
+
+        # Convergence variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mConvergenceNoise)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mConvergenceFraction)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mConvergenceMinSamples)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mConvergenceMaxSamples)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mConvergenceIncrement)
+
+        # Denoise variables
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mDenoise)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mDenoiserPath)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mDenoiserArgs)
+        CyclesRenderSetting.addAttribute(CyclesRenderSetting.mDenoiseKeepNoisy)
+
     except:
         sys.stderr.write("Failed to add attributes\n")
         raise
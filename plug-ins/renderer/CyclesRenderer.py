@@ -1,5 +1,6 @@
 import inspect
 import os
+import shutil
 import sys
 import time
 
@@ -10,6 +11,16 @@ import maya.OpenMayaMPx as OpenMayaMPx
 
 kPluginCmdName = "Cycles"
 
+# Command flags. A frame range renders those frames as a sequence, as batch workers do.
+kBatchFlag = "-b"
+kBatchFlagLong = "-batch"
+kStartFrameFlag = "-sf"
+kStartFrameFlagLong = "-startFrame"
+kEndFrameFlag = "-ef"
+kEndFrameFlagLong = "-endFrame"
+kByFrameFlag = "-bf"
+kByFrameFlagLong = "-byFrame"
+
 pluginDir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 sys.path.append(pluginDir)
 
@@ -17,10 +28,21 @@ sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..', 'util')))
 
 from process import Process
+from transfer import CopyQueue
+import imagefile
+import renderqueue
 
 # Import modules for settings, material, lights and volumes
 import CyclesRenderSettings
 
+import CyclesTexturePrefetch
+import CyclesSequenceManifest
+import CyclesProgress
+import CyclesSamplePasses
+import CyclesTimeBudget
+import CyclesConvergence
+import CyclesPostRender
+
 global renderSettings
 renderSettings = None
 
@@ -28,13 +50,30 @@ renderSettings = None
 #
 # IO
 #
-import CyclesRendererIO
+# The scene export pulls in pymel, which is slow to import, so it's loaded on
+# the first render rather than with the plug-in
+#
+CyclesRendererIO = None
+materialNodeTypes = []
+
+def loadRendererIO():
+    global CyclesRendererIO
+    if CyclesRendererIO is None:
+        loadStart = time.time()
+        import CyclesRendererIO
+        for materialNodeType in materialNodeTypes:
+            if materialNodeType not in CyclesRendererIO.materialNodeTypes:
+                CyclesRendererIO.materialNodeTypes.append(materialNodeType)
+        print( "Loaded scene export in %.3fs" % (time.time() - loadStart) )
+    return CyclesRendererIO
 
 #
 # Utility functions
 #
 def registMaterialNodeType(materialNodeType):
-    CyclesRendererIO.materialNodeTypes.append(materialNodeType)
+    materialNodeTypes.append(materialNodeType)
+    if CyclesRendererIO:
+        CyclesRendererIO.materialNodeTypes.append(materialNodeType)
 
 def createRenderSettingsNode():
     global renderSettings
@@ -119,7 +158,9 @@ def getImageExtension(renderSettings):
 #
 # UI
 #
-import CyclesRendererUI
+# CyclesRendererUI is imported by the Render Settings callbacks, the first
+# time the window is opened
+#
 
 #
 # Renderer functions
@@ -130,11 +171,47 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
     def __init__(self):
         OpenMayaMPx.MPxCommand.__init__(self)
 
+        # Set when rendering in a local staging directory
+        self.projectDir = None
+        self.stagingRoot = None
+        self.copyQueue = None
+
+        # Set when rendering an animation
+        self.manifest = None
+        self.sequenceProgress = None
+
+        # Set when rendering through a render queue. Queued frames are kept by job id.
+        self.renderQueueDir = None
+        self.renderQueue = None
+        self.queuedFrames = {}
+
+        # Set when post-render stages run on the frames, with the render
+        # settings they changed
+        self.postRenderQueue = None
+        self.previousSettings = {}
+
     # Invoked when the command is run.
     def doIt(self,argList):
         global renderSettings
         print "Rendering with Cycles..."
 
+        argData = OpenMaya.MArgDatabase(self.syntax(), argList)
+        batch = argData.isFlagSet(kBatchFlag) and argData.flagArgumentBool(kBatchFlag, 0)
+        frameRange = None
+        if argData.isFlagSet(kStartFrameFlag) or argData.isFlagSet(kEndFrameFlag):
+            startFrame = int(cmds.getAttr("defaultRenderGlobals.startFrame"))
+            if argData.isFlagSet(kStartFrameFlag):
+                startFrame = argData.flagArgumentInt(kStartFrameFlag, 0)
+            endFrame = startFrame
+            if argData.isFlagSet(kEndFrameFlag):
+                endFrame = argData.flagArgumentInt(kEndFrameFlag, 0)
+            byFrame = 1
+            if argData.isFlagSet(kByFrameFlag):
+                byFrame = max(1, argData.flagArgumentInt(kByFrameFlag, 0))
+            frameRange = (startFrame, endFrame, byFrame)
+
+        loadRendererIO()
+
         # Create a render settings node
         createRenderSettingsNode()
 
@@ -146,6 +223,21 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         #Get the directories and other variables
         projectDir = cmds.workspace(q=True, fn=True)
         renderDir = os.path.join(projectDir, "renderData")
+
+        # Render in a local directory that mirrors the project and copy the results back
+        self.projectDir = projectDir
+        self.stagingRoot = None
+        self.copyQueue = None
+        stagingDir = cmds.getAttr("%s.%s" % (renderSettings, "stagingDir"))
+        if stagingDir:
+            self.stagingRoot = os.path.join(stagingDir, os.path.basename(os.path.normpath(projectDir)))
+            renderDir = os.path.join(self.stagingRoot, "renderData")
+            for stagingSubDir in [renderDir, os.path.join(self.stagingRoot, "images")]:
+                if not os.path.exists(stagingSubDir):
+                    os.makedirs(stagingSubDir)
+            self.copyQueue = CopyQueue(remove_source=not cmds.getAttr("%s.%s" % (renderSettings, "keepTempFiles")))
+            print( "Render Settings - Staging Dir      : %s" % self.stagingRoot )
+
         pluginDir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
         version = cmds.about(v=True).replace(" ", "-")
 
@@ -170,36 +262,128 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         print( "Render Settings - Render Dir       : %s" % renderDir )
         print( "Render Settings - oiiotool Path    : %s" % cyclesPath )
 
-        animation = self.isAnimation()
+        animation = self.isAnimation(batch, frameRange)
         print( "Render Settings - Animation        : %s" % animation )
 
-        # Animation
-        if animation:
-            startFrame = int(cmds.getAttr("defaultRenderGlobals.startFrame"))
-            endFrame = int(cmds.getAttr("defaultRenderGlobals.endFrame"))
-            byFrame = int(cmds.getAttr("defaultRenderGlobals.byFrameStep"))
-            print( "Animation frame range : %d to %d, step %d" % (
-                startFrame, endFrame, byFrame) )
-
-            for frame in range(startFrame, endFrame+1, byFrame):
-                print( "Rendering frame " + str(frame) + " - begin" )
-
-                self.exportAndRender(renderDir, renderSettings, cyclesPath, oiiotoolPath,
-                    mtsDir, keepTempFiles, animation, frame, verbose)
+        # Frames are handed to a render queue, whose agents may run on other hosts
+        self.renderQueueDir = cmds.getAttr("%s.%s" % (renderSettings, "renderQueueDir")) or None
+        if self.renderQueueDir:
+            self.startRenderQueue(self.renderQueueDir,
+                cmds.getAttr("%s.%s" % (renderSettings, "renderQueueLocalAgents")))
+
+        # Post-render stages, like denoising, run on each frame while the next one
+        # renders. The settings they change are put back even if the render fails.
+        try:
+            self.startPostRender(renderSettings, oiiotoolPath, keepTempFiles)
+
+            # Geometry and motion samples are only reused between the frames of a single render
+            CyclesRendererIO.resetGeometryCache()
+            CyclesRendererIO.resetMotionSampleCache()
+
+            # Animation
+            if animation:
+                if frameRange:
+                    (startFrame, endFrame, byFrame) = frameRange
+                else:
+                    startFrame = int(cmds.getAttr("defaultRenderGlobals.startFrame"))
+                    endFrame = int(cmds.getAttr("defaultRenderGlobals.endFrame"))
+                    byFrame = int(cmds.getAttr("defaultRenderGlobals.byFrameStep"))
+                print( "Animation frame range : %d to %d, step %d" % (
+                    startFrame, endFrame, byFrame) )
+
+                # Read the textures of the next few frames while the current one renders
+                texturePrefetcher = None
+                texturePrefetchFrames = cmds.getAttr("%s.%s" % (renderSettings, "texturePrefetchFrames"))
+                if texturePrefetchFrames > 0:
+                    texturePrefetchScratchDir = cmds.getAttr("%s.%s" % (renderSettings, "texturePrefetchScratchDir"))
+                    texturePrefetcher = CyclesTexturePrefetch.TexturePrefetcher(texturePrefetchScratchDir)
+                    print( "Render Settings - Prefetch Frames  : %s" % texturePrefetchFrames )
+
+                frames = range(startFrame, endFrame+1, byFrame)
+
+                # Record each frame so an interrupted render can be resumed
+                imagePrefix = cmds.getAttr("defaultRenderGlobals.imageFilePrefix")
+                if imagePrefix is None:
+                    imagePrefix = self.getScenePrefix()
+                manifestPath = CyclesSequenceManifest.getManifestPath(projectDir, imagePrefix)
+                if frameRange:
+                    # Batch workers running at the same time each keep their own manifest
+                    manifestPath = CyclesSequenceManifest.getChunkManifestPath(manifestPath, startFrame, endFrame)
+                self.manifest = CyclesSequenceManifest.SequenceManifest(manifestPath)
+
+                resumeSequence = cmds.getAttr("%s.%s" % (renderSettings, "resumeSequence"))
+                if resumeSequence:
+                    self.manifest.load()
+                    (remainingFrames, invalidFrames) = self.manifest.getRemainingFrames(frames)
+
+                    print( "Resuming sequence : %s" % manifestPath )
+                    print( "Frames complete   : %d of %d" % (len(frames) - len(remainingFrames), len(frames)) )
+                    if remainingFrames:
+                        print( "Frames to render  : %s" % CyclesSequenceManifest.formatFrameRanges(remainingFrames) )
+                    for frame in sorted(invalidFrames.keys()):
+                        print( "\tframe %d : %s" % (frame, invalidFrames[frame]) )
+
+                    frames = remainingFrames
+                else:
+                    print( "Sequence manifest : %s" % manifestPath )
+
+                self.sequenceProgress = CyclesProgress.SequenceProgress(len(frames))
+
+                for i, frame in enumerate(frames):
+                    print( "Rendering frame " + str(frame) + " - begin" )
+
+                    if texturePrefetcher:
+                        upcomingFrames = frames[i+1:i+1+texturePrefetchFrames]
+                        if upcomingFrames:
+                            texturePrefetcher.schedule(CyclesRendererIO.getUpcomingTextureFiles(upcomingFrames))
+
+                    self.exportAndRender(renderDir, renderSettings, cyclesPath, oiiotoolPath,
+                        mtsDir, keepTempFiles, animation, frame, verbose, texturePrefetcher)
+
+                    # Queued frames end when their jobs finish
+                    if not self.renderQueueDir:
+                        print( "Rendering frame " + str(frame) + " - end" )
+                        print( "Sequence progress - %s" % self.sequenceProgress.formatStatus() )
+
+                # The queued frames may still read the prefetched textures
+                if self.renderQueueDir:
+                    self.finishQueuedFrames()
+
+                # The frames are recorded in the manifest once their stages have run
+                if self.postRenderQueue:
+                    self.finishPostRender()
+
+                if texturePrefetcher:
+                    texturePrefetcher.stop(removeCopies=not keepTempFiles)
+
+                self.manifest = None
+                self.sequenceProgress = None
+
+                # Geometry files are shared between frames so they're removed once the sequence is done
+                CyclesRendererIO.resetGeometryCache(removeFiles=not keepTempFiles)
+                CyclesRendererIO.resetMotionSampleCache()
+
+                print( "Animation finished" )
+
+            # Single frame
+            else:
+                imageName = self.exportAndRender(renderDir, renderSettings, cyclesPath, oiiotoolPath,
+                    mtsDir, keepTempFiles, animation, None, verbose)
 
-                print( "Rendering frame " + str(frame) + " - end" )
-
-            print( "Animation finished" )
+                # Display the render
+                if not cmds.about(batch=True):
+                    pass
+                    #CyclesRendererUI.showRender(imageName)
 
-        # Single frame
-        else:
-            imageName = self.exportAndRender(renderDir, renderSettings, cyclesPath, oiiotoolPath,
-                mtsDir, keepTempFiles, animation, None, verbose)
+            if self.renderQueue:
+                self.stopRenderQueue()
+        finally:
+            if self.postRenderQueue:
+                self.finishPostRender()
+            self.restorePreviousSettings(renderSettings)
 
-            # Display the render
-            if not cmds.about(batch=True):
-                pass
-                #CyclesRendererUI.showRender(imageName)
+        if self.copyQueue:
+            self.finishCopyBack()
 
         # Select the objects that the user had selected before they rendered, or clear the selection
         if len(userSelection) > 0:
@@ -207,10 +391,14 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         else:
             cmds.select(cl=True)
 
-    def isAnimation(self):
-        animation = cmds.getAttr("defaultRenderGlobals.animation")
-        if not cmds.about(batch=True) and animation:
-            print( "Animation isn't currently supported outside of Batch mode. Rendering current frame." )
+    def isAnimation(self, batch=False, frameRange=None):
+        if frameRange:
+            animation = True
+        else:
+            animation = cmds.getAttr("defaultRenderGlobals.animation")
+        if not (cmds.about(batch=True) or batch) and animation:
+            print( "Animation isn't currently supported outside of Batch mode. Use Render > Batch Render"
+                " to render the sequence in the background. Rendering current frame." )
             animation = False
 
         mayaReleasePythonGIL = os.environ.get('MAYA_RELEASE_PYTHON_GIL')
@@ -239,32 +427,292 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
                 imageWidth = cmds.getAttr("defaultResolution.width")
                 imageHeight = cmds.getAttr("defaultResolution.height")
 
-                pathTokens = os.path.splitext(imageName)
-                imageNameCropped = "%s_crop%s" % (pathTokens[0], pathTokens[1])
-                #print( "Generating cropped image : %s" % imageNameCropped )
-
-                oiiotoolResult = None
+                # PFM and NPY regions, and EXR regions when the OpenEXR binding is
+                # available, are expanded in-process. Other formats use oiiotool.
                 try:
-                    #cmd = '/usr/local/bin/oiiotool'
-                    cropArgs = '%dx%d-%d-%d' % (imageWidth, imageHeight, left, imageHeight-top)
-                    args = ['-v', imageName, '--crop', cropArgs, '--noautocrop', '-o', imageNameCropped]
-                    oiiotool = Process(description='reset image data window',
-                        cmd=oiiotoolPath,
-                        args=args)
-                    oiiotool.execute()
-                    oiiotoolResult = oiiotool.status
-                    #print( "oiiotool result : %s" % oiiotoolResult )
-                except:
-                    print( "Unable to run oiiotool" )
-                    oiiotoolResult = None
-
-                # Move the image with the new data window over the original rendered image
-                if oiiotoolResult in [0, None]:
-                    os.rename(imageNameCropped, imageName)
+                    resetStart = time.time()
+                    method = imagefile.reset_data_window(imageName, imageWidth, imageHeight,
+                        left, imageHeight-top, oiiotoolPath)
+                    print( "Reset image data window : %s (%s, %.3fs)" % (imageName, method, time.time() - resetStart) )
+                except Exception, e:
+                    print( "Unable to reset image data window : %s - %s" % (imageName, e) )
+
+    def getProjectPath(self, stagedFile):
+        if not self.stagingRoot:
+            return stagedFile
+        return os.path.join(self.projectDir, os.path.relpath(stagedFile, self.stagingRoot))
+
+    def copyBack(self, stagedFile):
+        projectFile = self.getProjectPath(stagedFile)
+        print( "Copying to project : %s" % projectFile )
+        self.copyQueue.put(stagedFile, projectFile)
+
+    def finishCopyBack(self):
+        print( "Waiting for %d copies to the project" % self.copyQueue.pending() )
+        failures = self.copyQueue.wait()
+        self.copyQueue.stop()
+
+        print( "Copied %d files to the project" % len(self.copyQueue.copied) )
+        if failures:
+            for (source, target, error) in failures:
+                print( "Failed to copy to the project : %s -> %s : %s" % (source, target, error) )
+            # Left in the staging directory so nothing is lost
+            cmds.warning( "Cycles : %d files couldn't be copied to the project and were left in %s" % (
+                len(failures), self.stagingRoot) )
+
+    def startPostRender(self, renderSettings, oiiotoolPath, keepTempFiles):
+        self.postRenderQueue = None
+        try:
+            stages = CyclesPostRender.getPostRenderStages(
+                lambda name: cmds.getAttr("%s.%s" % (renderSettings, name)), oiiotoolPath, keepTempFiles)
+        except Exception, e:
+            print( "Post-render - Unable to set up the stages : %s" % e )
+            stages = []
+        if not stages:
+            return
+
+        print( "Render Settings - Post-render      : %s" % ", ".join([stage.name for stage in stages]) )
+
+        # The scene is exported with the passes the stages need. The settings
+        # they change are put back once the render is done.
+        for (name, value) in CyclesPostRender.getRequiredSettings(stages).items():
+            previousValue = cmds.getAttr("%s.%s" % (renderSettings, name))
+            if previousValue != value:
+                print( "Post-render - Setting %s to %s" % (name, value) )
+                self.previousSettings[name] = previousValue
+                cmds.setAttr("%s.%s" % (renderSettings, name), value)
+
+        self.postRenderQueue = CyclesPostRender.PostRenderQueue(stages)
+
+    def restorePreviousSettings(self, renderSettings):
+        for (name, value) in self.previousSettings.items():
+            cmds.setAttr("%s.%s" % (renderSettings, name), value)
+        self.previousSettings = {}
+
+    def finishPostRender(self):
+        print( "Waiting for %d frames to finish post-render stages" % self.postRenderQueue.pending() )
+        failures = self.postRenderQueue.wait()
+        self.postRenderQueue.stop()
+        self.postRenderQueue = None
+
+        for (imageName, stageName, error) in failures:
+            print( "Post-render - Unable to %s : %s - %s" % (stageName, imageName, error) )
+        if failures:
+            # The frames were rendered, so they're kept without the stages' changes
+            cmds.warning( "Cycles : %d frames couldn't finish their post-render stages and were kept as rendered" %
+                len(failures) )
+
+    def finishFrame(self, frame, imageName, logName, renderStatus, watchdogTrips=None):
+        # The frame is recorded and copied back after its post-render stages
+        if self.postRenderQueue:
+            self.postRenderQueue.put(imageName, logName,
+                lambda imageName, fileNames, status: self.recordFrame(frame, imageName, fileNames, status,
+                    watchdogTrips),
+                renderStatus)
+        else:
+            self.recordFrame(frame, imageName, [imageName, logName], renderStatus, watchdogTrips)
+
+    def recordFrame(self, frame, imageName, fileNames, renderStatus, watchdogTrips=None):
+        # Recorded before the copy back, which may remove the staged image
+        if frame is not None and self.manifest:
+            self.manifest.recordFrame(frame, imageName, renderStatus, self.getProjectPath(imageName),
+                watchdogTrips)
+
+        # Copy the results back while the next frame renders
+        if self.copyQueue:
+            for stagedFile in fileNames:
+                if os.path.exists(stagedFile):
+                    self.copyBack(stagedFile)
+
+    def startRenderQueue(self, renderQueueDir, localAgents):
+        print( "Render Settings - Render Queue     : %s" % renderQueueDir )
+
+        # A daemon may already be serving the queue, with agents on other hosts
+        if renderqueue.daemon_running(renderQueueDir):
+            print( "Render queue - Submitting to the running daemon" )
+            return
+
+        print( "Render queue - Starting %d local agents" % localAgents )
+        agents = [renderqueue.WorkerAgent(renderqueue.LocalTransport(), name="local%d" % i)
+            for i in range(max(1, localAgents))]
+        self.renderQueue = renderqueue.RenderQueue(renderQueueDir, agents)
+        self.renderQueue.start()
+
+    def stopRenderQueue(self):
+        self.renderQueue.stop(kill=True)
+        print( "Render queue - %d jobs done, %d failed, %d retries" % (self.renderQueue.completed,
+            self.renderQueue.failed, self.renderQueue.retried) )
+        self.renderQueue = None
+
+    def queueRender(self, outFileName, geometryFiles, imageName, logName, profile,
+                    oiiotoolPath, keepTempFiles, animation, frame, sampleCount=0, samplePasses=1,
+                    timeBudget=None):
+        queuedFrame = {
+            'frame' : frame if animation else None,
+            'imageName' : imageName,
+            'logName' : logName,
+            'oiiotoolPath' : oiiotoolPath,
+            'keepTempFiles' : keepTempFiles,
+            'jobs' : {},
+            'passSamples' : None,
+            'passImageNames' : None,
+            'timeBudget' : timeBudget
+        }
+
+        # Each sample pass is a job of its own, so the passes can run on different agents
+        if samplePasses > 1:
+            queuedFrame['passSamples'] = CyclesSamplePasses.getPassSamples(sampleCount, samplePasses)
+            queuedFrame['passImageNames'] = []
+            for (index, passSampleCount) in enumerate(queuedFrame['passSamples']):
+                passSceneFileName = CyclesSamplePasses.writePassScene(outFileName, index)
+                passImageName = CyclesSamplePasses.getPassFileName(imageName, index)
+                passProfile = dict(profile)
+                passProfile['args'] = ['--samples', str(passSampleCount)] + profile['args']
+
+                jobId = renderqueue.submit_job(self.renderQueueDir, passSceneFileName,
+                    [outFileName] + geometryFiles, {os.path.basename(passImageName) : passImageName}, passProfile)
+                print( "Render queue - Submitted job %s : %s" % (jobId, passImageName) )
+                os.remove(passSceneFileName)
+
+                queuedFrame['jobs'][jobId] = None
+                queuedFrame['passImageNames'].append(passImageName)
+        else:
+            jobId = renderqueue.submit_job(self.renderQueueDir, outFileName, geometryFiles,
+                {os.path.basename(imageName) : imageName}, profile)
+            print( "Render queue - Submitted job %s : %s" % (jobId, imageName) )
+            queuedFrame['jobs'][jobId] = None
+
+        for jobId in queuedFrame['jobs']:
+            self.queuedFrames[jobId] = queuedFrame
+
+        # The job has its own copy of the scene and geometry
+        if not keepTempFiles:
+            # Geometry for animations may be reused by the next frame and is removed by doIt
+            if not animation:
+                for geometryFile in geometryFiles:
+                    try:
+                        os.remove(geometryFile)
+                    except:
+                        print( "Error removing temporary file : %s" % geometryFile )
+            os.remove(outFileName)
+
+        # Sequences are waited for once every frame is submitted
+        if not animation:
+            self.finishQueuedFrames()
+
+    def finishQueuedFrames(self):
+        frameCount = len(set([id(queuedFrame) for queuedFrame in self.queuedFrames.values()]))
+        framesFinished = 0
+        print( "Render queue - Waiting for %d frames" % frameCount )
+
+        batchMode = cmds.about(batch=True)
+        if not batchMode:
+            cmds.progressWindow(title="Cycles", progress=0, status="Waiting for the render queue", isInterruptable=True)
+
+        cancelled = False
+        try:
+            while self.queuedFrames:
+                finished = renderqueue.wait_for_jobs(self.renderQueueDir, self.queuedFrames.keys(),
+                    timeout=0.25, poll_interval=0.25)
+                for jobId in sorted(finished.keys()):
+                    queuedFrame = self.queuedFrames.pop(jobId)
+                    queuedFrame['jobs'][jobId] = finished[jobId] or {'state' : "missing", 'history' : []}
+
+                    # A frame rendered in sample passes finishes with its last pass
+                    if None not in queuedFrame['jobs'].values():
+                        self.finishQueuedFrame(queuedFrame)
+                        framesFinished += 1
+
+                if not batchMode:
+                    cmds.progressWindow(edit=True,
+                        progress=framesFinished*100/frameCount,
+                        status="%d of %d frames rendered" % (framesFinished, frameCount))
+
+                    # The jobs are killed by the daemon and then finish as cancelled
+                    if not cancelled and cmds.progressWindow(query=True, isCancelled=True):
+                        print( "Render cancelled" )
+                        for jobId in self.queuedFrames:
+                            renderqueue.cancel_job(self.renderQueueDir, jobId)
+                        cancelled = True
+        finally:
+            if not batchMode:
+                cmds.progressWindow(endProgress=True)
+
+    def finishQueuedFrame(self, queuedFrame):
+        frame = queuedFrame['frame']
+        imageName = queuedFrame['imageName']
+        logName = queuedFrame['logName']
+        oiiotoolPath = queuedFrame['oiiotoolPath']
+
+        renderStatus = 0
+        renderSeconds = 0.0
+        for jobId in sorted(queuedFrame['jobs'].keys()):
+            job = queuedFrame['jobs'][jobId]
+            history = job['history']
+            if history:
+                print( "Render queue - Job %s %s : %d attempts, last on %s in %.1fs" % (jobId, job['state'],
+                    len(history), history[-1]['agent'], history[-1]['seconds']) )
+                renderSeconds = max(renderSeconds, history[-1]['seconds'])
+            else:
+                print( "Render queue - Job %s %s" % (jobId, job['state']) )
+            if job['state'] != "done":
+                renderStatus = -1
+
+        # The render's log is kept next to the image, as for local renders, with
+        # the log of every pass for frames rendered in sample passes
+        with open(logName, 'w') as logFile:
+            for jobId in sorted(queuedFrame['jobs'].keys()):
+                jobLogName = queuedFrame['jobs'][jobId].get('log')
+                if jobLogName and os.path.exists(jobLogName):
+                    with open(jobLogName, 'r') as jobLogFile:
+                        shutil.copyfileobj(jobLogFile, logFile)
+        if not queuedFrame['keepTempFiles']:
+            for jobId in queuedFrame['jobs']:
+                renderqueue.JobStore(self.renderQueueDir).remove(jobId)
+
+        if renderStatus == 0 and queuedFrame['passSamples']:
+            try:
+                CyclesSamplePasses.mergePasses(queuedFrame['passImageNames'], queuedFrame['passSamples'],
+                    imageName, oiiotoolPath, queuedFrame['keepTempFiles'])
+            except Exception, e:
+                print( "Sample passes - Unable to merge the passes : %s" % e )
+                renderStatus = -1
+
+        # Agents may run on other hosts, so their times are logged but don't change this host's costs
+        if queuedFrame['timeBudget']:
+            queuedFrame['timeBudget'].recordRender(renderSeconds, renderStatus == 0, updateCost=False)
+
+        if frame is not None:
+            print( "Rendering frame " + str(frame) + " - end" )
+        if self.sequenceProgress:
+            self.sequenceProgress.frameFinished(renderSeconds)
+            print( "Sequence progress - %s" % self.sequenceProgress.formatStatus() )
+
+        if renderStatus == 0 and oiiotoolPath != "":
+            self.resetImageDataWindow(imageName, oiiotoolPath)
+
+        self.finishFrame(frame, imageName, logName, renderStatus)
 
     def getScenePrefix(self):
         return str('.'.join(os.path.split(cmds.file(q=True, sn=True))[-1].split('.')[:-1]))
 
+    def waitWithProgressWindow(self, cyclesRender, renderProgress):
+        cmds.progressWindow(title="Cycles", progress=0, status="Starting render", isInterruptable=True)
+        try:
+            while not cyclesRender.wait(0.25):
+                if renderProgress.event:
+                    cmds.progressWindow(edit=True,
+                        progress=int(renderProgress.event['fraction']*100),
+                        status=renderProgress.formatEvent())
+
+                if cmds.progressWindow(query=True, isCancelled=True):
+                    print( "Render cancelled" )
+                    cyclesRender.kill("render cancelled")
+                    cyclesRender.wait()
+                    break
+        finally:
+            cmds.progressWindow(endProgress=True)
+
     def renderScene(self,
                     outFileName, 
                     renderDir, 
@@ -276,7 +724,9 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
                     animation=False, 
                     frame=1, 
                     verbose=False,
-                    renderSettings=None):
+                    renderSettings=None,
+                    processKeys=None,
+                    sceneText=None):
         imageDir = os.path.join(os.path.split(renderDir)[0], 'images')
         os.chdir(imageDir)
 
@@ -290,6 +740,15 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         writePartialResultsInterval = -1
         blockSize = 32
         threads = 0
+        noOutputTimeout = 0
+        noProgressTimeout = 0
+        totalTimeout = 0
+        retries = 0
+        retryDelay = 10.0
+        sampleCount = 0
+        samplePasses = 1
+        timeBudgetSeconds = 0.0
+        convergenceNoise = 0.0
         if renderSettings:
             extension = getImageExtension(renderSettings)
 
@@ -297,12 +756,25 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
             writePartialResultsInterval = cmds.getAttr("%s.%s" % (renderSettings, "writePartialResultsInterval"))
             blockSize = cmds.getAttr("%s.%s" % (renderSettings, "blockSize"))
             threads = cmds.getAttr("%s.%s" % (renderSettings, "threads"))
+            noOutputTimeout = cmds.getAttr("%s.%s" % (renderSettings, "renderNoOutputTimeout"))
+            noProgressTimeout = cmds.getAttr("%s.%s" % (renderSettings, "renderNoProgressTimeout"))
+            totalTimeout = cmds.getAttr("%s.%s" % (renderSettings, "renderTimeout"))
+            retries = cmds.getAttr("%s.%s" % (renderSettings, "renderRetries"))
+            retryDelay = cmds.getAttr("%s.%s" % (renderSettings, "renderRetryDelay"))
+            sampleCount = cmds.getAttr("%s.%s" % (renderSettings, "sampleCount"))
+            samplePasses = cmds.getAttr("%s.%s" % (renderSettings, "samplePasses"))
+            timeBudgetSeconds = cmds.getAttr("%s.%s" % (renderSettings, "renderTimeBudget"))
+            convergenceNoise = cmds.getAttr("%s.%s" % (renderSettings, "convergenceNoise"))
 
             print( "Render Settings - Partial Results  : %s" % writePartialResults )
             print( "Render Settings - Results Interval : %s" % writePartialResultsInterval )
             print( "Render Settings - Block Size       : %s" % blockSize )
             if threads:
                 print( "Render Settings - Threads          : %s" % threads )
+            if samplePasses > 1:
+                print( "Render Settings - Sample Passes    : %s" % samplePasses )
+            if convergenceNoise > 0:
+                print( "Render Settings - Convergence Noise: %s" % convergenceNoise )
 
         if animation:
             extensionPadding = cmds.getAttr("defaultRenderGlobals.extensionPadding")
@@ -330,6 +802,9 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         args.extend(['--width', imageWidth])
         args.extend(['--height', imageHeight])
         args = ['--output', imageName]
+        # The time budget's pilot renders with these arguments, so it times the same threads
+        if threads:
+            args.extend(['--threads', str(threads)])
         args.extend([outFileName])
 
         if ' ' in mtsDir:
@@ -340,12 +815,78 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         env.update({"DISPLAY": os.environ.get("DISPLAY", ":0.0")})
         env.update({"PATH": os.environ.get("PATH")})
 
-        cyclesRender = Process(description='render an image',
-            cmd=cyclesPath,
-            args=args,
-            env=env, non_blocking = True)
+        # A time budget picks the sample count from what a sample costs on this host
+        timeBudget = None
+        if timeBudgetSeconds > 0:
+            timeBudgetCacheDir = cmds.getAttr("%s.%s" % (renderSettings, "timeBudgetCacheDir"))
+            if not timeBudgetCacheDir:
+                timeBudgetCacheDir = os.path.join(cmds.internalVar(userAppDir=True), "CyclesForMaya", "timeBudget")
+            timeBudget = CyclesTimeBudget.TimeBudget(timeBudgetCacheDir, timeBudgetSeconds,
+                cmds.getAttr("%s.%s" % (renderSettings, "timeBudgetMinSamples")),
+                cmds.getAttr("%s.%s" % (renderSettings, "timeBudgetMaxSamples")),
+                cmds.getAttr("%s.%s" % (renderSettings, "timeBudgetPilotSamples")))
+            try:
+                sampleCount = timeBudget.chooseSamples(cyclesPath, args, env, outFileName, imageName,
+                    geometryFiles, threads)
+            except Exception, e:
+                print( "Time budget - Unable to estimate the cost, rendering %d samples : %s" % (sampleCount, e) )
+                timeBudget = None
+
+            # Sample passes share out the samples themselves, and the budget's
+            # samples are the most a frame rendered until it converges takes
+            if timeBudget and samplePasses <= 1 and convergenceNoise <= 0:
+                args = ['--samples', str(sampleCount)] + args
+
+        # Queued renders run in the job's directory, on whichever host picks them up
+        if self.renderQueueDir:
+            if convergenceNoise > 0:
+                print( "Convergence - Queued renders use the sample count" )
+            profile = {
+                'cmd' : cyclesPath,
+                'args' : [{imageName : '{output}', outFileName : '{scene}'}.get(arg, arg) for arg in args],
+                'env' : env,
+                'retries' : max(0, retries),
+                'retry_delay' : retryDelay,
+                'timeout_no_output' : noOutputTimeout,
+                'timeout_no_progress' : noProgressTimeout,
+                'timeout_total' : totalTimeout,
+                'progress_pattern' : CyclesProgress.progressPattern
+            }
+            self.queueRender(outFileName, geometryFiles, imageName, logName, profile,
+                oiiotoolPath, keepTempFiles, animation, frame, sampleCount, samplePasses, timeBudget)
+            return imageName
+
+        # The frame renders in steps until its noise is under the target
+        if convergenceNoise > 0:
+            convergenceMaxSamples = cmds.getAttr("%s.%s" % (renderSettings, "convergenceMaxSamples"))
+            if timeBudget:
+                convergenceMaxSamples = min(convergenceMaxSamples, sampleCount)
+            cyclesRender = CyclesConvergence.ConvergenceRender(cyclesPath, args, env, outFileName,
+                imageName, convergenceNoise,
+                cmds.getAttr("%s.%s" % (renderSettings, "convergenceFraction")),
+                cmds.getAttr("%s.%s" % (renderSettings, "convergenceMinSamples")),
+                convergenceMaxSamples,
+                cmds.getAttr("%s.%s" % (renderSettings, "convergenceIncrement")),
+                threads, oiiotoolPath, keepTempFiles)
+
+        # The frame's samples are split between passes with their own seeds, rendered at the same time
+        elif samplePasses > 1:
+            cyclesRender = CyclesSamplePasses.SamplePassRender(cyclesPath, args, env, outFileName,
+                imageName, sampleCount, samplePasses, threads, oiiotoolPath, keepTempFiles)
+        else:
+            cyclesRender = Process(description='render an image',
+                cmd=cyclesPath,
+                args=args,
+                env=env, non_blocking = True)
+
+        # Cycles' status lines are turned into progress events, printed now and
+        # then in batch mode and shown in the progress window in the UI
+        batchMode = cmds.about(batch=True)
+        renderProgress = CyclesProgress.RenderProgress(frame if animation else None,
+            printInterval=5.0 if batchMode else None, sequence=self.sequenceProgress)
 
         def renderLogCallback(line):
+            renderProgress.update(line)
             if "Writing image" in line:
                 imageName = line.split("\"")[-2]
 
@@ -354,12 +895,50 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
                 #    CyclesRendererUI.showRender(imageName)
 
         cyclesRender.log_callback = renderLogCallback
+        if sceneText is not None:
+            cyclesRender.stdin_data = sceneText
+        if processKeys:
+            cyclesRender.process_keys.extend(processKeys)
+        if timeBudget:
+            cyclesRender.process_keys.extend(timeBudget.getProcessKeys())
         #cyclesRender.echo = False
 
+        # Long renders print a lot, which slows down the Script Editor. The
+        # full output goes to the log file.
+        cyclesRender.log_tail_lines = 1000
+        if not verbose:
+            cyclesRender.echo_lines_per_second = 10
+
+        # Renders that hang are killed and retried, so they don't hold up the rest of a sequence
+        cyclesRender.timeout_no_output = noOutputTimeout
+        cyclesRender.timeout_no_progress = noProgressTimeout
+        cyclesRender.timeout_total = totalTimeout
+        cyclesRender.progress_pattern = CyclesProgress.progressPattern
+        cyclesRender.retries = max(0, retries)
+        cyclesRender.retry_delay = retryDelay
+
         cyclesRender.execute()
+
+        # The output is collected on a separate thread, so wait until the render has finished
+        if batchMode:
+            cyclesRender.wait()
+        else:
+            self.waitWithProgressWindow(cyclesRender, renderProgress)
+        if self.sequenceProgress:
+            self.sequenceProgress.frameFinished(time.time() - renderProgress.start)
+        if timeBudget:
+            # A frame that stops early doesn't measure the cost of the budget's samples
+            timeBudget.recordRender(time.time() - renderProgress.start, cyclesRender.status == 0,
+                updateCost=convergenceNoise <= 0)
         cyclesRender.write_log_to_disk(logName, format='txt')
 
         print( "Render execution returned : %s" % cyclesRender.status )
+        renderStatus = cyclesRender.status
+        for trip in cyclesRender.watchdog_trips:
+            print( "Render watchdog - %s" % trip )
+        if cyclesRender.max_rss is not None:
+            print( "Render resources - CPU time %.1fs user, %.1fs system, peak memory %.1f MB" % (
+                cyclesRender.user_time, cyclesRender.system_time, cyclesRender.max_rss/1024.0) )
 
         if oiiotoolPath != "":
             self.resetImageDataWindow(imageName, oiiotoolPath)
@@ -367,18 +946,24 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
         if not keepTempFiles:
             #Delete all of the temp file we just made
             os.chdir(renderDir)
-            for geometryFile in geometryFiles:
-                try:
-                    #print( "Removing geometry : %s" % geometryFile )
-                    os.remove(geometryFile)
-                except:
-                    print( "Error removing temporary file : %s" % geometryFile )
+            # Geometry for animations may be reused by the next frame and is removed by doIt
+            if not animation:
+                for geometryFile in geometryFiles:
+                    try:
+                        #print( "Removing geometry : %s" % geometryFile )
+                        os.remove(geometryFile)
+                    except:
+                        print( "Error removing temporary file : %s" % geometryFile )
             #print( "Removing cycles scene description : %s" % outFileName )
-            os.remove(outFileName)
+            if sceneText is None:
+                os.remove(outFileName)
             #os.remove(logName)
         else:
             print( "Keeping temporary files" )
 
+        self.finishFrame(frame if animation else None, imageName, logName, renderStatus,
+            cyclesRender.watchdog_trips)
+
         return imageName
 
     def exportAndRender(self,
@@ -390,7 +975,8 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
                         keepTempFiles,  
                         animation, 
                         frame=None, 
-                        verbose=False):
+                        verbose=False,
+                        texturePrefetcher=None):
 
         if frame != None:
             # Calling this can lead to Maya 2016 locking up if you don't have MAYA_RELEASE_PYTHON_GIL set
@@ -407,37 +993,71 @@ class cyclesForMaya(OpenMayaMPx.MPxCommand):
 
         outFileName = os.path.join(renderDir, "%s.xml" % scenePrefix)
 
+        # Piping the scene to Cycles skips writing and re-reading it. The file
+        # is still written when temp files are kept, so it can be inspected.
+        pipeScene = (cmds.getAttr("%s.%s" % (renderSettings, "pipeSceneDescription")) and
+            not keepTempFiles and CyclesRendererIO.canPipeScene())
+
+        # Queued jobs take a copy of the scene file, sample passes and convergence
+        # steps include it and time budgets render it for a pilot
+        if (self.renderQueueDir or cmds.getAttr("%s.%s" % (renderSettings, "samplePasses")) > 1 or
+            cmds.getAttr("%s.%s" % (renderSettings, "renderTimeBudget")) > 0 or
+            cmds.getAttr("%s.%s" % (renderSettings, "convergenceNoise")) > 0):
+            pipeScene = False
+
         # Export scene and geometry
-        geometryFiles = CyclesRendererIO.writeScene(outFileName, renderDir, renderSettings)
+        sceneText = None
+        if pipeScene:
+            outFileName = CyclesRendererIO.pipedSceneFileName
+            (geometryFiles, sceneText) = CyclesRendererIO.writeSceneText(renderDir, renderSettings, texturePrefetcher)
+        else:
+            geometryFiles = CyclesRendererIO.writeScene(outFileName, renderDir, renderSettings, texturePrefetcher)
+
+        processKeys = []
+        if texturePrefetcher:
+            processKeys.extend(texturePrefetcher.frameStats())
 
         # Render scene, delete scene and geometry
         imageName = self.renderScene(outFileName, renderDir, cyclesPath, oiiotoolPath,
             mtsDir, keepTempFiles, geometryFiles, animation, frame, verbose,
-            renderSettings)
+            renderSettings, processKeys, sceneText)
 
         return imageName
 
+#
+# Batch rendering
+#
+# Render > Batch Render renders the sequence in the background, in chunks of
+# frames handed to mayapy workers. See CyclesBatch.
+#
+batchRender = None
+
 def batchRenderProcedure(options):
+    global batchRender
     print("\n\n\nbatchRenderProcedure - options : %s\n\n\n" % str(options))
 
-    '''
-    kwargs = {}
-    try:
-        cmds.batchRender(mc='Cycles')
-    except RuntimeError, err:
-        print err
-    '''
+    if batchRender and batchRender.isRunning():
+        print( "Batch render - already running. Cancel it before starting another." )
+        return
+
+    import CyclesBatch
+    createRenderSettingsNode()
+    batchRender = CyclesBatch.startBatchRender(renderSettings)
 
 def batchRenderOptionsProcedure():
     print("\n\n\nbatchRenderOptionsProcedure\n\n\n")
 
+    # Chunk size, workers and the mayapy path are in the Cycles render settings
+    mel.eval("unifiedRenderGlobalsWindow")
+
 def batchRenderOptionsStringProcedure():
     print("\n\n\nbatchRenderOptionsStringProcedure\n\n\n")
     return ' -r %s' % kPluginCmdName
 
 def cancelBatchRenderProcedure():
     print("\n\n\ncancelBatchRenderProcedure\n\n\n")
-    cmds.batchRender()
+    if batchRender and batchRender.isRunning():
+        batchRender.cancel()
 
 def commandRenderProcedure(options):
     print("\n\n\ncommandRenderProcedure - options : %s\n\n\n" % str(options))
@@ -452,6 +1072,15 @@ def commandRenderProcedure(options):
 def cmdCreator():
     return OpenMayaMPx.asMPxPtr( cyclesForMaya() )
 
+# Syntax
+def syntaxCreator():
+    syntax = OpenMaya.MSyntax()
+    syntax.addFlag(kBatchFlag, kBatchFlagLong, OpenMaya.MSyntax.kBoolean)
+    syntax.addFlag(kStartFrameFlag, kStartFrameFlagLong, OpenMaya.MSyntax.kLong)
+    syntax.addFlag(kEndFrameFlag, kEndFrameFlagLong, OpenMaya.MSyntax.kLong)
+    syntax.addFlag(kByFrameFlag, kByFrameFlagLong, OpenMaya.MSyntax.kLong)
+    return syntax
+
 def createMelPythonCallback(module, function, options=False):
     # Return value for python mel command is documented as string[] but seems to return
     # string in some cases. Commands that don't have options are assumed to return string.
@@ -511,17 +1140,10 @@ def registerRenderer():
 def initializePlugin(mobject):
     mplugin = OpenMayaMPx.MFnPlugin(mobject)
 
-    # Load needed plugins
-    try:
-        if not cmds.pluginInfo( "objExport", query=True, loaded=True ):
-            cmds.loadPlugin( "objExport" )
-    except:
-            sys.stderr.write( "Failed to load objExport plugin\n" )
-            raise
-
+    # objExport is only loaded if the legacy OBJ geometry export is used
     try:
         # Register Cycles Renderer
-        mplugin.registerCommand( kPluginCmdName, cmdCreator )
+        mplugin.registerCommand( kPluginCmdName, cmdCreator, syntaxCreator )
     except:
         sys.stderr.write( "Failed to register command: %s\n" % kPluginCmdName )
         raise
@@ -1,5 +1,9 @@
+import array
+import hashlib
+import math
 import os
 import struct
+import sys
 
 import maya.cmds as cmds
 import maya.mel as mel
@@ -10,6 +14,8 @@ import pymel.core
 
 from process import Process
 
+import CyclesTextureCache
+
 # Will be populated as materials are registered with Maya
 materialNodeTypes = []
 
@@ -221,6 +227,12 @@ def TransformElement(typeAttribute=None, id=None):
 def RefElement(typeAttribute=None, id=None):
     return createSceneElement(typeAttribute, id, 'ref')
 
+def IncludeElement(includeFileName, sceneDir):
+    # Cycles resolves include paths relative to the directory of the scene file
+    element = createSceneElement(elementType='include')
+    element.addAttribute('src', os.path.relpath(includeFileName, sceneDir))
+    return element
+
 def VolumeElement(name, volumePath=None, typeAttribute='gridvolume'):
     element = createSceneElement(typeAttribute, elementType='volume')
     element.addAttribute('name', name)
@@ -257,6 +269,23 @@ def NestedBSDFElement(material, connectedAttribute="bsdf", useDefault=True):
 
     return shaderElement
 
+def getFileNodeTexture(fileNode, time=None):
+    # Passing a time evaluates the path at that time, without changing the current time
+    timeArgs = {} if time is None else {'time' : time}
+
+    fileTexture = cmds.getAttr(fileNode+".fileTextureName", **timeArgs)
+    #print( "Found texture : %s" % fileTexture )
+    animatedTexture = cmds.getAttr("%s.%s" % (fileNode, "useFrameExtension"))
+    if animatedTexture:
+        textureFrameNumber = cmds.getAttr("%s.%s" % (fileNode, "frameExtension"), **timeArgs)
+        # Should make this an option at some point
+        tokens = fileTexture.split('.')
+        tokens[-2] = str(textureFrameNumber).zfill(4)
+        fileTexture = '.'.join(tokens)
+        #print( "Animated texture path : %s" % fileTexture )
+
+    return fileTexture
+
 def getTextureFile(material, connectionAttr):
     connections = cmds.listConnections(material, connections=True)
     fileTexture = None
@@ -265,22 +294,24 @@ def getTextureFile(material, connectionAttr):
             connection = connections[i]
             connectionType = cmds.nodeType(connection)
             if connectionType == "file" and connections[i-1]==(material+"."+connectionAttr):
-                fileTexture = cmds.getAttr(connection+".fileTextureName")
+                fileTexture = getFileNodeTexture(connection)
                 hasFile=True
-                #print( "Found texture : %s" % fileTexture )
-                animatedTexture = cmds.getAttr("%s.%s" % (connection, "useFrameExtension"))
-                if animatedTexture:
-                    textureFrameNumber = cmds.getAttr("%s.%s" % (connection, "frameExtension"))
-                    # Should make this an option at some point
-                    tokens = fileTexture.split('.')
-                    tokens[-2] = str(textureFrameNumber).zfill(4)
-                    fileTexture = '.'.join(tokens)
-                    #print( "Animated texture path : %s" % fileTexture )
             #else:
             #    print "Source can only be an image file"
 
     return fileTexture
 
+def getUpcomingTextureFiles(frames):
+    # File nodes feed both shaders and environment lights
+    textureFiles = []
+    for fileNode in cmds.ls(type="file"):
+        animatedTexture = cmds.getAttr("%s.%s" % (fileNode, "useFrameExtension"))
+        for frame in (frames if animatedTexture else frames[:1]):
+            fileTexture = getFileNodeTexture(fileNode, frame)
+            if fileTexture and fileTexture not in textureFiles:
+                textureFiles.append(fileTexture)
+    return textureFiles
+
 def TextureElement(name, texturePath, scale=None):
     textureElementDict = createSceneElement('bitmap', elementType='texture')
     textureElementDict.addChild( StringParameter('filename', texturePath) )
@@ -1277,7 +1308,7 @@ def evaluateShaderTreeCycles(materialNode):
             shaderElement.addAttribute("color", "{0} {1} {2}".format(clr[0], clr[1], clr[2]))
     elif materialNode.type() == "file":
         shaderElement = createSceneElement(elementType='image_texture')
-        fileTexture = materialNode.getAttr("fileTextureName")
+        fileTexture = getFileNodeTexture(materialNode.name())
         shaderElement.addAttribute("filename", fileTexture)
 
     myElements = list()
@@ -2183,34 +2214,210 @@ def getRenderableCamera():
 
     return rCamShape
 
-z_flip_mtx = pymel.core.datatypes.Matrix([1.0, 0.0, 0.0, 0.0,  0.0, 1.0, 0.0, 0.0,  0.0, 0.0, -1.0, 0.0,  0.0, 0.0, 0.0, 1.0])
-ident_mtx = pymel.core.datatypes.Matrix([1.0, 0.0, 0.0, 0.0,  0.0, 1.0, 0.0, 0.0,  0.0, 0.0, 1.0, 0.0,  0.0, 0.0, 0.0, 1.0])
+#
+# World matrices
+#
+# The world matrices of everything exported for a frame are read in one pass
+# over the DAG. Cycles' Z axis points the other way from Maya's, so the third
+# row of every matrix is flipped, and the matrices are formatted, over the
+# whole table at once.
+#
+worldMatrixTable = {}
+transformTable = {}
+
+def getDagPath(node):
+    selection = OpenMaya.MSelectionList()
+    selection.add(node)
+    dagPath = OpenMaya.MDagPath()
+    selection.getDagPath(0, dagPath)
+    return dagPath
+
+def getWorldMatrices(nodes):
+    selection = OpenMaya.MSelectionList()
+    for node in nodes:
+        selection.add(node)
+
+    values = array.array('d')
+    dagPath = OpenMaya.MDagPath()
+    for i in range(selection.length()):
+        selection.getDagPath(i, dagPath)
+        m = dagPath.inclusiveMatrix()
+        values.extend([m(r, c) for r in range(4) for c in range(4)])
+
+    return values
+
+def flipMatricesZ(values):
+    for i in range(8, 12):
+        values[i::16] = array.array('d', [-v for v in values[i::16]])
+
+def formatMatrices(values):
+    text = map(str, values)
+    return [" ".join(text[i:i+16]) for i in range(0, len(text), 16)]
+
+def buildTransformTable(nodes):
+    global worldMatrixTable
+    global transformTable
+
+    # The selection list merges duplicates, so the nodes have to be unique to line up with the matrices
+    uniqueNodes = []
+    for node in nodes:
+        if node not in uniqueNodes:
+            uniqueNodes.append(node)
+
+    values = getWorldMatrices(uniqueNodes)
+    worldMatrixTable = dict((node, values[i*16:(i+1)*16].tolist()) for i, node in enumerate(uniqueNodes))
+
+    flipMatricesZ(values)
+    transformTable = dict(zip(uniqueNodes, formatMatrices(values)))
+
+def getWorldMatrix(node):
+    if node in worldMatrixTable:
+        return worldMatrixTable[node]
+    return getWorldMatrices([node]).tolist()
+
+def getTransformDict(node, flip=True):
+    if flip and node in transformTable:
+        xform_str = transformTable[node]
+    else:
+        values = getWorldMatrices([node])
+        if flip:
+            flipMatricesZ(values)
+        xform_str = formatMatrices(values)[0]
+
+    transformDict = createSceneElement(elementType = 'transform')
+    transformDict.addAttribute('matrix', xform_str)
+
+    return transformDict
+
+#
+# Motion blur
+#
+# Motion samples are gathered in a single sweep over the shutter interval. The
+# time is set once per step and the world matrices of every exported transform,
+# and the points of every mesh that can deform, are captured at that time.
+# Samples are cached by time so steps shared by adjacent frames aren't
+# evaluated twice.
+#
+motionSampleCache = {}
+
+def resetMotionSampleCache():
+    global motionSampleCache
+    motionSampleCache = {}
+
+def getMotionSettings(renderSettings):
+    motionBlur = cmds.getAttr("%s.%s" % (renderSettings, "motionBlur"))
+    if not motionBlur:
+        return None
+
+    # Cycles needs an odd number of steps so that the middle one falls on the frame
+    steps = cmds.getAttr("%s.%s" % (renderSettings, "motionBlurSteps"))
+    steps = max(3, steps + 1 - (steps % 2))
 
-def getTransformDict(node, mtx = z_flip_mtx):
-    xform = pymel.core.datatypes.Matrix(node.getTransformation())
+    shutter = cmds.getAttr("%s.%s" % (renderSettings, "motionBlurShutter"))
 
-    xform = mtx * xform
+    return (steps, shutter)
 
-    xform_str = " ".join([str(xform[i][j]) for i in range(4) for j in range(4)])
+def getMotionSampleTimes(frame, steps, shutter):
+    return [frame + shutter*(float(i)/(steps-1) - 0.5) for i in range(steps)]
+
+def getObjectPoints(shape):
+    points = OpenMaya.MPointArray()
+    OpenMaya.MFnMesh(getDagPath(shape)).getPoints(points, OpenMaya.MSpace.kObject)
+    return [c for i in range(points.length()) for c in (points[i].x, points[i].y, points[i].z)]
+
+def getDeformableMeshes(geoms):
+    # Static meshes can't deform, so their points aren't sampled
+    meshes = {}
+    for geom in geoms:
+        shape = getMeshShape(geom)
+        if shape and not isStaticMesh(shape):
+            meshes[geom] = shape
+    return meshes
+
+def sampleSceneMotion(times, transforms, meshes):
+    def isCached(sample):
+        return (sample and
+            all(transform in sample['matrices'] for transform in transforms) and
+            all(geom in sample['points'] for geom in meshes))
+
+    # Samples before the start of this shutter interval won't be used again
+    for key in motionSampleCache.keys():
+        if key < round(times[0], 4):
+            del motionSampleCache[key]
+
+    currentTime = cmds.currentTime(query=True)
+    timeChanged = False
+    try:
+        for t in times:
+            key = round(t, 4)
+            if isCached(motionSampleCache.get(key)):
+                continue
+
+            cmds.currentTime(t, update=True)
+            timeChanged = True
+
+            values = getWorldMatrices(transforms)
+            sample = {'matrices' : {}, 'points' : {}}
+            for i, transform in enumerate(transforms):
+                sample['matrices'][transform] = values[i*16:(i+1)*16]
+            for geom, shape in meshes.iteritems():
+                sample['points'][geom] = getObjectPoints(shape)
+            motionSampleCache[key] = sample
+    finally:
+        if timeChanged:
+            cmds.currentTime(currentTime, update=True)
+
+    samples = [motionSampleCache[round(t, 4)] for t in times]
+    motion = {
+        'matrices' : dict((transform, [sample['matrices'][transform] for sample in samples]) for transform in transforms),
+        'points' : dict((geom, [sample['points'][geom] for sample in samples]) for geom in meshes)
+    }
+    return motion
+
+def getMotionTransformDict(matrices):
+    moving = any(m != matrices[0] for m in matrices[1:])
+    if moving:
+        # Cycles takes the matrices at shutter open, the frame and shutter close
+        keys = [matrices[0], matrices[len(matrices)/2], matrices[-1]]
+    else:
+        keys = [matrices[len(matrices)/2]]
+
+    values = array.array('d')
+    for m in keys:
+        values.extend(m)
+    flipMatricesZ(values)
+    xform_str = " ".join(formatMatrices(values))
 
     transformDict = createSceneElement(elementType = 'transform')
     transformDict.addAttribute('matrix', xform_str)
 
-    return transformDict
+    return transformDict, moving
 
-def writeSensorCycles(frameNumber, renderSettings):
+def writeSensorCycles(frameNumber, renderSettings, rCamShape=None, motion=None):
     # Find renderable camera
-    rCamShape = getRenderableCamera()
+    if not rCamShape:
+        rCamShape = getRenderableCamera()
 
     camNode = pymel.core.PyNode(rCamShape)
+    camTransform = cmds.listRelatives(rCamShape, parent=True, fullPath=True)[0]
 
-    transformDict = getTransformDict(camNode.parent(0))
+    moving = False
+    if motion and camTransform in motion['matrices']:
+        transformDict, moving = getMotionTransformDict(motion['matrices'][camTransform])
+    else:
+        transformDict = getTransformDict(camTransform)
 
     camDict = createSceneElement(elementType = 'camera')
     camDict.addAttribute('type', 'perspective')
     camDict.addAttribute('fov', 0.5*camNode.getHorizontalFieldOfView()*3.14159265/180.0)
 
-    transformDict.addChild(camDict)
+    if moving:
+        stateDict = createSceneElement(elementType = 'state')
+        stateDict.addAttribute('use_motion', 'true')
+        stateDict.addChild(camDict)
+        transformDict.addChild(stateDict)
+    else:
+        transformDict.addChild(camDict)
 
     return transformDict
 
@@ -2324,7 +2531,7 @@ def writeLightDirectional(light):
     for i in range(3):
         irradiance[i] = intensity*color[i]
 
-    matrix = cmds.getAttr(light+".worldMatrix")
+    matrix = getWorldMatrix(light)
     lightDir = [-matrix[8],-matrix[9],-matrix[10]]
 
     # Create a structure to be written
@@ -2342,7 +2549,7 @@ def writeLightPoint(light):
     for i in range(3):
         irradiance[i] = intensity*color[i]
 
-    matrix = cmds.getAttr(light+".worldMatrix")
+    matrix = getWorldMatrix(light)
     position = [matrix[12],matrix[13],matrix[14]]
 
     # Create a structure to be written
@@ -2360,16 +2567,11 @@ def writeLightArea(light):
     for i in range(3):
         irradiance[i] = intensity*color[i]
 
-    lightNode = pymel.core.PyNode(light)
-
     areaLightName = light.replace(':', '__').replace('|', '__')
 
     shaderDict = createSceneElement(elementType = 'shader')
     shaderDict.addAttribute('name', "{0}_shader".format(areaLightName))
 
-    intensity = lightNode.getIntensity()
-    color = lightNode.getColor()
-
     a = createSceneElement(elementType = 'emission')
     a.addAttribute('name', 'emission')
     a.addAttribute('color', '{0} {1} {2}'.format(color[0], color[1], color[2]))
@@ -2385,16 +2587,19 @@ def writeLightArea(light):
     lgt = createSceneElement(elementType = 'light')
     lgt.addAttribute('type', 'area')
 
-    xform = pymel.core.datatypes.Matrix(lightNode.parent(0).getTransformation())
-    co = pymel.core.datatypes.Point([0,0,0]) * xform
-    dir = pymel.core.datatypes.Vector([0,0,1]).rotateBy(xform)
+    # The rows of the world matrix are the light's axes and position
+    matrix = getWorldMatrix(light)
+    co = matrix[12:15]
 
-    axisu = pymel.core.datatypes.Vector([1,0,0]) * xform
-    axisv = pymel.core.datatypes.Vector([0,1,0]) * xform
-    sizeu = axisu.length()
-    axisu.normalize()
-    sizev = axisv.length()
-    axisv.normalize()
+    def lengthAndDirection(v):
+        length = math.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+        if length == 0.0:
+            return (0.0, v)
+        return (length, [x/length for x in v])
+
+    sizeu, axisu = lengthAndDirection(matrix[0:3])
+    sizev, axisv = lengthAndDirection(matrix[4:7])
+    dir = lengthAndDirection(matrix[8:11])[1]
 
     lgt.addAttribute('dir', '{0} {1} {2}'.format(dir[0], dir[1], dir[2]))
     lgt.addAttribute('axisu', '{0} {1} {2}'.format(axisu[0], axisu[1], axisu[2]))
@@ -2418,7 +2623,7 @@ def writeLightSpot(light):
     coneAngle = float(cmds.getAttr(light+".coneAngle"))/2.0
     penumbraAngle = float(cmds.getAttr(light+".penumbraAngle"))
 
-    matrix = cmds.getAttr(light+".worldMatrix")
+    matrix = getWorldMatrix(light)
     position = [matrix[12],matrix[13],matrix[14]]
 
     transform = cmds.listRelatives( light, parent=True, fullPath=True )[0]
@@ -2690,7 +2895,18 @@ def writeMaterials(geoms):
         
     return writtenMaterials, materialElements
 
+def loadObjExport():
+    try:
+        if not cmds.pluginInfo( "objExport", query=True, loaded=True ):
+            cmds.loadPlugin( "objExport" )
+    except:
+        sys.stderr.write( "Failed to load objExport plugin\n" )
+        raise
+
+# Legacy OBJ geometry export
 def exportGeometry(geom, renderDir):
+    loadObjExport()
+
     geomFilename = geom.replace(':', '__').replace('|', '__')
 
     cmds.select(geom)
@@ -2700,50 +2916,224 @@ def exportGeometry(geom, renderDir):
 
     return objFilenameFullPath
 
-def exportGeometryCycles(geom, renderDir):
-    geomNodeName = geom.replace(':', '__').replace('|', '__')
+#
+# Geometry export cache
+#
+# Connectivity and UVs of deforming meshes rarely change over a sequence, so
+# the formatted text for them is kept between frames, keyed by a fingerprint
+# of the topology. Only the points are formatted again. Meshes whose points
+# haven't changed either reuse the include file written on a previous frame.
+#
+geometryCache = {}
+
+# A mesh is static when nothing in its history changes over time. The check
+# only lists the history's node types, so it's much cheaper than reading the
+# mesh, and static meshes are read once for the whole sequence.
+timeDependentHistoryTypes = ['time', 'animCurve', 'expression', 'geometryFilter',
+    'cacheFile', 'constraint', 'motionPath', 'dynBase', 'nBase']
+staticMeshes = {}
+
+def getMeshShape(geom):
+    shapes = cmds.listRelatives(geom, shapes=True, type="mesh", noIntermediate=True, fullPath=True)
+    return shapes[0] if shapes else None
+
+def isStaticMesh(shape):
+    if shape not in staticMeshes:
+        history = cmds.listHistory(shape) or []
+        staticMeshes[shape] = not cmds.ls(history, type=timeDependentHistoryTypes)
+    return staticMeshes[shape]
+
+def resetGeometryCache(removeFiles=False):
+    global geometryCache
+    global staticMeshes
+
+    if removeFiles:
+        for entry in geometryCache.values():
+            for geomFile in entry['files']:
+                try:
+                    if os.path.exists(geomFile):
+                        os.remove(geomFile)
+                except:
+                    print( "Error removing temporary file : %s" % geomFile )
+
+    geometryCache = {}
+    staticMeshes = {}
+
+def fingerprintArrays(*arrays):
+    fingerprint = hashlib.md5()
+    for values in arrays:
+        if values and isinstance(values[0], float):
+            fingerprint.update(array.array('d', values).tostring())
+        else:
+            fingerprint.update(array.array('l', values).tostring())
+        # Separate the arrays so that moving values from one to the next changes the result
+        fingerprint.update('|')
+    return fingerprint.hexdigest()
+
+def getMeshUVs(node, nverts):
+    us, vs = node.getUVs()
+    uvCounts, uvIds = node.getAssignedUVs()
+
+    uvs = []
+    uvIndex = 0
+    for faceVertexCount, uvCount in zip(nverts, uvCounts):
+        if uvCount == faceVertexCount:
+            for uvId in uvIds[uvIndex:uvIndex+uvCount]:
+                uvs.append((us[uvId], vs[uvId]))
+        else:
+            # Faces without UVs still need one entry per face vertex
+            uvs.extend([(0.0, 0.0)]*faceVertexCount)
+        uvIndex += uvCount
 
-    meshDict = createSceneElement(elementType = 'mesh')
-    meshDict.addAttribute('name', geomNodeName)
+    return uvs
 
-    node = pymel.core.PyNode(geom)
+def writeGeometryInclude(includeFileName, element):
+    geometryElement = createSceneElement(elementType='cycles')
+    geometryElement.addChild(element)
 
-    xformDict = getTransformDict(node.parent(0))
+    with open(includeFileName, 'w+') as includeFile:
+        includeFile.write("<?xml version=\'1.0\' encoding=\'utf-8\'?>\n")
+        writeElement(includeFile, geometryElement)
 
-    nverts, verts = node.getVertices()
+def exportGeometryCycles(geom, renderDir, sceneDir=None, motion=None):
+    if sceneDir is None:
+        sceneDir = renderDir
+
+    geomNodeName = geom.replace(':', '__').replace('|', '__')
 
-    points = "{0}".format(" ".join(map(lambda x: "%g %g %g" % (x.x, x.y, x.z), node.getPoints())))
-    meshDict.addAttribute('P', points )
-    nverts_str = "{0}".format(" ".join(map(lambda x: str(x), nverts)))
-    meshDict.addAttribute('nverts', nverts_str)
-    verts_str = "{0}".format(" ".join(map(lambda x: str(x), verts)))
-    meshDict.addAttribute('verts', verts_str)
+    moving = False
+    if motion and geom in motion['matrices']:
+        xformDict, moving = getMotionTransformDict(motion['matrices'][geom])
+    else:
+        xformDict = getTransformDict(geom)
 
-    uvs = list()
-    for i in range(len(nverts)):
-        for vidx in range(nverts[i]):
-            u, v = node.getPolygonUV(i, vidx)
-            uvs.append("{0} {1}".format(u, v))
+    # Static meshes reuse the include written on an earlier frame without reading the mesh
+    entry = geometryCache.get(geomNodeName)
+    shape = getMeshShape(geom)
+    if entry and entry['file'] and shape and isStaticMesh(shape) and os.path.exists(entry['file']):
+        return entry['file'], [addGeometryState(geom, xformDict, entry['file'], moving, sceneDir)]
 
-    meshDict.addAttribute('UV', " ".join(uvs))
+    node = pymel.core.PyNode(geom)
 
+    nverts, verts = node.getVertices()
+    nverts = list(nverts)
+    verts = list(verts)
+    uvs = getMeshUVs(node, nverts)
+
+    # Deforming meshes carry the points of every motion step, one block after the other
+    motionSteps = 1
+    pointSamples = motion['points'].get(geom) if motion else None
+    if pointSamples and any(p != pointSamples[0] for p in pointSamples[1:]):
+        points = [c for p in pointSamples for c in p]
+        motionSteps = len(pointSamples)
+    elif pointSamples:
+        points = pointSamples[len(pointSamples)/2]
+    else:
+        points = [c for p in node.getPoints() for c in (p.x, p.y, p.z)]
+
+    topologyKey = fingerprintArrays(nverts, verts, [c for uv in uvs for c in uv])
+    pointsKey = fingerprintArrays(points)
+
+    if not entry or entry['topology'] != topologyKey:
+        entry = {
+            'topology' : topologyKey,
+            'nverts' : " ".join(map(str, nverts)),
+            'verts' : " ".join(map(str, verts)),
+            'UV' : " ".join(["%s %s" % uv for uv in uvs]),
+            'points' : None,
+            'file' : None,
+            'files' : entry['files'] if entry else []
+        }
+        geometryCache[geomNodeName] = entry
+
+    # Meshes whose points haven't changed reuse the previous frame's include
+    if entry['points'] != pointsKey or not os.path.exists(entry['file']):
+        meshDict = createSceneElement(elementType = 'mesh')
+        meshDict.addAttribute('name', geomNodeName)
+        meshDict.addAttribute('P', " ".join(["%g %g %g" % tuple(points[i:i+3]) for i in range(0, len(points), 3)]))
+        meshDict.addAttribute('nverts', entry['nverts'])
+        meshDict.addAttribute('verts', entry['verts'])
+        meshDict.addAttribute('UV', entry['UV'])
+        if motionSteps > 1:
+            meshDict.addAttribute('use_motion_blur', 'true')
+            meshDict.addAttribute('motion_steps', str(motionSteps))
+
+        geomFile = os.path.join(renderDir, "%s_%s.xml" % (geomNodeName, pointsKey[:12]))
+        writeGeometryInclude(geomFile, meshDict)
+
+        entry['points'] = pointsKey
+        entry['file'] = geomFile
+        if geomFile not in entry['files']:
+            entry['files'].append(geomFile)
+
+    return entry['file'], [addGeometryState(geom, xformDict, entry['file'], moving, sceneDir)]
+
+def addGeometryState(geom, xformDict, geomFile, moving, sceneDir):
     stateDict = createSceneElement(elementType = 'state')
     material = getSurfaceShader(geom)
     stateDict.addAttribute('shader', "{0}_shader".format(material))
     stateDict.addAttribute('interpolation', 'smooth')
-    stateDict.addChild(meshDict)
+    if moving:
+        stateDict.addAttribute('use_motion', 'true')
+    stateDict.addChild(IncludeElement(geomFile, sceneDir))
 
     xformDict.addChild(stateDict)
+    return xformDict
 
-    #return [shaderDict, xformDict]
-    return [xformDict]
+#
+# Hair export
+#
+# Strands are read from the hair system's outputHair plug a chunk at a time and
+# written straight to an include file, so the whole groom is never held as
+# Python lists. A preview fraction below 1 keeps a deterministic subset of the
+# strands, and widens them to keep the groom's overall coverage.
+#
+hairChunkSize = 1000
+
+def keepHairStrand(index, fraction):
+    # Knuth's multiplicative hash spreads the kept strands evenly over the groom
+    return ((index * 2654435761) & 0xffffffff) < fraction * 4294967296.0
+
+def writeHairInclude(includeFileName, geomNodeName, outputHair, radius, fraction=1.0):
+    strandCount = outputHair.evaluateNumElements()
+    nverts = array.array('l')
+    pointsWritten = False
+
+    with open(includeFileName, 'w+') as includeFile:
+        includeFile.write("<?xml version=\'1.0\' encoding=\'utf-8\'?>\n")
+        includeFile.write("<cycles>\n")
+        includeFile.write("<curves name=\"%s\" radius=\"%s\" P=\"" % (geomNodeName, radius))
+
+        for chunkStart in range(0, strandCount, hairChunkSize):
+            chunk = []
+            for i in range(chunkStart, min(chunkStart + hairChunkSize, strandCount)):
+                hairPlug = outputHair.elementByPhysicalIndex(i)
+                if fraction < 1.0 and not keepHairStrand(hairPlug.logicalIndex(), fraction):
+                    continue
+
+                hair = OpenMaya.MFnVectorArrayData(hairPlug.asMObject()).array()
+                for j in range(hair.length()):
+                    pnt = hair[j]
+                    chunk.append("%g %g %g" % (pnt.x, pnt.y, pnt.z))
+                nverts.append(hair.length())
+
+            if chunk:
+                if pointsWritten:
+                    includeFile.write(" ")
+                includeFile.write(" ".join(chunk))
+                pointsWritten = True
+
+        includeFile.write("\" nverts=\"%s\" />\n" % " ".join(map(str, nverts)))
+        includeFile.write("</cycles>\n")
+
+    return len(nverts), strandCount
+
+def exportHairCycles(geom, renderDir, sceneDir=None, fraction=1.0):
+    if sceneDir is None:
+        sceneDir = renderDir
 
-def exportHairCycles(geom, renderDir):
     geomNodeName = geom.replace(':', '__').replace('|', '__')
 
-    curvesDict = createSceneElement(elementType = 'curves')
-    curvesDict.addAttribute('name', geomNodeName)
-
     shaderDict = createSceneElement(elementType = 'shader')
     shaderDict.addAttribute('name', "{0}_shader".format(geomNodeName))
 
@@ -2754,35 +3144,35 @@ def exportHairCycles(geom, renderDir):
     a = createConnectionElement("mesh_closure bsdf", "output surface")
     shaderDict.addChild(a)
 
-    node = pymel.core.PyNode(geom)
-    hairs = node.getAttr("outputHair")
+    hairSystem = cmds.listRelatives(geom, shapes=True, type="hairSystem", fullPath=True)[0]
+    outputHair = OpenMaya.MFnDependencyNode(getDagPath(hairSystem).node()).findPlug("outputHair")
 
-    radius = node.getAttr("hairWidth")
-    curvesDict.addAttribute('radius', str(radius))
+    fraction = min(max(fraction, 0.0), 1.0)
+    radius = cmds.getAttr(hairSystem + ".hairWidth")
+    if 0.0 < fraction < 1.0:
+        radius /= fraction
 
-    xformDict = getTransformDict(node.parent(0), ident_mtx)
+    # The include is rewritten every frame and removed along with the cached mesh geometry
+    hairFile = os.path.join(renderDir, "%s_hair.xml" % geomNodeName)
+    written, strandCount = writeHairInclude(hairFile, geomNodeName, outputHair, radius, fraction)
+    if fraction < 1.0:
+        print( "\thair preview : %d of %d strands" % (written, strandCount) )
 
-    points = list()
-    nverts = list()
-    for hair in hairs:
-        for pnt in hair:
-            points.append((pnt[0], pnt[1], pnt[2]))
-        nverts.append(len(hair))
+    entry = geometryCache.setdefault(geomNodeName, {'files' : []})
+    if hairFile not in entry['files']:
+        entry['files'].append(hairFile)
 
-    points = "{0}".format(" ".join(map(lambda w: "%g %g %g" % (w[0], w[1], w[2]), points)))
-    curvesDict.addAttribute('P', points )
-    nverts_str = "{0}".format(" ".join(map(lambda x: str(x), nverts)))
-    curvesDict.addAttribute('nverts', nverts_str)
+    xformDict = getTransformDict(geom, flip=False)
 
     stateDict = createSceneElement(elementType = 'state')
     stateDict.addAttribute('shader', "{0}_shader".format(geomNodeName))
     stateDict.addAttribute('interpolation', 'smooth')
     stateDict.addAttribute('curve_primitive', 'segments')
-    stateDict.addChild(curvesDict)
+    stateDict.addChild(IncludeElement(hairFile, sceneDir))
 
     xformDict.addChild(stateDict)
 
-    return [shaderDict, xformDict]
+    return hairFile, [shaderDict, xformDict]
 
 def writeShape(geomFilename, surfaceShader, mediumShader, renderDir):
     shapeDict = ShapeElement('obj')
@@ -2819,8 +3209,9 @@ def writeShape(geomFilename, surfaceShader, mediumShader, renderDir):
     return shapeDict
 
 
-def writeGeometryAndMaterials(renderDir):
-    geoms = getRenderableGeometry()
+def writeGeometryAndMaterials(renderDir, sceneDir=None, geoms=None, motion=None, hairFraction=1.0):
+    if geoms is None:
+        geoms = getRenderableGeometry()
 
     writtenMaterials, materialElements = writeMaterials(geoms)
 
@@ -2840,7 +3231,8 @@ def writeGeometryAndMaterials(renderDir):
                 print( "\tsurface : %s" % surfaceShader )
                 print( "\tvolume  : %s" % volumeShader )
 
-                meshDicts = exportGeometryCycles(geom, renderDir)
+                geomFile, meshDicts = exportGeometryCycles(geom, renderDir, sceneDir, motion)
+                geoFiles.append(geomFile)
                 shapeElements.extend(meshDicts)
 
                 #geomFilename = exportGeometry(geom, renderDir)
@@ -2849,12 +3241,13 @@ def writeGeometryAndMaterials(renderDir):
                 #shapeElement = writeShape(geomFilename, surfaceShader, volumeShader, renderDir)
                 #shapeElements.append(shapeElement)
             elif nt=="hairSystem":
-                curveDicts = exportHairCycles(geom, renderDir)
+                hairFile, curveDicts = exportHairCycles(geom, renderDir, sceneDir, hairFraction)
+                geoFiles.append(hairFile)
                 shapeElements.extend(curveDicts)
 
     return (geoFiles, shapeElements, materialElements)
 
-def writeScene(outFileName, renderDir, renderSettings):
+def createScene(renderDir, renderSettings, sceneDir, texturePrefetcher=None):
     #
     # Generate scene element hierarchy
     #
@@ -2867,9 +3260,38 @@ def writeScene(outFileName, renderDir, renderSettings):
     # integratorElement = writeIntegrator(renderSettings)
     # sceneElement.addChild( integratorElement)
 
+    currentTime = cmds.currentTime(query=True)
+    frameNumber = int(currentTime)
+    rCamShape = getRenderableCamera()
+    camTransform = cmds.listRelatives(rCamShape, parent=True, fullPath=True)[0]
+    geoms = getRenderableGeometry()
+
+    # Read the world matrices of the camera, geometry and lights in one pass
+    lights = cmds.ls(type="light", long=True)
+    buildTransformTable([camTransform] + geoms + lights)
+
+    # Sample the camera and geometry over the shutter interval
+    motion = None
+    motionSettings = getMotionSettings(renderSettings)
+    if motionSettings:
+        (steps, shutter) = motionSettings
+        times = getMotionSampleTimes(currentTime, steps, shutter)
+
+        meshes = getDeformableMeshes(geoms)
+        transforms = [camTransform]
+        for geom in geoms:
+            if cmds.listRelatives(geom, shapes=True, type="mesh", fullPath=True) and geom not in transforms:
+                transforms.append(geom)
+
+        print( "Motion blur - %d steps over %s frames, %d transforms, %d deforming meshes" % (steps, shutter, len(transforms), len(meshes)) )
+        motion = sampleSceneMotion(times, transforms, meshes)
+
+        integratorDict = createSceneElement(elementType = 'integrator')
+        integratorDict.addAttribute('motion_blur', 'true')
+        sceneElement.addChild( integratorDict )
+
     # Get sensor : camera, sampler, and film
-    frameNumber = int(cmds.currentTime(query=True))
-    sensorElement = writeSensorCycles(frameNumber, renderSettings)
+    sensorElement = writeSensorCycles(frameNumber, renderSettings, rCamShape, motion)
     sceneElement.addChild( sensorElement)
 
     # Get lights
@@ -2878,7 +3300,8 @@ def writeScene(outFileName, renderDir, renderSettings):
         sceneElement.addChildren( lightElements )
 
     # Get geom and material assignments
-    (exportedGeometryFiles, shapeElements, materialElements) = writeGeometryAndMaterials(renderDir)
+    hairFraction = cmds.getAttr("%s.%s" % (renderSettings, "hairPreviewFraction"))
+    (exportedGeometryFiles, shapeElements, materialElements) = writeGeometryAndMaterials(renderDir, sceneDir, geoms, motion, hairFraction)
     if materialElements:
         sceneElement.addChildren( materialElements )
 
@@ -2888,6 +3311,50 @@ def writeScene(outFileName, renderDir, renderSettings):
     bgDict = writeBackgroundCycles()
     sceneElement.addChild(bgDict)
 
+    textureCacheDir = cmds.getAttr("%s.%s" % (renderSettings, "textureCacheDir"))
+    if not textureCacheDir:
+        textureCacheDir = os.path.join(cmds.internalVar(userAppDir=True), "CyclesForMaya", "textureCache")
+
+    textureConversion = cmds.getAttr("%s.%s" % (renderSettings, "textureConversion"))
+
+    # Draft renders use downscaled proxies for the textures whose proxies are ready
+    textureQuality = cmds.getAttr("%s.%s" % (renderSettings, "textureQuality"))
+    textureScale = CyclesTextureCache.textureQualityScales.get(textureQuality, 1)
+    if textureScale > 1:
+        oiiotoolPath = cmds.getAttr("%s.%s" % (renderSettings, "oiiotoolPath"))
+        textureProxyBudget = cmds.getAttr("%s.%s" % (renderSettings, "textureProxyBudget"))
+
+        if oiiotoolPath:
+            CyclesTextureCache.proxySceneTextures(sceneElement, oiiotoolPath, textureCacheDir, textureScale,
+                textureConversion, textureProxyBudget)
+        else:
+            print( "Draft texture proxies need oiiotoolPath to be set" )
+
+    # Point the scene at tiled, mipmapped versions of its textures
+    if textureConversion:
+        converterPath = cmds.getAttr("%s.%s" % (renderSettings, "maketxPath"))
+        if not converterPath:
+            converterPath = cmds.getAttr("%s.%s" % (renderSettings, "oiiotoolPath"))
+
+        textureConversionWorkers = cmds.getAttr("%s.%s" % (renderSettings, "textureConversionWorkers"))
+
+        if converterPath:
+            print( "Texture cache - Converter : %s" % converterPath )
+            print( "Texture cache - Directory : %s" % textureCacheDir )
+            CyclesTextureCache.prepareSceneTextures(sceneElement, converterPath, textureCacheDir, textureConversionWorkers)
+        else:
+            print( "Texture conversion needs either maketxPath or oiiotoolPath to be set" )
+
+    # Use the local copies of textures prefetched while the previous frame rendered
+    if texturePrefetcher:
+        texturePrefetcher.remapSceneTextures(sceneElement)
+
+    return (exportedGeometryFiles, sceneElement)
+
+def writeScene(outFileName, renderDir, renderSettings, texturePrefetcher=None):
+    sceneDir = os.path.dirname(outFileName)
+    (exportedGeometryFiles, sceneElement) = createScene(renderDir, renderSettings, sceneDir, texturePrefetcher)
+
     #
     # Write the structure to disk
     #
@@ -2900,3 +3367,23 @@ def writeScene(outFileName, renderDir, renderSettings):
 
     return exportedGeometryFiles
 
+#
+# Piped scene description
+#
+# Cycles can read the scene description from its standard input instead of a
+# file. Includes are still read from disk, relative to the directory of the
+# scene file name Cycles is given, which is /dev for /dev/stdin.
+#
+pipedSceneFileName = "/dev/stdin"
+
+def canPipeScene():
+    return os.path.exists(pipedSceneFileName)
+
+def writeSceneText(renderDir, renderSettings, texturePrefetcher=None):
+    sceneDir = os.path.dirname(pipedSceneFileName)
+    (exportedGeometryFiles, sceneElement) = createScene(renderDir, renderSettings, sceneDir, texturePrefetcher)
+
+    sceneText = "<?xml version=\'1.0\' encoding=\'utf-8\'?>\n" + writeElementText(sceneElement)
+
+    return (exportedGeometryFiles, sceneText)
+
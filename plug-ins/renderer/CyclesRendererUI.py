@@ -4,6 +4,7 @@ import os
 import re
 import struct
 import sys
+import time
 
 import maya.cmds as cmds
 import maya.mel as mel
@@ -562,64 +563,22 @@ def createIntegratorFrames():
     #Make the integrator specific settings
     global integratorFrames
 
-    integratorFrames = []
-
-    # Ambient Occlusion Settings
-    aoSettings = createIntegratorFrameAmbientOcclusion()
-
-    # Direct Illumination Settings
-    diSettings = createIntegratorFrameDirectIllumination()
-
-    # Path Tracer settings
-    pSettings = createIntegratorFramePathTracer()
-
-    # Simple Volumetric Path Tracer settings
-    vpsSettings = createIntegratorFrameSimpleVolumetricPathTracer()
-
-    # Volumetric Path Tracer settings
-    vpSettings = createIntegratorFrameVolumetricPathTracer()
-
-    # Bidirection Path Tracer Settings
-    bdptSettings = createIntegratorFrameBidirectionalPathTracer()
-
-    # Photon Map Settings
-    pmSettings = createIntegratorFramePhotonMap()
-
-    # Progressive Photon Map Settings
-    ppmSettings = createIntegratorFrameProgressivePhotonMap()
-
-    # Stochastic Progressive Photon Map Settings
-    sppmSettings = createIntegratorFrameStochasticProgressivePhotonMap()
-
-    # Primary Sample Space Metropolis Light Transport Settings
-    pssmltSettings = createIntegratorFramePrimarySampleSpaceMetropolisLightTransport()
-
-    # Path Space Metropolis Light Transport Settings
-    mltSettings = createIntegratorFramePathSpaceMetropolisLightTransport()
-
-    # Energy Redistribution Path Tracing Settings
-    erptSettings = createIntegratorFrameEnergyRedistributionPathTracing()
-
-    # Adjoint Particle Tracer Settings
-    ptrSettings = createIntegratorFrameAdjointParticleTracer()
-
-    # Virtual Point Lights Settings
-    vplSettings = createIntegratorFrameVirtualPointLights()
-
-    integratorFrames.append(aoSettings)
-    integratorFrames.append(diSettings)
-    integratorFrames.append(pSettings)
-    integratorFrames.append(vpsSettings)
-    integratorFrames.append(vpSettings)
-    integratorFrames.append(bdptSettings)
-    integratorFrames.append(pmSettings)
-    integratorFrames.append(ppmSettings)
-    integratorFrames.append(sppmSettings)
-    integratorFrames.append(pssmltSettings)
-    integratorFrames.append(mltSettings)
-    integratorFrames.append(erptSettings)
-    integratorFrames.append(ptrSettings)
-    integratorFrames.append(vplSettings)
+    integratorFrames = createLazyFrames({
+        "Ambient Occlusion" : createIntegratorFrameAmbientOcclusion,
+        "Direct Illumination" : createIntegratorFrameDirectIllumination,
+        "Path Tracer" : createIntegratorFramePathTracer,
+        "Simple Volumetric Path Tracer" : createIntegratorFrameSimpleVolumetricPathTracer,
+        "Volumetric Path Tracer" : createIntegratorFrameVolumetricPathTracer,
+        "Bidirectional Path Tracer" : createIntegratorFrameBidirectionalPathTracer,
+        "Photon Map" : createIntegratorFramePhotonMap,
+        "Progressive Photon Map" : createIntegratorFrameProgressivePhotonMap,
+        "Stochastic Progressive Photon Map" : createIntegratorFrameStochasticProgressivePhotonMap,
+        "Primary Sample Space Metropolis Light Transport" : createIntegratorFramePrimarySampleSpaceMetropolisLightTransport,
+        "Path Space Metropolis Light Transport" : createIntegratorFramePathSpaceMetropolisLightTransport,
+        "Energy Redistribution Path Tracer" : createIntegratorFrameEnergyRedistributionPathTracing,
+        "Adjoint Particle Tracer" : createIntegratorFrameAdjointParticleTracer,
+        "Virtual Point Lights" : createIntegratorFrameVirtualPointLights
+    })
 
 def createMetaIntegratorFramesAdaptive():
     miAdaptiveMaxError = cmds.getAttr("%s.%s" % (renderSettings, "miAdaptiveMaxError"))
@@ -689,16 +648,11 @@ def createMetaIntegratorFramesIrradianceCache():
 def createMetaIntegratorFrames():
     #Make the integrator specific settings
     global metaIntegratorFrames
-    metaIntegratorFrames = []
-
-    # Adaptive Settings
-    adaptiveSettings = createMetaIntegratorFramesAdaptive()
 
-    # Irradiance Cache Settings
-    irracheSettings = createMetaIntegratorFramesIrradianceCache()
-
-    metaIntegratorFrames.append(adaptiveSettings)
-    metaIntegratorFrames.append(irracheSettings)
+    metaIntegratorFrames = createLazyFrames({
+        "Adaptive" : createMetaIntegratorFramesAdaptive,
+        "Irradiance Cache" : createMetaIntegratorFramesIrradianceCache
+    })
 
 def changeMenu(menu, attribute, renderSettings, value):
     #selected = cmds.optionMenu(menu, query=True, value=True)
@@ -912,81 +866,70 @@ def createFilmFramesMath(renderSettings):
 
 def createFilmFrames(renderSettings):
     global filmFrames
-    filmFrames = []
 
-    # HDR Settings
-    hdrSettings = createFilmFramesHDR(renderSettings)
+    filmFrames = createLazyFrames({
+        "HDR Film" : lambda: createFilmFramesHDR(renderSettings),
+        "HDR Film - Tiled" : lambda: createFilmFramesHDRTiled(renderSettings),
+        "LDR Film" : lambda: createFilmFramesLDR(renderSettings),
+        "Math Film" : lambda: createFilmFramesMath(renderSettings)
+    })
 
-    # HDR Tiled Settings
-    hdrTiledSettings = createFilmFramesHDRTiled(renderSettings)
 
-    # LDR Settings
-    ldrSettings = createFilmFramesLDR(renderSettings)
+def createSamplerFrame(label, fieldLabel=None, attribute=None):
+    samplerSettings = cmds.frameLayout(label=label, cll=(attribute is not None), visible=False)
 
-    # Math Settings
-    mathSettings = createFilmFramesMath(renderSettings)
+    if attribute:
+        existingValue = cmds.getAttr( "%s.%s" % (renderSettings, attribute))
+        cmds.intFieldGrp(numberOfFields=1, label=fieldLabel, value1=existingValue,
+            changeCommand=lambda (x): getIntFieldGroup(None, attribute, x))
 
-    filmFrames.append(hdrSettings)
-    filmFrames.append(hdrTiledSettings)
-    filmFrames.append(ldrSettings)
-    filmFrames.append(mathSettings)
+    cmds.setParent('..')
 
+    return samplerSettings
 
 def createSamplerFrames():
     global samplerFrames
 
-    samplerFrames = []
-
-    existingSampleCount = cmds.getAttr( "%s.%s" % (renderSettings, "sampleCount"))
-    existingSamplerDimension = cmds.getAttr( "%s.%s" % (renderSettings, "samplerDimension"))
-    existingSamplerScramble = cmds.getAttr( "%s.%s" % (renderSettings, "samplerScramble"))
-
-    changeSampleCount = lambda (x): getIntFieldGroup(None, "sampleCount", x)
-    changeSamplerDimension = lambda (x): getIntFieldGroup(None, "samplerDimension", x)
-    changeSamplerScramble = lambda (x): getIntFieldGroup(None, "samplerScramble", x)
-
-    indSettings = cmds.frameLayout(label="Independent Sampler", cll=False, visible=True)
-    cmds.setParent('..')
-
-    stratSettings = cmds.frameLayout(label="Stratified Sampler", cll=True, visible=False)
-    stratSamplerDimension = cmds.intFieldGrp(numberOfFields=1, label="dimension", value1=existingSamplerDimension)
-    cmds.intFieldGrp(stratSamplerDimension, edit=1, changeCommand=changeSamplerDimension)    
-    cmds.setParent('..')
-
-    ldSettings = cmds.frameLayout(label="Low Discrepancy Sampler", cll=True, visible=False)
-    ldSamplerDimension = cmds.intFieldGrp(numberOfFields=1, label="dimension", value1=existingSamplerDimension)
-    cmds.intFieldGrp(ldSamplerDimension, edit=1, changeCommand=changeSamplerDimension)    
-    cmds.setParent('..')
+    samplerFrames = createLazyFrames({
+        "Independent Sampler" : lambda: createSamplerFrame("Independent Sampler"),
+        "Stratified Sampler" : lambda: createSamplerFrame("Stratified Sampler", "dimension", "samplerDimension"),
+        "Low Discrepancy Sampler" : lambda: createSamplerFrame("Low Discrepancy Sampler", "dimension", "samplerDimension"),
+        "Halton QMC Sampler" : lambda: createSamplerFrame("Halton QMC Sampler", "scramble", "samplerScramble"),
+        "Hammersley QMC Sampler" : lambda: createSamplerFrame("Hammersley QMC Sampler", "scramble", "samplerScramble"),
+        "Sobol QMC Sampler" : lambda: createSamplerFrame("Sobol QMC Sampler", "scramble", "samplerScramble")
+    })
 
-    halSettings = cmds.frameLayout(label="Halton QMC Sampler", cll=True, visible=False)
-    halSamplerScramble = cmds.intFieldGrp(numberOfFields=1, label="scramble", value1=existingSamplerScramble)
-    cmds.intFieldGrp(halSamplerScramble, edit=1, changeCommand=changeSamplerScramble)    
-    cmds.setParent('..')
+def createSensorOverrideFrames():
+    global sensorOverrideFrames
 
-    hamSettings = cmds.frameLayout(label="Hammersley QMC Sampler", cll=True, visible=False)
-    hamSamplerScramble = cmds.intFieldGrp(numberOfFields=1, label="scramble", value1=existingSamplerScramble)
-    cmds.intFieldGrp(hamSamplerScramble, edit=1, changeCommand=changeSamplerScramble)    
-    cmds.setParent('..')
+    sensorOverrideFrames = createLazyFrames({
+        "Perspective Pinhole Camera with Radial Distortion" : createSensorFramePerspectiveRdist
+    })
 
-    sobSettings = cmds.frameLayout(label="Sobol QMC Sampler", cll=True, visible=False)
-    sobSamplerScramble = cmds.intFieldGrp(numberOfFields=1, label="scramble", value1=existingSamplerScramble)
-    cmds.intFieldGrp(sobSamplerScramble, edit=1, changeCommand=changeSamplerScramble)    
+'''
+Only one variant of each group of settings is visible at a time, so each
+variant's frame, and the controls bound to its attributes, are only built the
+first time it's selected. The frames are kept in a layout created where the
+variants are listed, so they show up in the same place whenever they're built.
+'''
+def createLazyFrames(frameCreators):
+    frameParent = cmds.columnLayout(adjustableColumn=True)
     cmds.setParent('..')
 
-    samplerFrames.append(indSettings)
-    samplerFrames.append(stratSettings)
-    samplerFrames.append(ldSettings)
-    samplerFrames.append(halSettings)
-    samplerFrames.append(hamSettings)
-    samplerFrames.append(sobSettings)
+    return {'parent' : frameParent, 'creators' : frameCreators, 'frames' : {}}
 
-def createSensorOverrideFrames():
-    global sensorOverrideFrames
-    sensorOverrideFrames = []
+def showLazyFrame(lazyFrames, selected):
+    # Option menu values may have underscores in place of spaces
+    selected = selected.replace("_", " ")
 
-    perspectiveRdistSettings = createSensorFramePerspectiveRdist()
+    if selected in lazyFrames['creators'] and selected not in lazyFrames['frames']:
+        currentParent = cmds.setParent(query=True)
+        cmds.setParent(lazyFrames['parent'])
+        lazyFrames['frames'][selected] = lazyFrames['creators'][selected]()
+        cmds.setParent(currentParent)
 
-    sensorOverrideFrames.append(perspectiveRdistSettings)
+    for (label, frame) in lazyFrames['frames'].iteritems():
+        cmds.frameLayout(frame, edit=True, visible=(label == selected))
 
 def getRenderSettingsPath(name, renderSettingsAttribute=None):
     global renderSettings
@@ -1054,6 +997,7 @@ def createRenderSettingsUI():
     global sensorOverrideMenu
 
     print( "\n\n\nCycles Render Settings - Create UI - Python\n\n\n" )
+    createStart = time.time()
 
     parentForm = cmds.setParent(query=True)
 
@@ -1303,6 +1247,88 @@ def createRenderSettingsUI():
     cmds.setParent('..')
     cmds.setParent('..')
 
+    # Motion blur controls
+    cmds.frameLayout(label='Motion Blur', collapsable=True, collapse=True)
+    cmds.columnLayout(adjustableColumn=True)
+
+    motionBlur = cmds.getAttr( "%s.%s" % (renderSettings, "motionBlur"))
+    cmds.checkBox(label="Motion Blur", value=motionBlur,
+        changeCommand=lambda (x): getCheckBox(None, "motionBlur", x))
+
+    motionBlurSteps = cmds.getAttr( "%s.%s" % (renderSettings, "motionBlurSteps"))
+    cmds.intFieldGrp(numberOfFields=1, label="Motion Steps", value1=motionBlurSteps,
+        changeCommand=lambda (x): getIntFieldGroup(None, "motionBlurSteps", x))
+
+    motionBlurShutter = cmds.getAttr( "%s.%s" % (renderSettings, "motionBlurShutter"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Shutter (frames)", value1=motionBlurShutter,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "motionBlurShutter", x))
+
+    cmds.setParent('..')
+    cmds.setParent('..')
+
+    # Hair controls
+    cmds.frameLayout(label='Hair', collapsable=True, collapse=True)
+    cmds.columnLayout(adjustableColumn=True)
+
+    hairPreviewFraction = cmds.getAttr( "%s.%s" % (renderSettings, "hairPreviewFraction"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Preview Strand Fraction", value1=hairPreviewFraction,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "hairPreviewFraction", x))
+
+    cmds.setParent('..')
+    cmds.setParent('..')
+
+    # Texture conversion controls
+    cmds.frameLayout(label='Textures', collapsable=True, collapse=True)
+    cmds.columnLayout(adjustableColumn=True)
+
+    textureConversion = cmds.getAttr( "%s.%s" % (renderSettings, "textureConversion"))
+    cmds.checkBox(label="Convert to tiled, mipmapped textures", value=textureConversion,
+        changeCommand=lambda (x): getCheckBox(None, "textureConversion", x))
+
+    maketxPathGroup = cmds.textFieldButtonGrp(label="maketx Path", 
+        buttonLabel="Open", buttonCommand="browseFiles")
+    existingMaketxPath = cmds.getAttr( "%s.%s" % (renderSettings, "maketxPath"))
+    if existingMaketxPath not in ["", None]:
+        cmds.textFieldButtonGrp(maketxPathGroup, e=1, text=existingMaketxPath)
+    cmds.textFieldButtonGrp(maketxPathGroup, e=1, 
+        buttonCommand=lambda: getRenderSettingsPath(maketxPathGroup, "maketxPath"))
+
+    textureCacheDir = cmds.getAttr( "%s.%s" % (renderSettings, "textureCacheDir"))
+    cmds.textFieldGrp(label="Cache Directory", text=textureCacheDir if textureCacheDir else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "textureCacheDir", x))
+
+    textureConversionWorkers = cmds.getAttr( "%s.%s" % (renderSettings, "textureConversionWorkers"))
+    cmds.intFieldGrp(numberOfFields=1, label="Conversion Workers", value1=textureConversionWorkers,
+        changeCommand=lambda (x): getIntFieldGroup(None, "textureConversionWorkers", x))
+
+    existingTextureQuality = cmds.getAttr( "%s.%s" % (renderSettings, "textureQuality"))
+    textureQualityMenu = cmds.optionMenu(label="Texture Quality", 
+        changeCommand=lambda (x): getOptionMenu(None, "textureQuality", x))
+    cmds.menuItem("Full resolution")
+    cmds.menuItem("Draft 1/2")
+    cmds.menuItem("Draft 1/4")
+    cmds.menuItem("Draft 1/8")
+
+    if existingTextureQuality not in ["", None]:
+        cmds.optionMenu(textureQualityMenu, edit=True, value=existingTextureQuality)
+    else:
+        cmds.optionMenu(textureQualityMenu, edit=True, select=1)
+
+    textureProxyBudget = cmds.getAttr( "%s.%s" % (renderSettings, "textureProxyBudget"))
+    cmds.intFieldGrp(numberOfFields=1, label="Proxy Budget (MB)", value1=textureProxyBudget,
+        changeCommand=lambda (x): getIntFieldGroup(None, "textureProxyBudget", x))
+
+    texturePrefetchFrames = cmds.getAttr( "%s.%s" % (renderSettings, "texturePrefetchFrames"))
+    cmds.intFieldGrp(numberOfFields=1, label="Prefetch Frames", value1=texturePrefetchFrames,
+        changeCommand=lambda (x): getIntFieldGroup(None, "texturePrefetchFrames", x))
+
+    texturePrefetchScratchDir = cmds.getAttr( "%s.%s" % (renderSettings, "texturePrefetchScratchDir"))
+    cmds.textFieldGrp(label="Prefetch Scratch Directory", text=texturePrefetchScratchDir if texturePrefetchScratchDir else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "texturePrefetchScratchDir", x))
+
+    cmds.setParent('..')
+    cmds.setParent('..')
+
     # Overall controls
     cmds.frameLayout(label='Overall', collapsable=True, collapse=False)
     cmds.columnLayout(adjustableColumn=True)
@@ -1337,6 +1363,148 @@ def createRenderSettingsUI():
     blockSizeGroup = cmds.intFieldGrp(numberOfFields=1, label="Block size", value1=existingBlockSize)
     cmds.intFieldGrp(blockSizeGroup, edit=1, changeCommand=changeBlockSize)    
 
+    existingResumeSequence = cmds.getAttr( "%s.%s" % (renderSettings, "resumeSequence"))
+    cmds.checkBox(label="Resume interrupted sequences", value=existingResumeSequence,
+        changeCommand=lambda (x): getCheckBox(None, "resumeSequence", x))
+
+    existingPipeSceneDescription = cmds.getAttr( "%s.%s" % (renderSettings, "pipeSceneDescription"))
+    cmds.checkBox(label="Pipe scene description to Cycles", value=existingPipeSceneDescription,
+        changeCommand=lambda (x): getCheckBox(None, "pipeSceneDescription", x))
+
+    existingStagingDir = cmds.getAttr( "%s.%s" % (renderSettings, "stagingDir"))
+    cmds.textFieldGrp(label="Staging Directory", text=existingStagingDir if existingStagingDir else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "stagingDir", x))
+
+    existingRenderNoOutputTimeout = cmds.getAttr( "%s.%s" % (renderSettings, "renderNoOutputTimeout"))
+    cmds.intFieldGrp(numberOfFields=1, label="No output timeout", value1=existingRenderNoOutputTimeout,
+        changeCommand=lambda (x): getIntFieldGroup(None, "renderNoOutputTimeout", x))
+
+    existingRenderNoProgressTimeout = cmds.getAttr( "%s.%s" % (renderSettings, "renderNoProgressTimeout"))
+    cmds.intFieldGrp(numberOfFields=1, label="No progress timeout", value1=existingRenderNoProgressTimeout,
+        changeCommand=lambda (x): getIntFieldGroup(None, "renderNoProgressTimeout", x))
+
+    existingRenderTimeout = cmds.getAttr( "%s.%s" % (renderSettings, "renderTimeout"))
+    cmds.intFieldGrp(numberOfFields=1, label="Render timeout", value1=existingRenderTimeout,
+        changeCommand=lambda (x): getIntFieldGroup(None, "renderTimeout", x))
+
+    existingRenderRetries = cmds.getAttr( "%s.%s" % (renderSettings, "renderRetries"))
+    cmds.intFieldGrp(numberOfFields=1, label="Render retries", value1=existingRenderRetries,
+        changeCommand=lambda (x): getIntFieldGroup(None, "renderRetries", x))
+
+    existingRenderRetryDelay = cmds.getAttr( "%s.%s" % (renderSettings, "renderRetryDelay"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Retry delay", value1=existingRenderRetryDelay,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "renderRetryDelay", x))
+
+    mayapyPathGroup = cmds.textFieldButtonGrp(label="mayapy Path", 
+        buttonLabel="Open", buttonCommand="browseFiles")
+    existingMayapyPath = cmds.getAttr( "%s.%s" % (renderSettings, "mayapyPath"))
+    if existingMayapyPath not in ["", None]:
+        cmds.textFieldButtonGrp(mayapyPathGroup, e=1, text=existingMayapyPath)
+    cmds.textFieldButtonGrp(mayapyPathGroup, e=1, 
+        buttonCommand=lambda: getRenderSettingsPath(mayapyPathGroup, "mayapyPath"))
+
+    existingBatchChunkSize = cmds.getAttr( "%s.%s" % (renderSettings, "batchChunkSize"))
+    cmds.intFieldGrp(numberOfFields=1, label="Batch chunk size", value1=existingBatchChunkSize,
+        changeCommand=lambda (x): getIntFieldGroup(None, "batchChunkSize", x))
+
+    existingBatchWorkers = cmds.getAttr( "%s.%s" % (renderSettings, "batchWorkers"))
+    cmds.intFieldGrp(numberOfFields=1, label="Batch workers", value1=existingBatchWorkers,
+        changeCommand=lambda (x): getIntFieldGroup(None, "batchWorkers", x))
+
+    existingRenderQueueDir = cmds.getAttr( "%s.%s" % (renderSettings, "renderQueueDir"))
+    cmds.textFieldGrp(label="Render Queue Directory", text=existingRenderQueueDir if existingRenderQueueDir else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "renderQueueDir", x))
+
+    existingRenderQueueLocalAgents = cmds.getAttr( "%s.%s" % (renderSettings, "renderQueueLocalAgents"))
+    cmds.intFieldGrp(numberOfFields=1, label="Render queue local agents", value1=existingRenderQueueLocalAgents,
+        changeCommand=lambda (x): getIntFieldGroup(None, "renderQueueLocalAgents", x))
+
+    existingSamplePasses = cmds.getAttr( "%s.%s" % (renderSettings, "samplePasses"))
+    cmds.intFieldGrp(numberOfFields=1, label="Sample passes", value1=existingSamplePasses,
+        changeCommand=lambda (x): getIntFieldGroup(None, "samplePasses", x))
+
+    existingRenderTimeBudget = cmds.getAttr( "%s.%s" % (renderSettings, "renderTimeBudget"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Time budget", value1=existingRenderTimeBudget,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "renderTimeBudget", x))
+
+    existingTimeBudgetMinSamples = cmds.getAttr( "%s.%s" % (renderSettings, "timeBudgetMinSamples"))
+    cmds.intFieldGrp(numberOfFields=1, label="Budget min samples", value1=existingTimeBudgetMinSamples,
+        changeCommand=lambda (x): getIntFieldGroup(None, "timeBudgetMinSamples", x))
+
+    existingTimeBudgetMaxSamples = cmds.getAttr( "%s.%s" % (renderSettings, "timeBudgetMaxSamples"))
+    cmds.intFieldGrp(numberOfFields=1, label="Budget max samples", value1=existingTimeBudgetMaxSamples,
+        changeCommand=lambda (x): getIntFieldGroup(None, "timeBudgetMaxSamples", x))
+
+    existingTimeBudgetPilotSamples = cmds.getAttr( "%s.%s" % (renderSettings, "timeBudgetPilotSamples"))
+    cmds.intFieldGrp(numberOfFields=1, label="Pilot samples", value1=existingTimeBudgetPilotSamples,
+        changeCommand=lambda (x): getIntFieldGroup(None, "timeBudgetPilotSamples", x))
+
+    existingTimeBudgetCacheDir = cmds.getAttr( "%s.%s" % (renderSettings, "timeBudgetCacheDir"))
+    cmds.textFieldGrp(label="Time Budget Cache Directory", text=existingTimeBudgetCacheDir if existingTimeBudgetCacheDir else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "timeBudgetCacheDir", x))
+
+    existingConvergenceNoise = cmds.getAttr( "%s.%s" % (renderSettings, "convergenceNoise"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Convergence noise", value1=existingConvergenceNoise,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "convergenceNoise", x))
+
+    existingConvergenceFraction = cmds.getAttr( "%s.%s" % (renderSettings, "convergenceFraction"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Converged fraction", value1=existingConvergenceFraction,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "convergenceFraction", x))
+
+    existingConvergenceMinSamples = cmds.getAttr( "%s.%s" % (renderSettings, "convergenceMinSamples"))
+    cmds.intFieldGrp(numberOfFields=1, label="Convergence min samples", value1=existingConvergenceMinSamples,
+        changeCommand=lambda (x): getIntFieldGroup(None, "convergenceMinSamples", x))
+
+    existingConvergenceMaxSamples = cmds.getAttr( "%s.%s" % (renderSettings, "convergenceMaxSamples"))
+    cmds.intFieldGrp(numberOfFields=1, label="Convergence max samples", value1=existingConvergenceMaxSamples,
+        changeCommand=lambda (x): getIntFieldGroup(None, "convergenceMaxSamples", x))
+
+    existingConvergenceIncrement = cmds.getAttr( "%s.%s" % (renderSettings, "convergenceIncrement"))
+    cmds.intFieldGrp(numberOfFields=1, label="Convergence increment", value1=existingConvergenceIncrement,
+        changeCommand=lambda (x): getIntFieldGroup(None, "convergenceIncrement", x))
+
+    existingDenoise = cmds.getAttr( "%s.%s" % (renderSettings, "denoise"))
+    cmds.checkBox(label="Denoise", value=existingDenoise,
+        changeCommand=lambda (x): getCheckBox(None, "denoise", x))
+
+    denoiserPathGroup = cmds.textFieldButtonGrp(label="Denoiser Path", 
+        buttonLabel="Open", buttonCommand="browseFiles")
+    existingDenoiserPath = cmds.getAttr( "%s.%s" % (renderSettings, "denoiserPath"))
+    if existingDenoiserPath not in ["", None]:
+        cmds.textFieldButtonGrp(denoiserPathGroup, e=1, text=existingDenoiserPath)
+    cmds.textFieldButtonGrp(denoiserPathGroup, e=1, 
+        buttonCommand=lambda: getRenderSettingsPath(denoiserPathGroup, "denoiserPath"))
+
+    existingDenoiserArgs = cmds.getAttr( "%s.%s" % (renderSettings, "denoiserArgs"))
+    cmds.textFieldGrp(label="Denoiser Arguments", text=existingDenoiserArgs if existingDenoiserArgs else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "denoiserArgs", x))
+
+    existingDenoiseKeepNoisy = cmds.getAttr( "%s.%s" % (renderSettings, "denoiseKeepNoisy"))
+    cmds.checkBox(label="Keep noisy images", value=existingDenoiseKeepNoisy,
+        changeCommand=lambda (x): getCheckBox(None, "denoiseKeepNoisy", x))
+
+    existingSwatchCacheDir = cmds.getAttr( "%s.%s" % (renderSettings, "swatchCacheDir"))
+    cmds.textFieldGrp(label="Swatch Cache Directory", text=existingSwatchCacheDir if existingSwatchCacheDir else "",
+        changeCommand=lambda (x): getTextFieldGroup(None, "swatchCacheDir", x))
+
+    existingSwatchSize = cmds.getAttr( "%s.%s" % (renderSettings, "swatchSize"))
+    cmds.intFieldGrp(numberOfFields=1, label="Swatch size", value1=existingSwatchSize,
+        changeCommand=lambda (x): getIntFieldGroup(None, "swatchSize", x))
+
+    existingSwatchSamples = cmds.getAttr( "%s.%s" % (renderSettings, "swatchSamples"))
+    cmds.intFieldGrp(numberOfFields=1, label="Swatch samples", value1=existingSwatchSamples,
+        changeCommand=lambda (x): getIntFieldGroup(None, "swatchSamples", x))
+
+    existingSwatchWorkers = cmds.getAttr( "%s.%s" % (renderSettings, "swatchWorkers"))
+    cmds.intFieldGrp(numberOfFields=1, label="Swatch workers", value1=existingSwatchWorkers,
+        changeCommand=lambda (x): getIntFieldGroup(None, "swatchWorkers", x))
+
+    existingSwatchDebounce = cmds.getAttr( "%s.%s" % (renderSettings, "swatchDebounce"))
+    cmds.floatFieldGrp(numberOfFields=1, label="Swatch settle time", value1=existingSwatchDebounce,
+        changeCommand=lambda (x): getFloatFieldGroup(None, "swatchDebounce", x))
+
+    cmds.button(label="Preview Selected Material", command=lambda (x): showSwatchWindow())
+
     cmds.setParent('..')
     cmds.setParent('..')
 
@@ -1348,6 +1516,8 @@ def createRenderSettingsUI():
     af.append((cyclesGlobalsScrollLayout, 'right', 0))
     cmds.formLayout(parentForm, edit=True, attachForm=af)
 
+    print( "Cycles Render Settings - Created UI in %.3fs" % (time.time() - createStart) )
+
 
 def createRenderSettings():
     createRenderSettingsNode()
@@ -1382,6 +1552,11 @@ def showRender(fileName):
     renderWindowName = getRenderWindowPanel()
     cmds.renderWindowEditor(renderWindowName, edit=True, loadImage=fileName)
 
+# Swatches start a background render service, so it's only loaded when asked for
+def showSwatchWindow():
+    import CyclesSwatch
+    CyclesSwatch.showSwatchWindow()
+
 #Make the render window visible
 def showRenderWindow(filename):
     global renderWindow
@@ -1411,13 +1586,8 @@ def changeIntegrator(selectedIntegrator):
     #Query the integrator drop down menu to find the active integrator
     #selectedIntegrator = cmds.optionMenu(integratorMenu, query=True, value=True)
 
-    #Set all other integrator frameLayout to be invisible
-    for frame in integratorFrames:
-        currentIntegrator = cmds.frameLayout(frame, query=True, label=True).replace("_", " ")
-        if currentIntegrator == selectedIntegrator:
-            cmds.frameLayout(frame, edit=True, visible=True)
-        else:
-            cmds.frameLayout(frame, edit=True, visible=False) 
+    #Show the active integrator's frameLayout, building it the first time
+    showLazyFrame(integratorFrames, selectedIntegrator)
 
     integrator = selectedIntegrator
     getOptionMenu(None, "integrator", selectedIntegrator)
@@ -1431,14 +1601,8 @@ def changeSampler(selectedSampler):
 
     #Query the sampler drop down menu to find the active sampler
     selectedSampler = cmds.optionMenu(samplerMenu, query=True, value=True)
-    #Set all other sampler frameLayout to be invisible
-    for frame in samplerFrames:
-        currentSampler = cmds.frameLayout(frame, query=True, label=True)
-        currentSamplerUnderscore = currentSampler.replace(" ", "_")
-        if currentSampler == selectedSampler or currentSamplerUnderscore == selectedSampler:
-            cmds.frameLayout(frame, edit=True, visible=True)
-        else:
-            cmds.frameLayout(frame, edit=True, visible=False)
+    #Show the active sampler's frameLayout, building it the first time
+    showLazyFrame(samplerFrames, selectedSampler)
 
     sampler = selectedSampler
     getOptionMenu(None, "sampler", selectedSampler)
@@ -1446,39 +1610,24 @@ def changeSampler(selectedSampler):
 def changeSensorOverride(selectedSensorOverride):
     global sensorOverrideFrames
 
-    #Set all other sensorOverride frameLayouts to be invisible
-    for frame in sensorOverrideFrames:
-        currentSensorOverride = cmds.frameLayout(frame, query=True, label=True)
-        if currentSensorOverride == selectedSensorOverride:
-            cmds.frameLayout(frame, edit=True, visible=True)
-        else:
-            cmds.frameLayout(frame, edit=True, visible=False)
+    #Show the active sensorOverride's frameLayout, building it the first time
+    showLazyFrame(sensorOverrideFrames, selectedSensorOverride)
 
     getOptionMenu(None, "sensorOverride", selectedSensorOverride)
 
 def changeFilm(selectedFilm):
     global filmFrames
 
-    #Set all other film frameLayouts to be invisible
-    for frame in filmFrames:
-        currentFilmFrame = cmds.frameLayout(frame, query=True, label=True)
-        if currentFilmFrame == selectedFilm:
-            cmds.frameLayout(frame, edit=True, visible=True)
-        else:
-            cmds.frameLayout(frame, edit=True, visible=False)
+    #Show the active film's frameLayout, building it the first time
+    showLazyFrame(filmFrames, selectedFilm)
 
     getOptionMenu(None, "film", selectedFilm)
 
 def changeMetaIntegrator(selectedMetaIntegrator):
     global metaIntegratorFrames
 
-    #Set all other sensorOverride frameLayouts to be invisible
-    for frame in metaIntegratorFrames:
-        currentMetaIntegrator = cmds.frameLayout(frame, query=True, label=True)
-        if currentMetaIntegrator == selectedMetaIntegrator:
-            cmds.frameLayout(frame, edit=True, visible=True)
-        else:
-            cmds.frameLayout(frame, edit=True, visible=False)
+    #Show the active meta integrator's frameLayout, building it the first time
+    showLazyFrame(metaIntegratorFrames, selectedMetaIntegrator)
 
     getOptionMenu(None, "metaIntegrator", selectedMetaIntegrator)
 
@@ -0,0 +1,284 @@
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+from process import Process, ProcessList
+import imagefile
+
+import CyclesProgress
+
+#
+# Sample passes
+#
+# A frame's samples are split between a number of Cycles renders of the same
+# exported scene. Each pass renders a small scene that sets its own integrator
+# seed and includes the exported one, so the passes' noise is independent.
+# The passes run at the same time, on a share of this host's cores each or on
+# a render queue's agents, and their images are averaged with their sample
+# counts as weights, which matches a render with all of the samples.
+#
+def getPassSamples(samples, passes):
+    # The samples are shared out as evenly as they can be
+    passes = max(1, min(passes, samples))
+    return [samples // passes + (1 if i < samples % passes else 0) for i in range(passes)]
+
+def getPassSeed(index):
+    # The first pass uses Cycles' default seed, as a render without passes does
+    return index
+
+def getPassFileName(fileName, index):
+    (base, extension) = os.path.splitext(fileName)
+    return "%s.pass%d%s" % (base, index, extension)
+
+def writePassScene(sceneFileName, index):
+    # Includes are read relative to the scene Cycles is given, so the pass
+    # scene is written next to the exported one
+    passSceneFileName = getPassFileName(sceneFileName, index)
+    with open(passSceneFileName, 'w+') as passSceneFile:
+        passSceneFile.write("<?xml version=\'1.0\' encoding=\'utf-8\'?>\n")
+        passSceneFile.write("<cycles>\n")
+        passSceneFile.write("  <integrator seed=\"%d\" />\n" % getPassSeed(index))
+        passSceneFile.write("  <include src=\"%s\" />\n" % os.path.basename(sceneFileName))
+        passSceneFile.write("</cycles>\n")
+    return passSceneFileName
+
+def getPassArgs(args, sceneFileName, imageName, passSceneFileName, passImageName, samples, threads=0):
+    passArgs = ['--samples', str(samples)]
+    if threads:
+        passArgs.extend(['--threads', str(threads)])
+
+    # Each pass has its own share of the threads, in place of the frame's
+    skipNext = False
+    for arg in args:
+        if skipNext:
+            skipNext = False
+        elif arg == '--threads':
+            skipNext = True
+        else:
+            passArgs.append({sceneFileName : passSceneFileName, imageName : passImageName}.get(arg, arg))
+    return passArgs
+
+def mergePasses(passImageNames, passSamples, imageName, oiiotoolPath=None, keepTempFiles=False):
+    mergeStart = time.time()
+    method = imagefile.merge_images(passImageNames, passSamples, imageName, oiiotoolPath)
+    print( "Sample passes - Merged %d passes : %s (%s, %.3fs)" % (len(passImageNames), imageName,
+        method, time.time() - mergeStart) )
+
+    if not keepTempFiles:
+        for passImageName in passImageNames:
+            if os.path.exists(passImageName):
+                os.remove(passImageName)
+
+def applyRenderSettings(source, render):
+    # Renders made of several Cycles processes are used like the non-blocking
+    # Process of a single render. The settings made on them apply to each of
+    # their processes.
+    render.echo = source.echo
+    render.process_keys = list(source.process_keys)
+    render.log_tail_lines = source.log_tail_lines
+    render.echo_lines_per_second = source.echo_lines_per_second
+    render.timeout_no_output = source.timeout_no_output
+    render.timeout_no_progress = source.timeout_no_progress
+    render.timeout_total = source.timeout_total
+    render.progress_pattern = source.progress_pattern
+    render.retries = source.retries
+    render.retry_delay = source.retry_delay
+
+class PassProgress:
+    # Passes that render at the same time each print their own progress, which
+    # would jump back and forth if it was passed on as it is. Their fractions
+    # are combined, weighted by their samples, into the frame's progress.
+    def __init__(self, passSamples, callback):
+        self.passSamples = passSamples
+        self.callback = callback
+        self.fractions = [0.0]*len(passSamples)
+        self.lock = threading.Lock()
+
+    def getCallback(self, index):
+        if not self.callback:
+            return None
+        return lambda line: self.update(index, line)
+
+    def update(self, index, line):
+        progress = CyclesProgress.parseProgressLine(line)
+        if not progress or 'fraction' not in progress:
+            self.callback(line)
+            return
+
+        with self.lock:
+            self.fractions[index] = progress['fraction']
+            samples = sum(self.passSamples)
+            done = sum([fraction*passSamples for (fraction, passSamples) in zip(self.fractions, self.passSamples)])
+            self.callback("Progress %.2f   Sample %d/%d" % (100.0*done/samples, int(done), samples))
+
+class SamplePassRender(ProcessList):
+    # Renders the passes of a frame on this host and merges them. It can be
+    # waited for and killed, and its log has every pass.
+    def __init__(self, cyclesPath, args, env, sceneFileName, imageName, samples, passes,
+                 threads=0, oiiotoolPath=None, keepTempFiles=False):
+        self.passSamples = getPassSamples(samples, passes)
+        ProcessList.__init__(self, "render %d sample passes" % len(self.passSamples),
+            blocking=True, max_concurrency=len(self.passSamples))
+
+        self.imageName = imageName
+        self.oiiotoolPath = oiiotoolPath
+        self.keepTempFiles = keepTempFiles
+        self.merged = threading.Event()
+
+        # Each pass gets an equal share of the cores
+        passThreads = max(1, (threads or multiprocessing.cpu_count()) // len(self.passSamples))
+
+        self.passSceneFileNames = []
+        self.passImageNames = []
+        for (index, passSampleCount) in enumerate(self.passSamples):
+            passSceneFileName = writePassScene(sceneFileName, index)
+            passImageName = getPassFileName(imageName, index)
+            self.passSceneFileNames.append(passSceneFileName)
+            self.passImageNames.append(passImageName)
+
+            render = Process(description="render sample pass %d, %d samples" % (index, passSampleCount),
+                cmd=cyclesPath,
+                args=getPassArgs(args, sceneFileName, imageName, passSceneFileName, passImageName,
+                    passSampleCount, passThreads),
+                env=env)
+            self.add_process(render)
+
+        print( "Sample passes - %d passes of %s samples, %d threads each" % (len(self.passSamples),
+            ", ".join(map(str, self.passSamples)), passThreads) )
+
+    def execute(self):
+        passProgress = PassProgress(self.passSamples, self.log_callback)
+        for (index, render) in enumerate(self.processes):
+            applyRenderSettings(self, render)
+            render.log_callback = passProgress.getCallback(index)
+
+        self.merged.clear()
+        thread = threading.Thread(target=self._render)
+        thread.daemon = True
+        thread.start()
+
+    def _render(self):
+        try:
+            ProcessList.execute(self)
+
+            self.watchdog_trips = [trip for render in self.processes for trip in render.watchdog_trips]
+            for render in self.processes:
+                self._add_resources(render)
+
+            if self.status == 0 and not self._cancelled:
+                mergePasses(self.passImageNames, self.passSamples, self.imageName,
+                    self.oiiotoolPath, self.keepTempFiles)
+        except Exception, e:
+            print( "Sample passes - Unable to merge the passes : %s" % e )
+            self.status = -1
+        finally:
+            if not self.keepTempFiles:
+                for passSceneFileName in self.passSceneFileNames:
+                    if os.path.exists(passSceneFileName):
+                        os.remove(passSceneFileName)
+            self.merged.set()
+
+    def wait(self, timeout=None):
+        self.merged.wait(timeout)
+        return self.merged.is_set()
+
+#
+# Merge check
+#
+# Renders synthetic passes, each pixel the mean of its samples with Gaussian
+# noise drawn from the pass's seed, merges them as a frame's passes are
+# merged, and compares the result with a reference with all of the samples
+# and a seed of its own. Both should have the same mean and the same noise
+# variance, the noise's variance over the samples. Passes that shared their
+# noise would leave the merged image noisier than the reference.
+#
+#   PYTHONPATH=../util python CyclesSamplePasses.py --samples 64 --passes 3
+#
+def writeCheckImage(imageName, pixels, width, height):
+    with open(imageName, 'wb') as imageFile:
+        imageFile.write("PF\n%d %d\n-1.0\n" % (width, height))
+        imageFile.write(struct.pack("<%df" % len(pixels), *pixels))
+
+def readCheckImage(imageName):
+    with open(imageName, 'rb') as imageFile:
+        (channels, width, height, scale) = imagefile.read_pfm_header(imageFile)
+        count = channels*width*height
+        return struct.unpack("%s%df" % ("<" if float(scale) < 0 else ">", count), imageFile.read(4*count))
+
+def renderCheckImage(truth, samples, seed, sigma):
+    generator = random.Random(seed)
+    return [value + sum([generator.gauss(0.0, sigma) for i in range(samples)])/samples for value in truth]
+
+def getErrorStatistics(pixels, truth):
+    errors = [pixel - value for (pixel, value) in zip(pixels, truth)]
+    mean = sum(pixels)/len(pixels)
+    errorMean = sum(errors)/len(errors)
+    variance = sum([(error - errorMean)**2 for error in errors])/(len(errors) - 1)
+    return (mean, variance)
+
+def checkMerge(samples=64, passes=3, size=64, sigma=0.5):
+    truth = [0.1 + 0.8*((x*7 + y*13 + c) % 17)/16.0 for y in range(size) for x in range(size) for c in range(3)]
+    passSamples = getPassSamples(samples, passes)
+
+    checkDir = tempfile.mkdtemp(prefix="samplepasses_")
+    try:
+        passImageNames = []
+        for (index, passSampleCount) in enumerate(passSamples):
+            passImageName = os.path.join(checkDir, "pass%d.pfm" % index)
+            writeCheckImage(passImageName, renderCheckImage(truth, passSampleCount, getPassSeed(index), sigma),
+                size, size)
+            passImageNames.append(passImageName)
+
+        imageName = os.path.join(checkDir, "merged.pfm")
+        imagefile.merge_images(passImageNames, passSamples, imageName)
+        merged = readCheckImage(imageName)
+    finally:
+        shutil.rmtree(checkDir, True)
+
+    # The reference's seed isn't one that the passes used
+    reference = renderCheckImage(truth, samples, getPassSeed(len(passSamples)), sigma)
+
+    (mergedMean, mergedVariance) = getErrorStatistics(merged, truth)
+    (referenceMean, referenceVariance) = getErrorStatistics(reference, truth)
+    expectedVariance = sigma**2/samples
+
+    # The means differ by the noise of both images' averages, and the
+    # variances are estimated from a limited number of pixels
+    meanTolerance = 4.0*math.sqrt(2.0*expectedVariance/len(truth))
+    varianceTolerance = 4.0*math.sqrt(2.0/(len(truth) - 1))
+
+    print( "Sample passes - %d passes of %s samples, %d pixels" % (len(passSamples),
+        ", ".join(map(str, passSamples)), len(truth)) )
+    print( "  mean     : merged %.5f, reference %.5f, tolerance %.5f" % (mergedMean, referenceMean, meanTolerance) )
+    print( "  variance : merged %.6f, reference %.6f, expected %.6f" % (mergedVariance, referenceVariance,
+        expectedVariance) )
+
+    matches = (abs(mergedMean - referenceMean) <= meanTolerance and
+        abs(mergedVariance/referenceVariance - 1.0) <= 2.0*varianceTolerance and
+        abs(mergedVariance/expectedVariance - 1.0) <= varianceTolerance)
+    print( "  %s" % ("The merged passes match the reference" if matches else
+        "The merged passes don't match the reference") )
+    return matches
+
+if __name__ == '__main__':
+    import sys
+    from optparse import OptionParser
+
+    p = OptionParser(usage='%prog [options]')
+    p.add_option('--samples', '-s', type='int', default=64,
+                 help='The samples of the frame, shared out between the passes')
+    p.add_option('--passes', '-p', type='int', default=3,
+                 help='The number of passes')
+    p.add_option('--size', type='int', default=64,
+                 help='The width and height of the images')
+    p.add_option('--sigma', type='float', default=0.5,
+                 help='The standard deviation of a sample\'s noise')
+    (options, args) = p.parse_args()
+
+    sys.exit(0 if checkMerge(options.samples, options.passes, options.size, options.sigma) else 1)
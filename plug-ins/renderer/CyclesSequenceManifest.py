@@ -0,0 +1,158 @@
+import datetime
+import glob
+import json
+import os
+import platform
+
+from transfer import checksum
+
+#
+# Sequence manifest
+#
+# Every frame of an animation render is recorded in a manifest next to the
+# images, with its status and the size and checksum of its image. When a render
+# is resumed, frames whose images are still present and match the manifest are
+# skipped. Frames that are missing, truncated, corrupt or failed are rendered
+# again.
+#
+
+# The first bytes of each image format Cycles writes
+imageMagicNumbers = {
+    '.exr' : ['\x76\x2f\x31\x01'],
+    '.png' : ['\x89PNG'],
+    '.jpg' : ['\xff\xd8\xff'],
+    '.jpeg' : ['\xff\xd8\xff'],
+    '.tif' : ['II*\x00', 'MM\x00*'],
+    '.tiff' : ['II*\x00', 'MM\x00*'],
+    '.hdr' : ['#?'],
+    '.pfm' : ['PF', 'Pf'],
+}
+
+def validateImage(imagePath, size=None, imageChecksum=None):
+    if not os.path.isfile(imagePath):
+        return (False, "missing")
+
+    imageSize = os.path.getsize(imagePath)
+    if imageSize == 0:
+        return (False, "empty")
+    if size is not None and imageSize != size:
+        return (False, "size %d, expected %d" % (imageSize, size))
+
+    magicNumbers = imageMagicNumbers.get(os.path.splitext(imagePath)[1].lower())
+    if magicNumbers:
+        with open(imagePath, 'rb') as imageFile:
+            header = imageFile.read(max(map(len, magicNumbers)))
+        if not any(header.startswith(magic) for magic in magicNumbers):
+            return (False, "not a valid image")
+
+    if imageChecksum is not None and checksum(imagePath) != imageChecksum:
+        return (False, "checksum mismatch")
+
+    return (True, "valid")
+
+def getManifestPath(projectDir, imagePrefix):
+    return os.path.join(projectDir, "images", imagePrefix + ".manifest.json")
+
+# Batch workers each record their chunk of frames in a manifest of their own,
+# which are merged into the sequence's manifest once the workers finish
+def getChunkManifestPath(manifestPath, startFrame, endFrame):
+    return "%s.%d-%d.json" % (os.path.splitext(manifestPath)[0], startFrame, endFrame)
+
+def mergeChunkManifests(manifestPath):
+    manifest = SequenceManifest(manifestPath)
+    manifest.load()
+
+    chunkPaths = sorted(glob.glob("%s.*-*.json" % os.path.splitext(manifestPath)[0]))
+    for chunkPath in chunkPaths:
+        chunkManifest = SequenceManifest(chunkPath)
+        manifest.frames.update(chunkManifest.load())
+
+    if chunkPaths:
+        manifest.save()
+        for chunkPath in chunkPaths:
+            os.remove(chunkPath)
+
+    return manifest
+
+def formatFrameRanges(frames):
+    ranges = []
+    for frame in sorted(frames):
+        if ranges and frame == ranges[-1][1] + 1:
+            ranges[-1][1] = frame
+        else:
+            ranges.append([frame, frame])
+    return ", ".join([str(start) if start == end else "%d-%d" % (start, end) for (start, end) in ranges])
+
+class SequenceManifest:
+    def __init__(self, manifestPath):
+        self.manifestPath = manifestPath
+        self.frames = {}
+
+    def load(self):
+        self.frames = {}
+        if os.path.exists(self.manifestPath):
+            try:
+                with open(self.manifestPath, 'r') as manifestFile:
+                    manifest = json.load(manifestFile)
+                self.frames = manifest.get('frames', {})
+            except Exception, e:
+                print( "Sequence manifest - couldn't read %s : %s" % (self.manifestPath, e) )
+        return self.frames
+
+    def save(self):
+        manifestDir = os.path.dirname(self.manifestPath)
+        if not os.path.exists(manifestDir):
+            os.makedirs(manifestDir)
+
+        # Written to a temporary file first so an interrupted write can't lose the earlier frames
+        tempPath = "%s.%d.tmp" % (self.manifestPath, os.getpid())
+        with open(tempPath, 'w') as manifestFile:
+            json.dump({'version' : 1, 'frames' : self.frames}, manifestFile, indent=2, sort_keys=True)
+        # Windows won't rename over an existing file
+        if platform.system() == 'Windows' and os.path.exists(self.manifestPath):
+            os.remove(self.manifestPath)
+        os.rename(tempPath, self.manifestPath)
+
+    def recordFrame(self, frame, imageName, renderStatus, outputImageName=None, watchdogTrips=None):
+        # outputImageName is where the image ends up, when it's rendered somewhere else first
+        if outputImageName is None:
+            outputImageName = imageName
+
+        (valid, reason) = validateImage(imageName)
+        entry = {
+            'status' : 'complete' if valid and renderStatus in [0, None] else 'failed',
+            'image' : outputImageName,
+            'renderStatus' : renderStatus,
+            'recorded' : str(datetime.datetime.now())
+        }
+        if watchdogTrips:
+            entry['watchdog'] = watchdogTrips
+        if valid:
+            entry['size'] = os.path.getsize(imageName)
+            entry['checksum'] = checksum(imageName)
+        else:
+            entry['reason'] = reason
+
+        self.frames[str(frame)] = entry
+        self.save()
+
+        return entry['status'] == 'complete'
+
+    def validateFrame(self, frame):
+        entry = self.frames.get(str(frame))
+        if not entry:
+            return (False, "not rendered")
+        if entry['status'] != 'complete':
+            return (False, entry.get('reason', entry['status']))
+        return validateImage(entry['image'], entry.get('size'), entry.get('checksum'))
+
+    def getRemainingFrames(self, frames):
+        remaining = []
+        invalid = {}
+        for frame in frames:
+            (valid, reason) = self.validateFrame(frame)
+            if not valid:
+                remaining.append(frame)
+                if str(frame) in self.frames:
+                    invalid[frame] = reason
+        return (remaining, invalid)
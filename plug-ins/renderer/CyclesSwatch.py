@@ -0,0 +1,411 @@
+import hashlib
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+import maya.cmds as cmds
+import maya.OpenMaya as OpenMaya
+import maya.utils
+
+from process import Process
+
+# The swatch window is opened from the Render Settings UI, which Maya imports
+# as a top-level module. The renderer is imported from its package so that
+# this is the module the plug-in registered the material node types on.
+from renderer import CyclesRenderer
+from renderer import CyclesTextureCache
+
+#
+# Material swatches
+#
+# Each material is previewed on a small sphere rendered by Cycles in the
+# background. Previews are cached on disk, keyed by a hash of the material's
+# compiled shader graph and the swatch settings, so a material that's been
+# seen before, or changed back, is shown without rendering. While a slider is
+# dragged, a render only starts once the material has stopped changing for a
+# moment, and a render that's running when the material changes again is
+# killed, as its result would already be stale.
+#
+
+# Bump when the swatch scene changes so old cache entries aren't reused
+swatchVersion = 1
+
+swatchPollInterval = 0.05
+swatchCameraDistance = 3.2
+swatchFieldOfView = 0.42
+
+def getSphereMesh(rings=16, segments=32):
+    points = []
+    for ring in range(rings + 1):
+        theta = math.pi*ring/rings
+        for segment in range(segments):
+            phi = 2.0*math.pi*segment/segments
+            points.append((math.sin(theta)*math.cos(phi), math.cos(theta), math.sin(theta)*math.sin(phi)))
+
+    nverts = []
+    verts = []
+    for ring in range(rings):
+        for segment in range(segments):
+            a = ring*segments + segment
+            b = ring*segments + (segment + 1) % segments
+            verts.extend([a, b, b + segments, a + segments])
+            nverts.append(4)
+
+    return (points, nverts, verts)
+
+def writeSwatchMesh(rendererIO):
+    (points, nverts, verts) = getSphereMesh()
+
+    meshDict = rendererIO.createSceneElement(elementType = 'mesh')
+    meshDict.addAttribute('name', 'swatch_sphere')
+    meshDict.addAttribute('P', " ".join(["%g %g %g" % p for p in points]))
+    meshDict.addAttribute('nverts', " ".join(map(str, nverts)))
+    meshDict.addAttribute('verts', " ".join(map(str, verts)))
+    return meshDict
+
+def writeSwatchScene(shaderElement):
+    rendererIO = CyclesRenderer.loadRendererIO()
+
+    sceneElement = rendererIO.createSceneElement(elementType = 'cycles')
+    sceneElement.addAttribute('version', '0.5.0')
+
+    cameraDict = rendererIO.createSceneElement(elementType = 'camera')
+    cameraDict.addAttribute('type', 'perspective')
+    cameraDict.addAttribute('fov', swatchFieldOfView)
+
+    transformDict = rendererIO.createSceneElement(elementType = 'transform')
+    transformDict.addAttribute('translate', "0 0 -%g" % swatchCameraDistance)
+    transformDict.addChild(cameraDict)
+    sceneElement.addChild(transformDict)
+
+    sceneElement.addChild(rendererIO.writeBackgroundCycles())
+    sceneElement.addChild(shaderElement)
+
+    stateDict = rendererIO.createSceneElement(elementType = 'state')
+    stateDict.addAttribute('shader', shaderElement.getAttribute('name'))
+    stateDict.addAttribute('interpolation', 'smooth')
+    stateDict.addChild(writeSwatchMesh(rendererIO))
+    sceneElement.addChild(stateDict)
+
+    return sceneElement
+
+def getShaderGraphHash(shaderElement, size, samples):
+    key = hashlib.sha1()
+    key.update(json.dumps(shaderElement, sort_keys=True))
+    key.update("|%d|%d|%d" % (size, samples, swatchVersion))
+
+    # Textures are part of the graph by name only, so edits to them need their stamps
+    for texturePath in sorted(set(CyclesTextureCache.listSceneTextures(shaderElement))):
+        if os.path.isfile(texturePath):
+            stat = os.stat(texturePath)
+            key.update("|%s|%d|%d" % (texturePath, int(stat.st_mtime), stat.st_size))
+
+    return key.hexdigest()
+
+class SwatchService:
+    def __init__(self, cyclesPath, cacheDir, size=128, samples=32, workers=2, debounce=0.3):
+        self.cyclesPath = cyclesPath
+        self.cacheDir = cacheDir
+        self.size = size
+        self.samples = samples
+        self.workers = max(1, workers)
+        self.debounce = debounce
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = {}
+        self.running = {}
+        self.stopped = False
+
+        self.hits = 0
+        self.renders = 0
+        self.superseded = 0
+
+        self.thread = threading.Thread(target=self._dispatchRequests)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def getSwatchPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], "%s.png" % key)
+
+    def request(self, material, callback):
+        # The graph is compiled here, on Maya's main thread. Only rendering happens in the background.
+        rendererIO = CyclesRenderer.loadRendererIO()
+        shaderElement = rendererIO.writeShaderCycles(material, material)
+        if not shaderElement:
+            return None
+
+        key = getShaderGraphHash(shaderElement, self.size, self.samples)
+        swatchPath = self.getSwatchPath(key)
+        cached = os.path.exists(swatchPath)
+        if not cached:
+            sceneText = rendererIO.writeElementText(writeSwatchScene(shaderElement))
+
+        staleRender = None
+        with self.lock:
+            self.pending.pop(material, None)
+
+            job = self.running.get(material)
+            if job and job['key'] != key and not job['superseded']:
+                job['superseded'] = True
+                staleRender = job['render']
+                self.superseded += 1
+
+            if cached:
+                self.hits += 1
+            elif job and job['key'] == key and not job['superseded']:
+                job['callback'] = callback
+            else:
+                self.pending[material] = {
+                    'key' : key,
+                    'sceneText' : sceneText,
+                    'callback' : callback,
+                    'requested' : time.time()
+                }
+
+        if staleRender:
+            staleRender.kill("superseded")
+
+        if cached:
+            callback(material, swatchPath)
+            return swatchPath
+
+        self.wake.set()
+        return None
+
+    def _dispatchRequests(self):
+        while not self.stopped:
+            self.wake.wait(swatchPollInterval)
+            self.wake.clear()
+
+            now = time.time()
+            failedJobs = []
+            with self.lock:
+                # Oldest requests first, once they've settled
+                for (material, request) in sorted(self.pending.items(), key=lambda (m, r): r['requested']):
+                    if len(self.running) >= self.workers:
+                        break
+                    # A superseded render is still being killed
+                    if material in self.running:
+                        continue
+                    if now - request['requested'] < self.debounce:
+                        continue
+
+                    del self.pending[material]
+                    try:
+                        job = self._startRender(material, request)
+                    except Exception, e:
+                        print( "Swatch render failed to start : %s - %s" % (material, e) )
+                        continue
+
+                    # A render that Cycles couldn't be launched for has already ended,
+                    # without its finish callback
+                    if job['render'].status == -1 and job['render'].end is not None:
+                        failedJobs.append((material, job))
+                    else:
+                        self.running[material] = job
+
+            for (material, job) in failedJobs:
+                self._renderFinished(material, job)
+
+    def _startRender(self, material, request):
+        swatchPath = self.getSwatchPath(request['key'])
+        swatchDir = os.path.dirname(swatchPath)
+        if not os.path.exists(swatchDir):
+            try:
+                os.makedirs(swatchDir)
+            except OSError:
+                if not os.path.isdir(swatchDir):
+                    raise
+
+        (sceneHandle, scenePath) = tempfile.mkstemp(prefix="swatch_", suffix=".xml")
+        with os.fdopen(sceneHandle, 'w') as sceneFile:
+            sceneFile.write(request['sceneText'])
+
+        # Rendered to a temporary file and renamed into place, as with the texture cache
+        tempPath = "%s.%d.%d.png" % (os.path.splitext(swatchPath)[0], os.getpid(), self.renders)
+
+        cyclesDir = os.path.dirname(self.cyclesPath)
+        env = {"LD_LIBRARY_PATH" : str(cyclesDir), "PATH" : os.environ.get("PATH", "")}
+
+        render = Process(description='render a swatch',
+            cmd=self.cyclesPath,
+            args=['--samples', str(self.samples),
+                  '--width', str(self.size),
+                  '--height', str(self.size),
+                  '--output', tempPath,
+                  scenePath],
+            env=env, non_blocking=True)
+        render.echo = False
+
+        job = {
+            'key' : request['key'],
+            'callback' : request['callback'],
+            'render' : render,
+            'scenePath' : scenePath,
+            'tempPath' : tempPath,
+            'swatchPath' : swatchPath,
+            'superseded' : False,
+            'finished' : False
+        }
+        render.finish_callback = lambda: self._renderFinished(material, job)
+
+        self.renders += 1
+        render.execute()
+        return job
+
+    def _renderFinished(self, material, job):
+        # Called once, whether the render ended or couldn't be launched
+        with self.lock:
+            if job['finished']:
+                return
+            job['finished'] = True
+
+        render = job['render']
+        swatchPath = job['swatchPath']
+
+        try:
+            if os.path.exists(job['scenePath']):
+                os.remove(job['scenePath'])
+
+            if job['superseded']:
+                pass
+            elif render.status == 0 and os.path.exists(job['tempPath']):
+                try:
+                    os.rename(job['tempPath'], swatchPath)
+                except OSError:
+                    # Windows won't rename over an existing file, which is the same swatch
+                    pass
+                maya.utils.executeDeferred(job['callback'], material, swatchPath)
+            else:
+                print( "Swatch render failed : %s, status %s" % (material, render.status) )
+                for line in render.log[-10:]:
+                    print( "\t%s" % line )
+
+            if os.path.exists(job['tempPath']):
+                os.remove(job['tempPath'])
+        except Exception, e:
+            print( "Swatch render failed : %s - %s" % (material, e) )
+        finally:
+            with self.lock:
+                if self.running.get(material) is job:
+                    del self.running[material]
+            self.wake.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+
+        with self.lock:
+            self.pending = {}
+            jobs = self.running.values()
+            for job in jobs:
+                job['superseded'] = True
+
+        for job in jobs:
+            job['render'].kill("swatch service stopped")
+            job['render'].wait(5.0)
+        self.thread.join(5.0)
+
+        print( "Swatch service - %d renders, %d cache hits, %d superseded" % (
+            self.renders, self.hits, self.superseded) )
+
+#
+# Maya integration
+#
+# The service is started on first use with the swatch settings from the render
+# settings node, and restarted when they change.
+#
+swatchService = None
+
+def getSwatchSettings():
+    renderSettings = CyclesRenderer.getRenderSettingsNode()
+    if not renderSettings:
+        CyclesRenderer.createRenderSettingsNode()
+        renderSettings = CyclesRenderer.getRenderSettingsNode()
+
+    cacheDir = cmds.getAttr("%s.%s" % (renderSettings, "swatchCacheDir"))
+    if not cacheDir:
+        cacheDir = os.path.join(cmds.internalVar(userAppDir=True), "CyclesForMaya", "swatchCache")
+
+    return (cmds.getAttr("%s.%s" % (renderSettings, "cyclesPath")),
+            cacheDir,
+            cmds.getAttr("%s.%s" % (renderSettings, "swatchSize")),
+            cmds.getAttr("%s.%s" % (renderSettings, "swatchSamples")),
+            cmds.getAttr("%s.%s" % (renderSettings, "swatchWorkers")),
+            cmds.getAttr("%s.%s" % (renderSettings, "swatchDebounce")))
+
+def getSwatchService():
+    global swatchService
+
+    settings = getSwatchSettings()
+    if swatchService and swatchService.settings != settings:
+        swatchService.stop()
+        swatchService = None
+
+    if not swatchService:
+        swatchService = SwatchService(*settings)
+        swatchService.settings = settings
+        print( "Swatch service - Cache : %s" % settings[1] )
+
+    return swatchService
+
+def stopSwatchService():
+    global swatchService
+    if swatchService:
+        swatchService.stop()
+        swatchService = None
+
+def requestSwatch(material, callback):
+    return getSwatchService().request(material, callback)
+
+def watchMaterial(material, callback):
+    # Every node upstream of the material changes its swatch
+    callbackIds = []
+    for node in cmds.listHistory(material) or [material]:
+        selection = OpenMaya.MSelectionList()
+        selection.add(node)
+        nodeObject = OpenMaya.MObject()
+        selection.getDependNode(0, nodeObject)
+
+        def attributeChanged(message, plug, otherPlug, clientData):
+            if message & (OpenMaya.MNodeMessage.kAttributeSet |
+                          OpenMaya.MNodeMessage.kConnectionMade |
+                          OpenMaya.MNodeMessage.kConnectionBroken):
+                requestSwatch(material, callback)
+
+        callbackIds.append(OpenMaya.MNodeMessage.addAttributeChangedCallback(nodeObject, attributeChanged))
+
+    return callbackIds
+
+def removeCallbacks(callbackIds):
+    for callbackId in callbackIds:
+        OpenMaya.MMessage.removeCallback(callbackId)
+
+def showSwatchWindow(material=None):
+    if not material:
+        materials = [x for x in cmds.ls(selection=True) if cmds.nodeType(x) in CyclesRenderer.materialNodeTypes]
+        if not materials:
+            print( "Select a Cycles material to preview" )
+            return None
+        material = materials[0]
+
+    size = getSwatchService().size
+
+    window = cmds.window(title="Cycles Swatch - %s" % material)
+    cmds.columnLayout()
+    image = cmds.image(width=size, height=size)
+    cmds.showWindow(window)
+
+    def showSwatch(material, swatchPath):
+        if cmds.image(image, exists=True):
+            cmds.image(image, edit=True, image=swatchPath)
+
+    callbackIds = watchMaterial(material, showSwatch)
+    cmds.scriptJob(uiDeleted=[window, lambda: removeCallbacks(callbackIds)])
+
+    requestSwatch(material, showSwatch)
+    return window
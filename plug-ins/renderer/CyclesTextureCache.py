@@ -0,0 +1,347 @@
+import hashlib
+import os
+import threading
+
+from Queue import Queue, Empty
+
+from process import Process
+
+#
+# Texture preparation
+#
+# Textures referenced by the exported scene are converted to tiled, mipmapped
+# files so Cycles can page in just the tiles and levels it needs. Conversions
+# are stored in a cache directory that can be shared between scenes, shots and
+# machines. A conversion is keyed by the source path, its modification time and
+# size, and the converter settings, so a texture is only ever converted once.
+#
+
+# Bump when the conversion itself changes so old cache entries aren't reused
+textureCacheVersion = 1
+
+# Files that are already tiled and mipmapped are passed through as-is
+preparedTextureExtensions = ['.tx']
+
+def getConverterArgs(converterPath, sourcePath, targetPath):
+    # maketx and oiiotool are both part of OpenImageIO
+    if 'maketx' in os.path.basename(converterPath).lower():
+        return ['--oiio', sourcePath, '-o', targetPath]
+    else:
+        return [sourcePath, '-otex', targetPath]
+
+def getTextureCacheKey(texturePath, converterPath):
+    stat = os.stat(texturePath)
+    settings = " ".join(getConverterArgs(converterPath, "", ""))
+
+    key = hashlib.sha1()
+    key.update(os.path.abspath(texturePath))
+    key.update("|%d|%d|" % (int(stat.st_mtime), stat.st_size))
+    key.update("%s|%s|%d" % (os.path.basename(converterPath), settings, textureCacheVersion))
+    return key.hexdigest()
+
+def getCachedTexturePath(cacheDir, texturePath, converterPath):
+    key = getTextureCacheKey(texturePath, converterPath)
+    textureName = os.path.splitext(os.path.basename(texturePath))[0]
+
+    # Spread the entries over sub-directories to keep directory listings short
+    return os.path.join(cacheDir, key[:2], "%s_%s.tx" % (textureName, key[:16]))
+
+def convertTexture(converterPath, sourcePath, targetPath, env=None):
+    targetDir = os.path.dirname(targetPath)
+    if not os.path.exists(targetDir):
+        try:
+            os.makedirs(targetDir)
+        except OSError:
+            # Another conversion may have created it first
+            if not os.path.isdir(targetDir):
+                raise
+
+    # Convert to a temporary file and rename it into place, so other renders
+    # sharing the cache never see a partially written texture
+    (targetBase, targetExtension) = os.path.splitext(targetPath)
+    tempPath = "%s.%d.%d%s" % (targetBase, os.getpid(), threading.current_thread().ident, targetExtension)
+
+    conversion = Process(description='convert a texture',
+        cmd=converterPath,
+        args=getConverterArgs(converterPath, sourcePath, tempPath),
+        env=env)
+    conversion.echo = False
+    conversion.execute()
+
+    if conversion.status != 0 or not os.path.exists(tempPath):
+        print( "Texture conversion failed : %s" % sourcePath )
+        for line in conversion.log:
+            print( "\t%s" % line )
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        return False
+
+    try:
+        os.rename(tempPath, targetPath)
+    except OSError:
+        # Windows won't rename over an existing file. Another process already
+        # finished the same conversion, so its result is used.
+        os.remove(tempPath)
+
+    return os.path.exists(targetPath)
+
+def prepareTextures(texturePaths, converterPath, cacheDir, workers=4, env=None):
+    textureMap = {}
+    conversions = Queue()
+
+    for texturePath in set(texturePaths):
+        if not texturePath or not os.path.isfile(texturePath):
+            continue
+        if os.path.splitext(texturePath)[1].lower() in preparedTextureExtensions:
+            continue
+
+        cachedPath = getCachedTexturePath(cacheDir, texturePath, converterPath)
+        if os.path.exists(cachedPath):
+            textureMap[texturePath] = cachedPath
+        else:
+            conversions.put((texturePath, cachedPath))
+
+    cached = len(textureMap)
+    pending = conversions.qsize()
+    print( "Texture cache - %d cached, %d to convert" % (cached, pending) )
+
+    def convertTextures():
+        while True:
+            try:
+                (texturePath, cachedPath) = conversions.get(block=False)
+            except Empty:
+                break
+            try:
+                if convertTexture(converterPath, texturePath, cachedPath, env):
+                    textureMap[texturePath] = cachedPath
+            except Exception, e:
+                print( "Texture conversion failed : %s - %s" % (texturePath, e) )
+
+    threads = []
+    for i in range(max(1, min(workers, pending))):
+        thread = threading.Thread(target=convertTextures)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if pending:
+        print( "Texture cache - converted %d of %d" % (len(textureMap) - cached, pending) )
+
+    return textureMap
+
+#
+# Draft texture proxies
+#
+# Draft renders use textures downscaled by 2, 4 or 8. Proxies are generated in
+# the background, and a texture whose proxy isn't ready yet is rendered with
+# the original, so export never waits on them. The proxy directory is kept to
+# a disk budget by removing the least recently used proxies. Using a proxy
+# updates its modification time, which gives the recency order.
+#
+textureQualityScales = {
+    "Full resolution" : 1,
+    "Draft 1/2" : 2,
+    "Draft 1/4" : 4,
+    "Draft 1/8" : 8
+}
+
+proxyQueue = Queue()
+proxyPending = set()
+proxyLock = threading.Lock()
+proxyWorkers = []
+
+def getProxyArgs(sourcePath, targetPath, scale, tiled):
+    args = [sourcePath, '--resize', '%g%%' % (100.0/scale)]
+    if tiled:
+        args.extend(['-otex', targetPath])
+    else:
+        args.extend(['-o', targetPath])
+    return args
+
+def getProxyTexturePath(cacheDir, texturePath, scale, tiled):
+    stat = os.stat(texturePath)
+
+    key = hashlib.sha1()
+    key.update(os.path.abspath(texturePath))
+    key.update("|%d|%d|" % (int(stat.st_mtime), stat.st_size))
+    key.update(" ".join(getProxyArgs("", "", scale, tiled)))
+    key.update("|%d" % textureCacheVersion)
+    key = key.hexdigest()
+
+    (textureName, extension) = os.path.splitext(os.path.basename(texturePath))
+    if tiled:
+        extension = '.tx'
+    return os.path.join(cacheDir, "proxies", key[:2], "%s_%d_%s%s" % (textureName, scale, key[:16], extension))
+
+def evictTextureProxies(cacheDir, budgetBytes):
+    proxyDir = os.path.join(cacheDir, "proxies")
+
+    proxies = []
+    totalBytes = 0
+    for root, dirs, files in os.walk(proxyDir):
+        for fileName in files:
+            proxyPath = os.path.join(root, fileName)
+            try:
+                stat = os.stat(proxyPath)
+            except OSError:
+                continue
+            proxies.append((stat.st_mtime, stat.st_size, proxyPath))
+            totalBytes += stat.st_size
+
+    if totalBytes <= budgetBytes:
+        return 0
+
+    evicted = 0
+    for (mtime, size, proxyPath) in sorted(proxies):
+        if totalBytes <= budgetBytes:
+            break
+        try:
+            os.remove(proxyPath)
+            totalBytes -= size
+            evicted += 1
+        except OSError:
+            print( "Texture proxies - couldn't evict : %s" % proxyPath )
+
+    return evicted
+
+def generateTextureProxies():
+    while True:
+        (oiiotoolPath, texturePath, proxyPath, scale, tiled, cacheDir, budgetBytes) = proxyQueue.get()
+        try:
+            targetDir = os.path.dirname(proxyPath)
+            if not os.path.exists(targetDir):
+                try:
+                    os.makedirs(targetDir)
+                except OSError:
+                    if not os.path.isdir(targetDir):
+                        raise
+
+            (targetBase, targetExtension) = os.path.splitext(proxyPath)
+            tempPath = "%s.%d.%d%s" % (targetBase, os.getpid(), threading.current_thread().ident, targetExtension)
+
+            generation = Process(description='generate a texture proxy',
+                cmd=oiiotoolPath,
+                args=getProxyArgs(texturePath, tempPath, scale, tiled))
+            generation.echo = False
+            generation.execute()
+
+            if generation.status == 0 and os.path.exists(tempPath):
+                try:
+                    os.rename(tempPath, proxyPath)
+                except OSError:
+                    os.remove(tempPath)
+
+                with proxyLock:
+                    evictTextureProxies(cacheDir, budgetBytes)
+            else:
+                print( "Texture proxies - generation failed : %s" % texturePath )
+                if os.path.exists(tempPath):
+                    os.remove(tempPath)
+        except Exception, e:
+            print( "Texture proxies - generation failed : %s - %s" % (texturePath, e) )
+        finally:
+            with proxyLock:
+                proxyPending.discard(proxyPath)
+            proxyQueue.task_done()
+
+def requestTextureProxies(texturePaths, oiiotoolPath, cacheDir, scale, tiled=False, budgetMegabytes=4096, workers=2):
+    textureMap = {}
+    requested = 0
+    budgetBytes = budgetMegabytes*1024*1024
+
+    for texturePath in set(texturePaths):
+        if not texturePath or not os.path.isfile(texturePath):
+            continue
+
+        proxyPath = getProxyTexturePath(cacheDir, texturePath, scale, tiled)
+        if os.path.exists(proxyPath):
+            # Mark the proxy as recently used
+            try:
+                os.utime(proxyPath, None)
+            except OSError:
+                pass
+            textureMap[texturePath] = proxyPath
+            continue
+
+        with proxyLock:
+            if proxyPath in proxyPending:
+                continue
+            proxyPending.add(proxyPath)
+
+        proxyQueue.put((oiiotoolPath, texturePath, proxyPath, scale, tiled, cacheDir, budgetBytes))
+        requested += 1
+
+    # Workers outlive a single export so later frames and renders pick up where they left off
+    with proxyLock:
+        while len(proxyWorkers) < workers:
+            worker = threading.Thread(target=generateTextureProxies)
+            worker.daemon = True
+            worker.start()
+            proxyWorkers.append(worker)
+
+    print( "Texture proxies - 1/%d, %d ready, %d requested, %d pending" % (
+        scale, len(textureMap), requested, len(proxyPending)) )
+
+    return textureMap
+
+def waitForTextureProxies():
+    proxyQueue.join()
+
+#
+# Scene description rewriting
+#
+def getTextureFilenameAttributes(element):
+    # Shader nodes carry the path in a 'filename' attribute, older emitters in
+    # a 'filename' string parameter
+    if element.get('type') == 'string':
+        if element['attributes'].get('name') == 'filename':
+            return ['value']
+        return []
+    elif 'filename' in element.get('attributes', {}):
+        return ['filename']
+    return []
+
+def walkSceneElements(element):
+    if element in [{}, None]:
+        return
+    yield element
+    for child in element.get('children', []):
+        for descendant in walkSceneElements(child):
+            yield descendant
+
+def listSceneTextures(sceneElement):
+    texturePaths = []
+    for element in walkSceneElements(sceneElement):
+        for attribute in getTextureFilenameAttributes(element):
+            texturePaths.append(element['attributes'][attribute])
+    return texturePaths
+
+def remapSceneTextures(sceneElement, textureMap):
+    for element in walkSceneElements(sceneElement):
+        for attribute in getTextureFilenameAttributes(element):
+            texturePath = element['attributes'][attribute]
+            if texturePath in textureMap:
+                element['attributes'][attribute] = textureMap[texturePath]
+
+def prepareSceneTextures(sceneElement, converterPath, cacheDir, workers=4, env=None):
+    texturePaths = listSceneTextures(sceneElement)
+    if not texturePaths:
+        return {}
+
+    textureMap = prepareTextures(texturePaths, converterPath, cacheDir, workers, env)
+    remapSceneTextures(sceneElement, textureMap)
+
+    return textureMap
+
+def proxySceneTextures(sceneElement, oiiotoolPath, cacheDir, scale, tiled=False, budgetMegabytes=4096, workers=2):
+    texturePaths = listSceneTextures(sceneElement)
+    if not texturePaths:
+        return {}
+
+    textureMap = requestTextureProxies(texturePaths, oiiotoolPath, cacheDir, scale, tiled, budgetMegabytes, workers)
+    remapSceneTextures(sceneElement, textureMap)
+
+    return textureMap
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import platform
+import shutil
+import threading
+
+from Queue import Queue
+
+import CyclesTextureCache
+
+#
+# Texture prefetching
+#
+# While one frame renders, the textures and environment maps of the next few
+# frames are read ahead on a background thread. They are either read once so
+# they're in the OS page cache, or copied to a local scratch directory, when
+# one is given, so Cycles doesn't read them from network storage. The scene for
+# each frame is pointed at the scratch copies that are ready, and the number of
+# textures that were or weren't prefetched goes in the frame's log.
+#
+prefetchChunkSize = 4*1024*1024
+
+class TexturePrefetcher:
+    def __init__(self, scratchDir=None):
+        self.scratchDir = scratchDir
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.scheduled = set()
+        self.ready = {}
+        self.copies = []
+
+        self.hits = 0
+        self.misses = 0
+        self.bytesPrefetched = 0
+        self.failures = 0
+
+        self.thread = threading.Thread(target=self._prefetchTextures)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, texturePaths):
+        scheduled = 0
+        for texturePath in texturePaths:
+            if texturePath in self.scheduled or not os.path.isfile(texturePath):
+                continue
+            self.scheduled.add(texturePath)
+            self.queue.put(texturePath)
+            scheduled += 1
+        return scheduled
+
+    def _getScratchPath(self, texturePath):
+        key = hashlib.sha1(os.path.abspath(texturePath)).hexdigest()
+        return os.path.join(self.scratchDir, "%s_%s" % (key[:16], os.path.basename(texturePath)))
+
+    def _warmTexture(self, texturePath):
+        with open(texturePath, 'rb') as textureFile:
+            while textureFile.read(prefetchChunkSize):
+                pass
+        return texturePath
+
+    def _copyTexture(self, texturePath):
+        scratchPath = self._getScratchPath(texturePath)
+
+        # Copies from earlier renders are reused while they match the source
+        sourceStat = os.stat(texturePath)
+        if os.path.exists(scratchPath):
+            scratchStat = os.stat(scratchPath)
+            if (scratchStat.st_size == sourceStat.st_size and
+                int(scratchStat.st_mtime) == int(sourceStat.st_mtime)):
+                return scratchPath
+
+        if not os.path.exists(self.scratchDir):
+            os.makedirs(self.scratchDir)
+
+        tempPath = "%s.%d.tmp" % (scratchPath, os.getpid())
+        shutil.copy2(texturePath, tempPath)
+        # Windows won't rename over an existing file
+        if platform.system() == 'Windows' and os.path.exists(scratchPath):
+            os.remove(scratchPath)
+        os.rename(tempPath, scratchPath)
+
+        self.copies.append(scratchPath)
+        return scratchPath
+
+    def _prefetchTextures(self):
+        while True:
+            texturePath = self.queue.get()
+            if texturePath is None:
+                break
+
+            try:
+                if self.scratchDir:
+                    localPath = self._copyTexture(texturePath)
+                else:
+                    localPath = self._warmTexture(texturePath)
+
+                with self.lock:
+                    self.ready[texturePath] = localPath
+                    self.bytesPrefetched += os.path.getsize(texturePath)
+            except Exception, e:
+                print( "Texture prefetch failed : %s - %s" % (texturePath, e) )
+                with self.lock:
+                    self.failures += 1
+
+    def remapSceneTextures(self, sceneElement):
+        textureMap = {}
+        with self.lock:
+            for texturePath in set(CyclesTextureCache.listSceneTextures(sceneElement)):
+                if texturePath in self.ready:
+                    textureMap[texturePath] = self.ready[texturePath]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+
+        CyclesTextureCache.remapSceneTextures(sceneElement, textureMap)
+        return textureMap
+
+    def frameStats(self):
+        # Counts are per frame, so they're reset once they've been reported
+        with self.lock:
+            stats = [('prefetchHits', self.hits),
+                     ('prefetchMisses', self.misses),
+                     ('prefetchBytes', self.bytesPrefetched),
+                     ('prefetchFailures', self.failures),
+                     ('prefetchPending', self.queue.qsize())]
+            self.hits = 0
+            self.misses = 0
+            self.bytesPrefetched = 0
+            self.failures = 0
+        return stats
+
+    def stop(self, removeCopies=False):
+        self.queue.put(None)
+        self.thread.join(5.0)
+
+        if removeCopies:
+            for scratchPath in self.copies:
+                try:
+                    if os.path.exists(scratchPath):
+                        os.remove(scratchPath)
+                except:
+                    print( "Error removing prefetched texture : %s" % scratchPath )
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import platform
+import socket
+import time
+
+from process import Process
+
+import CyclesProgress
+
+#
+# Time budgets
+#
+# A frame with a time budget picks its sample count from what a sample costs.
+# A short pilot render of the exported scene measures how long Cycles takes to
+# load the scene and how long each sample takes on this host, and the final
+# sample count is the number that fits in what's left of the budget, within
+# minimum and maximum bounds. Costs are cached by the scene's hash and the
+# host, so re-rendering the same scene skips the pilot. Once the frame has
+# rendered, its actual time replaces the pilot's estimate of the cost, and
+# the estimate, sample count and actual time are logged to check the model.
+#
+timeBudgetVersion = 1
+
+def getSceneHash(sceneFileName, includeFiles):
+    key = hashlib.sha1()
+    key.update("%d" % timeBudgetVersion)
+    for fileName in [sceneFileName] + sorted(includeFiles):
+        key.update("|%s|" % os.path.basename(fileName))
+        with open(fileName, 'rb') as sceneFile:
+            for block in iter(lambda: sceneFile.read(1 << 20), ''):
+                key.update(block)
+    return key.hexdigest()
+
+def getCostKey(sceneHash, cyclesPath, threads):
+    # A sample's cost depends on the host, the Cycles build and the threads it uses
+    key = hashlib.sha1()
+    key.update("%s|%s|%s|%d" % (sceneHash, socket.gethostname(), os.path.abspath(cyclesPath), threads))
+    return key.hexdigest()
+
+def chooseSamples(budgetSeconds, setupSeconds, secondsPerSample, minSamples, maxSamples):
+    if secondsPerSample > 0.0:
+        samples = int((budgetSeconds - setupSeconds)/secondsPerSample)
+    else:
+        samples = maxSamples
+    return max(minSamples, min(maxSamples, samples))
+
+def runPilot(cyclesPath, args, env, sceneFileName, imageName, pilotSamples):
+    # The pilot has the final render's arguments, threads included, apart from its samples and image
+    pilotImageName = "%s.pilot%s" % os.path.splitext(imageName)
+    pilotArgs = ['--samples', str(pilotSamples)]
+    pilotArgs.extend([{imageName : pilotImageName}.get(arg, arg) for arg in args])
+
+    # The progress reports time the sampling, leaving out the time Cycles takes
+    # to load the scene and to write the image and exit
+    progressReports = []
+    def pilotLogCallback(line):
+        progress = CyclesProgress.parseProgressLine(line)
+        if progress and 'fraction' in progress:
+            progressReports.append((time.time(), progress['fraction']))
+
+    pilot = Process(description='render a pilot image',
+        cmd=cyclesPath,
+        args=pilotArgs,
+        env=env)
+    pilot.echo = False
+    pilot.log_callback = pilotLogCallback
+
+    pilotStart = time.time()
+    pilot.execute()
+    pilotSeconds = time.time() - pilotStart
+
+    if os.path.exists(pilotImageName):
+        os.remove(pilotImageName)
+    if pilot.status != 0:
+        raise ValueError("The pilot render returned %s : %s" % (pilot.status, "\n".join(pilot.log[-5:])))
+
+    (firstTime, firstFraction) = progressReports[0] if progressReports else (None, 0.0)
+    (lastTime, lastFraction) = progressReports[-1] if progressReports else (None, 0.0)
+    if lastFraction - firstFraction > 0.0:
+        secondsPerSample = (lastTime - firstTime)/((lastFraction - firstFraction)*pilotSamples)
+        setupSeconds = max(0.0, firstTime - pilotStart - firstFraction*pilotSamples*secondsPerSample)
+    else:
+        # Without progress reports, the whole pilot counts as sampling, which
+        # overestimates a sample's cost and keeps the frame within its budget
+        secondsPerSample = pilotSeconds/pilotSamples
+        setupSeconds = 0.0
+
+    return {
+        'setupSeconds' : setupSeconds,
+        'secondsPerSample' : secondsPerSample,
+        'source' : "pilot",
+        'pilotSamples' : pilotSamples,
+        'pilotSeconds' : pilotSeconds
+    }
+
+class TimeBudget:
+    def __init__(self, cacheDir, budgetSeconds, minSamples=16, maxSamples=4096, pilotSamples=8):
+        self.cacheDir = cacheDir
+        self.budgetSeconds = budgetSeconds
+        self.minSamples = max(1, minSamples)
+        self.maxSamples = max(self.minSamples, maxSamples)
+        self.pilotSamples = max(1, pilotSamples)
+
+        self.costKey = None
+        self.cost = None
+        self.samples = None
+        self.estimatedSeconds = None
+        self.cached = False
+
+    def getCostPath(self):
+        return os.path.join(self.cacheDir, "%s.json" % self.costKey)
+
+    def loadCost(self):
+        try:
+            with open(self.getCostPath(), 'r') as costFile:
+                return json.load(costFile)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def saveCost(self):
+        if not os.path.exists(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                if not os.path.isdir(self.cacheDir):
+                    raise
+
+        # Written to a temporary file and renamed, as batch workers may share the cache
+        costPath = self.getCostPath()
+        tempPath = "%s.%d.tmp" % (costPath, os.getpid())
+        with open(tempPath, 'w') as costFile:
+            json.dump(self.cost, costFile, indent=2, sort_keys=True)
+        # Windows won't rename over an existing file
+        if platform.system() == 'Windows' and os.path.exists(costPath):
+            os.remove(costPath)
+        os.rename(tempPath, costPath)
+
+    def chooseSamples(self, cyclesPath, args, env, sceneFileName, imageName, includeFiles, threads=0):
+        # threads is the number that args gives Cycles, 0 for all of the cores
+        self.costKey = getCostKey(getSceneHash(sceneFileName, includeFiles), cyclesPath, threads)
+
+        self.cost = self.loadCost()
+        self.cached = self.cost is not None
+        if self.cached:
+            print( "Time budget - Cost from an earlier %s : %s" % (self.cost['source'], self.getCostPath()) )
+        else:
+            print( "Time budget - Rendering a %d sample pilot" % self.pilotSamples )
+            self.cost = runPilot(cyclesPath, args, env, sceneFileName, imageName, self.pilotSamples)
+            print( "Time budget - Pilot took %.2fs" % self.cost['pilotSeconds'] )
+            self.saveCost()
+
+        self.samples = chooseSamples(self.budgetSeconds, self.cost['setupSeconds'], self.cost['secondsPerSample'],
+            self.minSamples, self.maxSamples)
+        self.estimatedSeconds = self.cost['setupSeconds'] + self.samples*self.cost['secondsPerSample']
+
+        print( "Time budget - Setup %.2fs, %.4fs a sample" % (self.cost['setupSeconds'], self.cost['secondsPerSample']) )
+        print( "Time budget - %d samples, estimated %.1fs of a %.1fs budget" % (self.samples,
+            self.estimatedSeconds, self.budgetSeconds) )
+        return self.samples
+
+    def recordRender(self, seconds, succeeded=True, updateCost=True):
+        error = (seconds - self.estimatedSeconds)/self.estimatedSeconds if self.estimatedSeconds else 0.0
+        print( "Time budget - %d samples took %.1fs, estimated %.1fs (%+.0f%%), budget %.1fs" % (self.samples,
+            seconds, self.estimatedSeconds, error*100.0, self.budgetSeconds) )
+
+        record = {
+            'time' : time.time(),
+            'host' : socket.gethostname(),
+            'costKey' : self.costKey,
+            'cached' : self.cached,
+            'budgetSeconds' : self.budgetSeconds,
+            'samples' : self.samples,
+            'estimatedSeconds' : self.estimatedSeconds,
+            'actualSeconds' : seconds,
+            'succeeded' : succeeded
+        }
+        try:
+            with open(os.path.join(self.cacheDir, "timeBudget.log"), 'a') as logFile:
+                logFile.write(json.dumps(record, sort_keys=True) + "\n")
+        except (IOError, OSError), e:
+            print( "Time budget - Unable to log the render : %s" % e )
+
+        # The full render is a better measure of the cost than the pilot
+        if updateCost and succeeded and seconds > self.cost['setupSeconds']:
+            self.cost['secondsPerSample'] = (seconds - self.cost['setupSeconds'])/self.samples
+            self.cost['source'] = "render"
+            try:
+                self.saveCost()
+            except (IOError, OSError), e:
+                print( "Time budget - Unable to save the cost : %s" % e )
+
+    def getProcessKeys(self):
+        return [('timeBudget', self.budgetSeconds),
+                ('timeBudgetSamples', self.samples),
+                ('timeBudgetEstimate', "%.2f" % self.estimatedSeconds),
+                ('timeBudgetCostSource', self.cost['source'])]
@@ -0,0 +1,1077 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Image post-processing done in-process, without launching a tool per image.
+Rendered regions are placed back into full resolution frames, and images
+rendered in passes are averaged, by streaming their rows, for the formats
+where that's possible, and written atomically. Other formats fall back to
+oiiotool. The noise of images rendered in two independent halves is
+estimated from their difference, and channels are extracted to their own
+images for tools that read them separately.
+"""
+
+from __future__ import division
+
+import array
+import ast
+import math
+import optparse
+import os
+import platform
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from process import Process
+
+# OpenEXR files need the optional Python binding. Without it, they go through
+# oiiotool.
+try:
+    import OpenEXR
+    import Imath
+except ImportError:
+    OpenEXR = None
+    Imath = None
+
+__author__ = 'Haarm-Pieter Duiker'
+__copyright__ = 'Copyright (C) 2015 - Duiker Research Corp'
+__license__ = ''
+__maintainer__ = 'Haarm-Pieter Duiker'
+__email__ = 'support@duikerresearch.org'
+__status__ = 'Production'
+
+__all__ = ['read_pfm_header',
+           'read_npy_header',
+           'write_npy_header',
+           'expand_pfm',
+           'expand_npy',
+           'expand_exr',
+           'expand_oiiotool',
+           'reset_data_window',
+           'merge_pfm',
+           'merge_npy',
+           'merge_exr',
+           'merge_oiiotool',
+           'merge_images',
+           'extract_channels',
+           'estimate_noise',
+           'main']
+
+NPY_MAGIC = '\x93NUMPY'
+
+
+def _partial_path(path):
+    (base, extension) = os.path.splitext(path)
+    return '%s.%d.partial%s' % (base, os.getpid(), extension)
+
+
+def _replace(partial_path, path):
+    # Windows won't rename over an existing file. Elsewhere the rename
+    # replaces it, so there's always a whole image at the path.
+    if platform.system() == 'Windows' and os.path.exists(path):
+        os.remove(path)
+    os.rename(partial_path, path)
+
+
+def _read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise ValueError('Truncated image : %s' % fp.name)
+    return data
+
+
+def _get_span(offset, size, full_size):
+    """
+    Returns the part of a row or column of *size* pixels placed at *offset*
+    that falls inside *full_size* pixels, as *(first, last, position)*.
+    """
+
+    first = max(0, -offset)
+    last = max(first, min(size, full_size - offset))
+    return (first, last, offset + first)
+
+
+def _expand_rows(read_row, rows, row_order, width, full_width, full_height,
+                 x, y, pixel_bytes):
+    """
+    Yields the rows of a full frame, in the order they are stored, given a
+    function that reads the next stored row of the region.
+    """
+
+    (first, last, position) = _get_span(x, width, full_width)
+    left_pad = '\0' * (position * pixel_bytes)
+    right_pad = '\0' * ((full_width - position - (last - first)) * pixel_bytes)
+    empty_row = '\0' * (full_width * pixel_bytes)
+
+    (first_row, last_row, _) = _get_span(y, rows, full_height)
+    region_row = 0
+
+    for stored_row in range(full_height):
+        # Row from the top of the frame
+        if row_order == 'bottom_up':
+            row = full_height - 1 - stored_row
+        else:
+            row = stored_row
+
+        source_row = row - y
+        if first_row <= source_row < last_row:
+            # The region's rows are stored in the same order, so they're read
+            # in sequence, skipping the ones outside the frame
+            if row_order == 'bottom_up':
+                wanted = rows - 1 - source_row
+            else:
+                wanted = source_row
+            data = None
+            while region_row <= wanted:
+                data = read_row()
+                region_row += 1
+            yield (left_pad +
+                   data[first * pixel_bytes:last * pixel_bytes] +
+                   right_pad)
+        else:
+            yield empty_row
+
+
+def read_pfm_header(fp):
+    """
+    Reads the header of a Portable Float Map.
+
+    Parameters
+    ----------
+    fp : file
+        The file, positioned at its start.
+
+    Returns
+    -------
+    tuple
+         The *(channels, width, height, scale)* of the image. *scale* is the
+         header's line as written, its sign giving the byte order.
+    """
+
+    identifier = fp.readline().strip()
+    if identifier == 'PF':
+        channels = 3
+    elif identifier == 'Pf':
+        channels = 1
+    else:
+        raise ValueError('Not a Portable Float Map : %s' % fp.name)
+
+    dimensions = fp.readline().split()
+    (width, height) = (int(dimensions[0]), int(dimensions[1]))
+    scale = fp.readline().strip()
+    float(scale)
+
+    return (channels, width, height, scale)
+
+
+def read_npy_header(fp):
+    """
+    Reads the header of a NumPy array file.
+
+    Parameters
+    ----------
+    fp : file
+        The file, positioned at its start.
+
+    Returns
+    -------
+    tuple
+         The *(descr, fortran_order, shape, itemsize)* of the array.
+    """
+
+    if fp.read(6) != NPY_MAGIC:
+        raise ValueError('Not a NumPy array file : %s' % fp.name)
+
+    major = ord(_read_exactly(fp, 1))
+    _read_exactly(fp, 1)
+    if major == 1:
+        (length,) = struct.unpack('<H', _read_exactly(fp, 2))
+    else:
+        (length,) = struct.unpack('<I', _read_exactly(fp, 4))
+
+    header = ast.literal_eval(_read_exactly(fp, length))
+    descr = header['descr']
+
+    # Only plain numeric types have a fixed item size that can be read here
+    match = re.match(r'^[<>|=][a-z](\d+)$', str(descr))
+    itemsize = int(match.group(1)) if match else None
+
+    return (descr, header['fortran_order'], tuple(header['shape']), itemsize)
+
+
+def write_npy_header(fp, descr, shape):
+    """
+    Writes a version 1.0 NumPy array file header.
+
+    Parameters
+    ----------
+    fp : file
+        The file to write to.
+    descr : unicode
+        The array's type description, as read by *read_npy_header*.
+    shape : tuple
+        The array's shape.
+    """
+
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        str(descr), tuple(shape))
+
+    # The data starts on a 64 byte boundary
+    padding = 64 - (len(NPY_MAGIC) + 4 + len(header) + 1) % 64
+    header += ' ' * padding + '\n'
+
+    fp.write(NPY_MAGIC + '\x01\x00')
+    fp.write(struct.pack('<H', len(header)))
+    fp.write(header)
+
+
+def expand_pfm(image_path, width, height, x, y):
+    """
+    Places a Portable Float Map region into a full frame, streaming the
+    region a row at a time.
+
+    Parameters
+    ----------
+    image_path : str
+        The region image, replaced by the full frame.
+    width : int
+        The width of the full frame.
+    height : int
+        The height of the full frame.
+    x : int
+        The position of the region's left edge, in pixels from the left.
+    y : int
+        The position of the region's top edge, in pixels from the top.
+    """
+
+    partial_path = _partial_path(image_path)
+    try:
+        with open(image_path, 'rb') as source:
+            (channels, region_width, region_height,
+             scale) = read_pfm_header(source)
+            pixel_bytes = 4 * channels
+            row_bytes = region_width * pixel_bytes
+
+            # Rows are stored from the bottom up. Zeros are zeros in either
+            # byte order, so the data is copied as is.
+            with open(partial_path, 'wb') as target:
+                target.write('%s\n%d %d\n%s\n' % (
+                    'PF' if channels == 3 else 'Pf', width, height, scale))
+                for row in _expand_rows(
+                        lambda: _read_exactly(source, row_bytes),
+                        region_height, 'bottom_up', region_width,
+                        width, height, x, y, pixel_bytes):
+                    target.write(row)
+
+        _replace(partial_path, image_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def expand_npy(image_path, width, height, x, y):
+    """
+    Places a NumPy array region, shaped *(rows, columns)* or
+    *(rows, columns, channels)*, into a full frame, streaming the region a row
+    at a time.
+
+    Parameters
+    ----------
+    image_path : str
+        The region image, replaced by the full frame.
+    width : int
+        The width of the full frame.
+    height : int
+        The height of the full frame.
+    x : int
+        The position of the region's left edge, in pixels from the left.
+    y : int
+        The position of the region's top edge, in pixels from the top.
+    """
+
+    partial_path = _partial_path(image_path)
+    try:
+        with open(image_path, 'rb') as source:
+            (descr, fortran_order, shape, itemsize) = read_npy_header(source)
+            if fortran_order or itemsize is None or len(shape) not in [2, 3]:
+                raise ValueError('Unsupported NumPy array layout : %s' % (
+                    image_path))
+
+            channels = shape[2] if len(shape) == 3 else 1
+            pixel_bytes = itemsize * channels
+            row_bytes = shape[1] * pixel_bytes
+
+            with open(partial_path, 'wb') as target:
+                write_npy_header(target, descr,
+                                 (height, width) + tuple(shape[2:]))
+                for row in _expand_rows(
+                        lambda: _read_exactly(source, row_bytes),
+                        shape[0], 'top_down', shape[1],
+                        width, height, x, y, pixel_bytes):
+                    target.write(row)
+
+        _replace(partial_path, image_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def expand_exr(image_path, width, height, x, y):
+    """
+    Places an OpenEXR region into a full frame, through the OpenEXR binding.
+    The region's data window is kept relative to *x* and *y*, and the full
+    frame's data and display windows both cover the frame.
+
+    Parameters
+    ----------
+    image_path : str
+        The region image, replaced by the full frame.
+    width : int
+        The width of the full frame.
+    height : int
+        The height of the full frame.
+    x : int
+        The position of the region's left edge, in pixels from the left.
+    y : int
+        The position of the region's top edge, in pixels from the top.
+    """
+
+    if OpenEXR is None:
+        raise ValueError('The OpenEXR binding isn\'t available')
+
+    source = OpenEXR.InputFile(image_path)
+    header = source.header()
+    data_window = header['dataWindow']
+    region_width = data_window.max.x - data_window.min.x + 1
+    region_height = data_window.max.y - data_window.min.y + 1
+
+    half = Imath.PixelType(Imath.PixelType.HALF)
+    pixels = {}
+    for (name, channel) in header['channels'].items():
+        if channel.xSampling != 1 or channel.ySampling != 1:
+            raise ValueError('Unsupported subsampled channel : %s' % name)
+
+        pixel_bytes = 2 if channel.type == half else 4
+        data = source.channel(name)
+        rows = [data[i:i + region_width * pixel_bytes]
+                for i in range(0, len(data), region_width * pixel_bytes)]
+        rows.reverse()
+
+        pixels[name] = ''.join(_expand_rows(
+            rows.pop, region_height, 'top_down', region_width,
+            width, height, x + data_window.min.x, y + data_window.min.y,
+            pixel_bytes))
+    source.close()
+
+    frame = Imath.Box2i(Imath.V2i(0, 0), Imath.V2i(width - 1, height - 1))
+    header['dataWindow'] = frame
+    header['displayWindow'] = frame
+    header.pop('tiles', None)
+
+    partial_path = _partial_path(image_path)
+    try:
+        target = OpenEXR.OutputFile(partial_path, header)
+        target.writePixels(pixels)
+        target.close()
+
+        _replace(partial_path, image_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def expand_oiiotool(image_path, width, height, x, y, oiiotool_path):
+    """
+    Places a region into a full frame with oiiotool.
+
+    Parameters
+    ----------
+    image_path : str
+        The region image, replaced by the full frame.
+    width : int
+        The width of the full frame.
+    height : int
+        The height of the full frame.
+    x : int
+        The position of the region's left edge, in pixels from the left.
+    y : int
+        The position of the region's top edge, in pixels from the top.
+    oiiotool_path : str
+        The oiiotool executable.
+    """
+
+    if not oiiotool_path:
+        raise ValueError('No oiiotool path to fall back to')
+
+    partial_path = _partial_path(image_path)
+    try:
+        crop_args = '%dx%d-%d-%d' % (width, height, x, y)
+        oiiotool = Process(description='reset image data window',
+                           cmd=oiiotool_path,
+                           args=['-v', image_path, '--crop', crop_args,
+                                 '--noautocrop', '-o', partial_path])
+        oiiotool.echo = False
+        oiiotool.execute()
+
+        if oiiotool.status != 0 or not os.path.exists(partial_path):
+            raise ValueError('oiiotool returned %s : %s' % (
+                oiiotool.status, '\n'.join(oiiotool.log[-5:])))
+
+        _replace(partial_path, image_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def reset_data_window(image_path, width, height, x, y, oiiotool_path=None,
+                      use_oiiotool=False):
+    """
+    Places a rendered region into a full frame, replacing the region image.
+    The region is streamed in-process where its format allows, and run
+    through oiiotool otherwise.
+
+    Parameters
+    ----------
+    image_path : str
+        The region image, replaced by the full frame.
+    width : int
+        The width of the full frame.
+    height : int
+        The height of the full frame.
+    x : int
+        The position of the region's left edge, in pixels from the left.
+    y : int
+        The position of the region's top edge, in pixels from the top.
+    oiiotool_path : str
+        The oiiotool executable, for formats that can't be handled here.
+    use_oiiotool : bool
+        Whether to always use oiiotool.
+
+    Returns
+    -------
+    str
+         How the image was processed : *pfm*, *npy*, *exr* or *oiiotool*.
+    """
+
+    extension = os.path.splitext(image_path)[1].lower()
+
+    if not use_oiiotool:
+        if extension == '.pfm':
+            expand_pfm(image_path, width, height, x, y)
+            return 'pfm'
+        elif extension == '.npy':
+            expand_npy(image_path, width, height, x, y)
+            return 'npy'
+        elif extension == '.exr' and OpenEXR is not None:
+            expand_exr(image_path, width, height, x, y)
+            return 'exr'
+
+    expand_oiiotool(image_path, width, height, x, y, oiiotool_path)
+    return 'oiiotool'
+
+
+def _get_weights(weights, count):
+    if len(weights) != count:
+        raise ValueError('Expected %d weights, got %d' % (count, len(weights)))
+    total = sum(weights)
+    if total <= 0:
+        raise ValueError('The weights don\'t add up to more than 0')
+    return [weight / total for weight in weights]
+
+
+def _merge_rows(sources, weights, rows, row_bytes, target, typecode, swap):
+    """
+    Writes the weighted average of the rows of a number of sources, given as
+    *(fp, typecode, swap)*, with *swap* whether the values need their bytes
+    swapped to and from the native byte order.
+    """
+
+    for row in range(rows):
+        total = None
+        for ((fp, source_typecode, source_swap), weight) in zip(sources,
+                                                                 weights):
+            values = array.array(source_typecode)
+            values.fromstring(_read_exactly(fp, row_bytes))
+            if source_swap:
+                values.byteswap()
+
+            if total is None:
+                total = [weight * value for value in values]
+            else:
+                total = [accumulated + weight * value for (accumulated, value)
+                         in zip(total, values)]
+
+        merged = array.array(typecode, total)
+        if swap:
+            merged.byteswap()
+        target.write(merged.tostring())
+
+
+def merge_pfm(image_paths, weights, output_path):
+    """
+    Writes the weighted average of a number of Portable Float Maps of the same
+    size, streaming them a row at a time.
+
+    Parameters
+    ----------
+    image_paths : list
+        The images.
+    weights : list
+        The weight of each image, a number of samples for example.
+    output_path : str
+        The averaged image, written in little-endian byte order.
+    """
+
+    weights = _get_weights(weights, len(image_paths))
+    native_little = sys.byteorder == 'little'
+
+    partial_path = _partial_path(output_path)
+    sources = []
+    try:
+        layout = None
+        for image_path in image_paths:
+            fp = open(image_path, 'rb')
+            sources.append((fp, 'f', None))
+            (channels, width, height, scale) = read_pfm_header(fp)
+            if layout is None:
+                layout = (channels, width, height)
+            elif layout != (channels, width, height):
+                raise ValueError('Image size doesn\'t match : %s' % image_path)
+            # A negative scale marks little-endian data
+            sources[-1] = (fp, 'f', (float(scale) < 0) != native_little)
+
+        (channels, width, height) = layout
+        with open(partial_path, 'wb') as target:
+            target.write('%s\n%d %d\n-1.0\n' % (
+                'PF' if channels == 3 else 'Pf', width, height))
+            _merge_rows(sources, weights, height, width * channels * 4,
+                        target, 'f', not native_little)
+
+        # The output may be one of the images
+        for (fp, typecode, swap) in sources:
+            fp.close()
+        _replace(partial_path, output_path)
+    finally:
+        for (fp, typecode, swap) in sources:
+            fp.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def merge_npy(image_paths, weights, output_path):
+    """
+    Writes the weighted average of a number of NumPy float arrays of the same
+    shape, streaming them a row at a time.
+
+    Parameters
+    ----------
+    image_paths : list
+        The images.
+    weights : list
+        The weight of each image, a number of samples for example.
+    output_path : str
+        The averaged image, written with the first image's type.
+    """
+
+    weights = _get_weights(weights, len(image_paths))
+    native_order = '<' if sys.byteorder == 'little' else '>'
+    typecodes = {4: 'f', 8: 'd'}
+
+    partial_path = _partial_path(output_path)
+    sources = []
+    try:
+        layout = None
+        for image_path in image_paths:
+            fp = open(image_path, 'rb')
+            sources.append((fp, None, None))
+            (descr, fortran_order, shape, itemsize) = read_npy_header(fp)
+            if (fortran_order or len(shape) not in [2, 3] or
+                    str(descr)[1:2] != 'f' or itemsize not in typecodes):
+                raise ValueError('Unsupported NumPy array layout : %s' % (
+                    image_path))
+            if layout is None:
+                layout = (descr, shape, itemsize)
+            elif layout[1:] != (shape, itemsize):
+                raise ValueError('Image layout doesn\'t match : %s' % (
+                    image_path))
+            sources[-1] = (fp, typecodes[itemsize],
+                           str(descr)[0] not in [native_order, '=', '|'])
+
+        (descr, shape, itemsize) = layout
+        channels = shape[2] if len(shape) == 3 else 1
+        with open(partial_path, 'wb') as target:
+            write_npy_header(target, descr, shape)
+            _merge_rows(sources, weights, shape[0],
+                        shape[1] * channels * itemsize, target,
+                        typecodes[itemsize], sources[0][2])
+
+        # The output may be one of the images
+        for (fp, typecode, swap) in sources:
+            fp.close()
+        _replace(partial_path, output_path)
+    finally:
+        for (fp, typecode, swap) in sources:
+            fp.close()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def merge_exr(image_paths, weights, output_path):
+    """
+    Writes the weighted average of a number of OpenEXR images with the same
+    channels and data window, through the OpenEXR binding. The average is
+    written as 32 bit float channels.
+
+    Parameters
+    ----------
+    image_paths : list
+        The images.
+    weights : list
+        The weight of each image, a number of samples for example.
+    output_path : str
+        The averaged image.
+    """
+
+    if OpenEXR is None:
+        raise ValueError('The OpenEXR binding isn\'t available')
+
+    weights = _get_weights(weights, len(image_paths))
+    float_type = Imath.PixelType(Imath.PixelType.FLOAT)
+
+    header = None
+    totals = {}
+    for (image_path, weight) in zip(image_paths, weights):
+        source = OpenEXR.InputFile(image_path)
+        source_header = source.header()
+        if header is None:
+            header = source_header
+        elif (sorted(source_header['channels'].keys()) !=
+              sorted(header['channels'].keys()) or
+              str(source_header['dataWindow']) != str(header['dataWindow'])):
+            raise ValueError('Image layout doesn\'t match : %s' % image_path)
+
+        for name in header['channels'].keys():
+            values = array.array('f')
+            values.fromstring(source.channel(name, float_type))
+            if name not in totals:
+                totals[name] = [weight * value for value in values]
+            else:
+                totals[name] = [accumulated + weight * value for
+                                (accumulated, value) in
+                                zip(totals[name], values)]
+        source.close()
+
+    header['channels'] = dict([(name, Imath.Channel(float_type))
+                               for name in totals.keys()])
+
+    partial_path = _partial_path(output_path)
+    try:
+        target = OpenEXR.OutputFile(partial_path, header)
+        target.writePixels(dict([(name, array.array('f', total).tostring())
+                                 for (name, total) in totals.items()]))
+        target.close()
+
+        _replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def merge_oiiotool(image_paths, weights, output_path, oiiotool_path):
+    """
+    Writes the weighted average of a number of images with oiiotool.
+
+    Parameters
+    ----------
+    image_paths : list
+        The images.
+    weights : list
+        The weight of each image, a number of samples for example.
+    output_path : str
+        The averaged image.
+    oiiotool_path : str
+        The oiiotool executable.
+    """
+
+    if not oiiotool_path:
+        raise ValueError('No oiiotool path to fall back to')
+
+    weights = _get_weights(weights, len(image_paths))
+
+    args = ['-v']
+    for (i, (image_path, weight)) in enumerate(zip(image_paths, weights)):
+        args.extend([image_path, '--mulc', repr(weight)])
+        if i > 0:
+            args.append('--add')
+
+    partial_path = _partial_path(output_path)
+    try:
+        oiiotool = Process(description='merge images',
+                           cmd=oiiotool_path,
+                           args=args + ['-o', partial_path])
+        oiiotool.echo = False
+        oiiotool.execute()
+
+        if oiiotool.status != 0 or not os.path.exists(partial_path):
+            raise ValueError('oiiotool returned %s : %s' % (
+                oiiotool.status, '\n'.join(oiiotool.log[-5:])))
+
+        _replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def merge_images(image_paths, weights, output_path, oiiotool_path=None,
+                 use_oiiotool=False):
+    """
+    Writes the weighted average of a number of images of the same size and
+    format. Images rendered with different seeds and sample counts, averaged
+    with their sample counts as weights, match an image rendered with all of
+    the samples. Float images are merged in-process where their format
+    allows, and with oiiotool otherwise.
+
+    Parameters
+    ----------
+    image_paths : list
+        The images.
+    weights : list
+        The weight of each image, a number of samples for example.
+    output_path : str
+        The averaged image. It may be one of the images.
+    oiiotool_path : str
+        The oiiotool executable, for formats that can't be handled here.
+    use_oiiotool : bool
+        Whether to always use oiiotool.
+
+    Returns
+    -------
+    str
+         How the images were merged : *pfm*, *npy*, *exr* or *oiiotool*.
+    """
+
+    extension = os.path.splitext(output_path)[1].lower()
+
+    if not use_oiiotool:
+        if extension == '.pfm':
+            merge_pfm(image_paths, weights, output_path)
+            return 'pfm'
+        elif extension == '.npy':
+            merge_npy(image_paths, weights, output_path)
+            return 'npy'
+        elif extension == '.exr' and OpenEXR is not None:
+            merge_exr(image_paths, weights, output_path)
+            return 'exr'
+
+    merge_oiiotool(image_paths, weights, output_path, oiiotool_path)
+    return 'oiiotool'
+
+
+def _open_float_rows(image_path):
+    """
+    Returns the *(width, height, channels, read_rows)* of a float image, with
+    *read_rows(stride)* yielding every *stride*th row as an array of
+    interleaved channel values.
+    """
+
+    extension = os.path.splitext(image_path)[1].lower()
+    native_little = sys.byteorder == 'little'
+
+    if extension == '.pfm':
+        with open(image_path, 'rb') as fp:
+            (channels, width, height, scale) = read_pfm_header(fp)
+            offset = fp.tell()
+        swap = (float(scale) < 0) != native_little
+        typecode = 'f'
+        itemsize = 4
+
+    elif extension == '.npy':
+        typecodes = {4: 'f', 8: 'd'}
+        with open(image_path, 'rb') as fp:
+            (descr, fortran_order, shape, itemsize) = read_npy_header(fp)
+            offset = fp.tell()
+        if (fortran_order or len(shape) not in [2, 3] or
+                str(descr)[1:2] != 'f' or itemsize not in typecodes):
+            raise ValueError('Unsupported NumPy array layout : %s' % (
+                image_path))
+        (height, width) = shape[:2]
+        channels = shape[2] if len(shape) == 3 else 1
+        swap = str(descr)[0] not in ['<' if native_little else '>', '=', '|']
+        typecode = typecodes[itemsize]
+
+    elif extension == '.exr' and OpenEXR is not None:
+        source = OpenEXR.InputFile(image_path)
+        header = source.header()
+        window = header['dataWindow']
+        width = window.max.x - window.min.x + 1
+        height = window.max.y - window.min.y + 1
+
+        names = [name for name in ['R', 'G', 'B']
+                 if name in header['channels']]
+        if not names:
+            names = sorted(header['channels'].keys())[:3]
+        channels = len(names)
+
+        float_type = Imath.PixelType(Imath.PixelType.FLOAT)
+        planes = []
+        for name in names:
+            values = array.array('f')
+            values.fromstring(source.channel(name, float_type))
+            planes.append(values)
+        source.close()
+
+        def read_exr_rows(stride):
+            for row in range(0, height, stride):
+                values = array.array('f', [0.0]) * (width * channels)
+                for (channel, plane) in enumerate(planes):
+                    values[channel::channels] = plane[row * width:
+                                                      (row + 1) * width]
+                yield values
+
+        return (width, height, channels, read_exr_rows)
+
+    else:
+        raise ValueError('Unsupported image format : %s' % image_path)
+
+    row_bytes = width * channels * itemsize
+
+    def read_rows(stride):
+        with open(image_path, 'rb') as fp:
+            fp.seek(offset)
+            for row in range(height):
+                if row % stride:
+                    fp.seek(row_bytes, 1)
+                    continue
+                values = array.array(typecode)
+                values.fromstring(_read_exactly(fp, row_bytes))
+                if swap:
+                    values.byteswap()
+                yield values
+
+    return (width, height, channels, read_rows)
+
+
+def extract_channels(image_path, output_path, channels, oiiotool_path):
+    """
+    Writes some of the channels of an image to another image with oiiotool,
+    in the format given by its extension.
+
+    Parameters
+    ----------
+    image_path : str
+        The image.
+    output_path : str
+        The image with the channels.
+    channels : str
+        The channels, separated by commas, as oiiotool's *--ch* takes them.
+    oiiotool_path : str
+        The oiiotool executable.
+    """
+
+    if not oiiotool_path:
+        raise ValueError('No oiiotool path to extract channels with')
+
+    partial_path = _partial_path(output_path)
+    try:
+        oiiotool = Process(description='extract channels',
+                           cmd=oiiotool_path,
+                           args=['-v', image_path, '--ch', channels,
+                                 '-o', partial_path])
+        oiiotool.echo = False
+        oiiotool.execute()
+
+        if oiiotool.status != 0 or not os.path.exists(partial_path):
+            raise ValueError('oiiotool returned %s : %s' % (
+                oiiotool.status, '\n'.join(oiiotool.log[-5:])))
+
+        _replace(partial_path, output_path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def estimate_noise(first_path, second_path, oiiotool_path=None,
+                   max_pixels=262144, black_level=0.01):
+    """
+    Estimates the noise of the average of two images of the same size,
+    rendered with the same number of samples and independent seeds. Each
+    pixel's variance is estimated from the difference of the two as
+    *(a - b)^2 / 4*, and its noise is its standard deviation relative to
+    its value. Images with more pixels than *max_pixels* are sampled on an
+    even grid.
+
+    Parameters
+    ----------
+    first_path : str
+        The first image.
+    second_path : str
+        The second image.
+    oiiotool_path : str
+        The oiiotool executable, to convert formats that can't be read here.
+    max_pixels : int
+        The largest number of pixels to estimate the noise of.
+    black_level : float
+        Added to the pixel values the noise is relative to, so the noise of
+        pixels near black doesn't dominate.
+
+    Returns
+    -------
+    list
+         The noise of each pixel estimated, in no particular order.
+    """
+
+    temp_dir = None
+    try:
+        try:
+            first = _open_float_rows(first_path)
+            second = _open_float_rows(second_path)
+        except ValueError:
+            # Converted to Portable Float Maps first
+            temp_dir = tempfile.mkdtemp(prefix='imagefile_')
+            converted = []
+            for (i, image_path) in enumerate([first_path, second_path]):
+                converted.append(os.path.join(temp_dir, 'half%d.pfm' % i))
+                extract_channels(image_path, converted[-1], 'R,G,B',
+                                 oiiotool_path)
+            first = _open_float_rows(converted[0])
+            second = _open_float_rows(converted[1])
+
+        (width, height, channels, read_first) = first
+        if second[:3] != (width, height, channels):
+            raise ValueError('Image size doesn\'t match : %s' % second_path)
+        read_second = second[3]
+
+        stride = max(1, int(math.ceil(math.sqrt(
+            width * height / max(1, max_pixels)))))
+        colors = min(3, channels)
+        scale = 1.0 / (2 * colors)
+
+        noise = []
+        for (first_row, second_row) in zip(read_first(stride),
+                                           read_second(stride)):
+            for start in range(0, width * channels, stride * channels):
+                difference = 0.0
+                level = 0.0
+                for i in range(start, start + colors):
+                    (a, b) = (first_row[i], second_row[i])
+                    difference += (a - b) * (a - b)
+                    level += a + b
+                noise.append(math.sqrt(difference * scale * 0.5) /
+                             (abs(level) * scale + black_level))
+        return noise
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, True)
+
+
+def _write_test_region(image_path, width, height):
+    pixel = struct.pack('<fff', 0.18, 0.5, 1.0)
+    if image_path.endswith('.npy'):
+        with open(image_path, 'wb') as fp:
+            write_npy_header(fp, '<f4', (height, width, 3))
+            fp.write(pixel * (width * height))
+    else:
+        with open(image_path, 'wb') as fp:
+            fp.write('PF\n%d %d\n-1.0\n' % (width, height))
+            fp.write(pixel * (width * height))
+
+
+def main():
+    """
+    Places region images given on the command line into full frames, merges
+    them, estimates the noise of two halves, or benchmarks the in-process
+    path against oiiotool.
+    """
+
+    p = optparse.OptionParser(description='Region image post-processing',
+                              prog='imagefile',
+                              version='imagefile 0.1',
+                              usage='%prog [options] [image ...]')
+    p.add_option('--width', '-w', type='int', default=1920)
+    p.add_option('--height', '-H', type='int', default=1080)
+    p.add_option('--x', '-x', type='int', default=0)
+    p.add_option('--y', '-y', type='int', default=0)
+    p.add_option('--oiiotool', '-o', default=None)
+    p.add_option('--benchmark', '-b', type='int', default=0,
+                 help='Times this many runs of each path on test regions')
+    p.add_option('--region', '-r', default='960x540',
+                 help='The size of the benchmark regions')
+    p.add_option('--merge', '-m', default=None,
+                 help='Writes the weighted average of the images here')
+    p.add_option('--weights', default=None,
+                 help='The weight of each merged image, separated by commas')
+    p.add_option('--noise', '-n', action='store_true', default=False,
+                 help='Estimates the noise of the average of two images')
+
+    options, arguments = p.parse_args()
+
+    if options.benchmark:
+        (region_width, region_height) = map(int, options.region.split('x'))
+        benchmark_dir = tempfile.mkdtemp(prefix='imagefile_')
+        try:
+            paths = [('in-process', '.pfm', False),
+                     ('in-process', '.npy', False)]
+            if options.oiiotool:
+                paths.append(('oiiotool', '.pfm', True))
+
+            for (method, extension, use_oiiotool) in paths:
+                source_path = os.path.join(benchmark_dir,
+                                           'region%s' % extension)
+                image_path = os.path.join(benchmark_dir,
+                                          'frame%s' % extension)
+                _write_test_region(source_path, region_width, region_height)
+
+                seconds = 0
+                for i in range(options.benchmark):
+                    shutil.copy(source_path, image_path)
+                    start = time.time()
+                    reset_data_window(image_path, options.width,
+                                      options.height, options.x, options.y,
+                                      options.oiiotool, use_oiiotool)
+                    seconds += time.time() - start
+
+                print('%-10s %s : %.4f seconds per image' % (
+                    method, extension, seconds / options.benchmark))
+        finally:
+            shutil.rmtree(benchmark_dir, True)
+        return 0
+
+    if not arguments:
+        p.print_help()
+        return 1
+
+    if options.noise:
+        if len(arguments) != 2:
+            p.error('--noise takes two images')
+        noise = sorted(estimate_noise(arguments[0], arguments[1],
+                                      options.oiiotool))
+        for percentile in [50, 90, 95, 99]:
+            index = min(len(noise) - 1, len(noise) * percentile // 100)
+            print('%d%% of pixels : noise %.4f or less' % (percentile,
+                                                           noise[index]))
+        return 0
+
+    if options.merge:
+        if options.weights:
+            weights = map(float, options.weights.split(','))
+        else:
+            weights = [1.0] * len(arguments)
+        method = merge_images(arguments, weights, options.merge,
+                              options.oiiotool)
+        print('%s : %s' % (options.merge, method))
+        return 0
+
+    for image_path in arguments:
+        method = reset_data_window(image_path, options.width, options.height,
+                                   options.x, options.y, options.oiiotool)
+        print('%s : %s' % (image_path, method))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,12 +8,17 @@ a process or a list of other process wrappers which carry such data.
 
 from __future__ import division
 
+import collections
 import datetime
 import math
 import os
 import optparse
 import platform
+import re
+import signal
 import sys
+import tempfile
+import time
 import traceback
 
 try:
@@ -34,6 +39,9 @@ __all__ = ['read_text',
            'ProcessList',
            'main']
 
+# Set in the environment of processes started in a process group of their own
+PROCESS_GROUP_VARIABLE = 'PROCESS_GROUP_LEADER'
+
 
 def read_text(text_file):
     """
@@ -88,20 +96,23 @@ def write_text(text, text_file):
 # Class definition and use based on post
 # http://eyalarubas.com/python-subproc-nonblock.html
 #
-from threading import Thread
+from threading import Thread, Event, Lock
 from Queue import Queue, Empty
 
 class NonBlockingStreamReader:
 
-    def __init__(self, stream, streamEndCallback=None):
+    def __init__(self, stream, streamEndCallback=None, lineCallback=None):
         '''
         stream: the stream to read from.
                 Usually a process' stdout or stderr.
+        lineCallback: called with each line as it is read, instead of
+                      queueing it.
         '''
 
         self._s = stream
         self._q = Queue()
         self._streamEndCallback = streamEndCallback
+        self._ended = Event()
 
         def _populateQueue(stream, queue, streamEndCallback):
             '''
@@ -114,9 +125,15 @@ class NonBlockingStreamReader:
             while True:
                 line = stream.readline()
                 if line:
-                    queue.put(line)
+                    if lineCallback:
+                        lineCallback(line)
+                    else:
+                        queue.put(line)
                 else:
                     #raise UnexpectedEndOfStream
+                    # Wakes a reader waiting on a stream that has ended
+                    self._ended.set()
+                    queue.put(None)
                     if streamEndCallback:
                         streamEndCallback(stream, self)
                     break
@@ -126,9 +143,12 @@ class NonBlockingStreamReader:
         self._t.daemon = True
         self._t.start() #start collecting lines from the stream
 
+    def ended(self):
+        return self._ended.is_set()
+
     def readline(self, timeout=None):
         try:
-            line = self._q.get(block = timeout is not None,
+            line = self._q.get(block = timeout is not None and not self.ended(),
                     timeout = timeout)
             return line
         except Empty:
@@ -179,6 +199,20 @@ class Process:
         self.end = None
         self.log = []
         self.echo = True
+
+        # With a tail length, the output is spooled to a temporary file as it
+        # arrives and *log* only keeps the last lines. The full output is still
+        # written by *write_log*.
+        self.log_tail_lines = None
+        self.log_count = 0
+        self._log_spool = None
+
+        # Echoes at most this many lines a second. The number of lines left
+        # out is printed instead.
+        self.echo_lines_per_second = None
+        self._echo_window_start = 0
+        self._echo_window_lines = 0
+        self._echo_suppressed = 0
         self.cwd = cwd
         self.env = env
         self.batch_wrapper = batch_wrapper
@@ -189,6 +223,65 @@ class Process:
         self.non_blocking = non_blocking
         self.finish_callback = None
 
+        self._process = None
+        self._finished = Event()
+
+        # Text written to the process' standard input, which is then closed
+        self.stdin_data = None
+
+        # Watchdog limits, in seconds. A process that produces no output, or
+        # no change in the text matched by *progress_pattern*, or that runs
+        # longer than the total limit, is killed along with its children.
+        # Limits that are None or 0 are not checked.
+        self.timeout_no_output = None
+        self.timeout_no_progress = None
+        self.timeout_total = None
+        self.progress_pattern = None
+
+        # A killed process is run again up to *retries* times, waiting
+        # *retry_delay* seconds, doubled with every retry, in between
+        self.retries = 0
+        self.retry_delay = 5.0
+
+        # Starts the process in its own process group even without a
+        # watchdog, so *kill* also reaches the processes it starts
+        self.own_process_group = False
+
+        self.attempts = 0
+        self.watchdog_trips = []
+        self._kill_reason = None
+        self._cancelled = False
+        self._process_group = False
+        self._watchdog_stop = Event()
+
+        # Resources used by the process and the children it waited for, where
+        # the platform reports them. Times are in seconds, *max_rss* is the
+        # peak resident memory in kilobytes, and the byte counts include reads
+        # and writes served from the page cache. Retries add to the totals.
+        self._reset_resources()
+        self._io_sample = None
+        self._reap_lock = Lock()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the process to finish. Mostly useful for non-blocking
+        processes, as *execute* only returns once blocking processes finish.
+
+        Parameters
+        ----------
+        timeout : float
+            The number of seconds to wait. Waits until the process finishes
+            when None.
+
+        Returns
+        -------
+        bool
+             Whether the process has finished.
+        """
+
+        self._finished.wait(timeout)
+        return self._finished.is_set()
+
     def get_elapsed_seconds(self):
         """
         Object description.
@@ -206,8 +299,8 @@ class Process:
 
         if self.end and self.start:
             delta = (self.end - self.start)
-            formatted = '%s.%s' % (delta.days * 86400 + delta.seconds,
-                                   int(math.floor(delta.microseconds / 1e3)))
+            formatted = '%s.%03d' % (delta.days * 86400 + delta.seconds,
+                                     int(math.floor(delta.microseconds / 1e3)))
         else:
             formatted = None
         return formatted
@@ -301,8 +394,48 @@ class Process:
                 write_dict['indentationLevel'] -= 1
             self.write_key(write_dict, 'processKeys', None, 'stop')
 
+        if self.watchdog_trips:
+            self.write_key(write_dict, 'attempts', self.attempts)
+            self.write_key(write_dict, 'watchdog', '; '.join(self.watchdog_trips))
+
+        self.write_resource_keys(write_dict)
+
         self.write_key(write_dict, 'status', self.status)
 
+    def write_resource_keys(self, write_dict):
+        """
+        Writes the resources used by the process, where they are known.
+
+        Parameters
+        ----------
+        write_dict : dict
+            The log handle, format and indentation level.
+        """
+
+        if self.user_time is not None:
+            self.write_key(write_dict, 'userTime', '%.3f' % self.user_time)
+        if self.system_time is not None:
+            self.write_key(write_dict, 'systemTime',
+                           '%.3f' % self.system_time)
+        self.write_key(write_dict, 'maxRSS', self.max_rss)
+        self.write_key(write_dict, 'readBytes', self.read_bytes)
+        self.write_key(write_dict, 'writeBytes', self.write_bytes)
+
+    def _reset_resources(self):
+        self.user_time = None
+        self.system_time = None
+        self.max_rss = None
+        self.read_bytes = None
+        self.write_bytes = None
+
+    def _add_resources(self, other):
+        for name in ['user_time', 'system_time', 'read_bytes', 'write_bytes']:
+            value = getattr(other, name)
+            if value is not None:
+                setattr(self, name, (getattr(self, name) or 0) + value)
+        if other.max_rss is not None:
+            self.max_rss = max(self.max_rss or 0, other.max_rss)
+
     def write_log_footer(self, write_dict):
         """
         Object description.
@@ -351,7 +484,7 @@ class Process:
                 self.write_key(write_dict, 'output', None, 'start')
                 if format == 'xml':
                     log_handle.write('<![CDATA[\n')
-                for line in self.log:
+                for line in self.iter_log():
                     log_handle.write('%s%s\n' % ('', line))
                 if format == 'xml':
                     log_handle.write(']]>\n')
@@ -416,11 +549,78 @@ class Process:
         if line:
             line = line.rstrip()
             if line != "":
-                self.log.append(line.rstrip())
+                self.log.append(line)
+                self.log_count += 1
+                if self._log_spool:
+                    self._log_spool.write('%s\n' % line)
                 if self.echo:
-                    print( '%s' % line.rstrip())
+                    self._echoLine(line)
                 if self.log_callback:
-                    self.log_callback(line.rstrip())
+                    self.log_callback(line)
+
+    def iter_log(self):
+        """
+        Iterates over all of the logged lines, including those that are no
+        longer kept in *log*.
+
+        Returns
+        -------
+        generator
+             The logged lines.
+        """
+
+        if not self._log_spool:
+            for line in list(self.log):
+                yield line
+            return
+
+        self._log_spool.flush()
+        self._log_spool.seek(0)
+        try:
+            for line in self._log_spool:
+                yield line.rstrip('\n')
+        finally:
+            self._log_spool.seek(0, os.SEEK_END)
+
+    def _resetLog(self):
+        if self._log_spool:
+            self._log_spool.close()
+            self._log_spool = None
+
+        if self.log_tail_lines:
+            self.log = collections.deque(maxlen=self.log_tail_lines)
+            self._log_spool = tempfile.TemporaryFile()
+        else:
+            self.log = []
+        self.log_count = 0
+
+        self._echo_window_start = 0
+        self._echo_window_lines = 0
+        self._echo_suppressed = 0
+
+    def _echoLine(self, line):
+        if self.echo_lines_per_second:
+            now = time.time()
+            if now - self._echo_window_start >= 1.0:
+                self._flushEcho()
+                self._echo_window_start = now
+                self._echo_window_lines = 0
+
+            if self._echo_window_lines >= self.echo_lines_per_second:
+                self._echo_suppressed += 1
+                return
+            self._echo_window_lines += 1
+
+        print( '%s' % line)
+
+    def _flushEcho(self):
+        if self._echo_suppressed:
+            print( '... %d lines not shown' % self._echo_suppressed)
+            self._echo_suppressed = 0
+
+    def _logOutput(self, line):
+        self._noteOutput(line)
+        self.log_line(line)
 
     def execute(self):
         """
@@ -438,7 +638,20 @@ class Process:
         """
 
         self.start = datetime.datetime.now()
-        self.log = []
+        self._resetLog()
+        self._finished.clear()
+
+        self.attempts = 0
+        self.watchdog_trips = []
+        self._cancelled = False
+        self._reset_resources()
+
+        self._launch()
+
+    def _launch(self):
+        self.attempts += 1
+        self._kill_reason = None
+        self._io_sample = None
 
         cmdargs = [self.cmd]
         cmdargs.extend(self.args)
@@ -460,6 +673,10 @@ class Process:
         #
         # Create process
         #
+        stdin_pipe = sp.PIPE if sp and self.stdin_data is not None else None
+        group_args = self._getProcessGroupArgs()
+        self._process_group = bool(group_args)
+        env = self._getProcessEnv(group_args)
         try:
             # Using *subprocess*.
             if sp:
@@ -471,17 +688,27 @@ class Process:
                     print('%s : Running process through wrapper %s\n' % (
                         self.__class__, self._tmp_wrapper))
                     process = sp.Popen([self._tmp_wrapper], stdout=sp.PIPE,
-                                       stderr=sp.STDOUT,
-                                       cwd=self.cwd, env=self.env)
+                                       stderr=sp.STDOUT, stdin=stdin_pipe,
+                                       cwd=self.cwd, env=env,
+                                       **group_args)
                 else:
                     print( "\nUsing standard subprocess Popen\n", cmdargs )
                     process = sp.Popen(cmdargs, stdout=sp.PIPE,
-                                       stderr=sp.STDOUT,
-                                       cwd=self.cwd, env=self.env)
+                                       stderr=sp.STDOUT, stdin=stdin_pipe,
+                                       cwd=self.cwd, env=env,
+                                       **group_args)
 
                 stdout = process.stdout
                 stdin = process.stdin
 
+                # Written from a separate thread so a process that fills
+                # its output before reading all of its input can't deadlock
+                if stdin_pipe:
+                    stdin_writer = Thread(target=self._write_stdin,
+                                          args=(stdin, self.stdin_data))
+                    stdin_writer.daemon = True
+                    stdin_writer.start()
+
                 #pid = process.pid
                 #self.log_line('process id %s\n' % pid)
 
@@ -499,23 +726,256 @@ class Process:
             print('Couldn\'t execute command : %s' % cmdargs[0])
             traceback.print_exc()
 
+        self._process = process
+
+        if stdout is None:
+            self.status = -1
+            self.end = datetime.datetime.now()
+            self._finished.set()
+            return
+
+        if process is not None:
+            self._startWatchdog(process)
+
         # 
         # Collect process output
         #
         if not self.non_blocking:
             self._collectOutput(stdout, stdin, process)
         else:
-            nbsr = NonBlockingStreamReader(stdout, self._processFinish)
+            # Lines are logged as they arrive
+            nbsr = NonBlockingStreamReader(stdout, self._processFinish,
+                                           self._logOutput)
+
+    def _write_stdin(self, process_stdin, data):
+        try:
+            process_stdin.write(data)
+        except IOError:
+            # The process exited without reading all of its input
+            pass
+        finally:
+            try:
+                process_stdin.close()
+            except IOError:
+                pass
+
+    def _getWatchdogEnabled(self):
+        return bool(self.timeout_no_output or self.timeout_total or
+                    (self.timeout_no_progress and self.progress_pattern))
+
+    def _getProcessGroupArgs(self):
+        # A watched process is started in its own process group, so it can be
+        # killed along with any processes it started. Inside a process that
+        # has a group of its own, processes stay in that group instead, so
+        # killing it still reaches them. A watchdog then only kills the
+        # process itself.
+        if not sp or not (self.own_process_group or
+                          self._getWatchdogEnabled()):
+            return {}
+        if os.environ.get(PROCESS_GROUP_VARIABLE):
+            return {}
+        if platform.system() == 'Windows':
+            return {'creationflags': getattr(sp, 'CREATE_NEW_PROCESS_GROUP',
+                                             0x200)}
+        return {'preexec_fn': os.setsid}
+
+    def _getProcessEnv(self, group_args):
+        # Lets the processes that this one starts know they're in its group
+        if not group_args:
+            return self.env
+        env = dict(self.env if self.env is not None else os.environ)
+        env[PROCESS_GROUP_VARIABLE] = '1'
+        return env
+
+    def _startWatchdog(self, process):
+        self._watchdog_stop.clear()
+        if not self._getWatchdogEnabled():
+            return
+
+        now = time.time()
+        self._last_output = now
+        self._last_progress = now
+        self._last_progress_text = None
+        if self.progress_pattern:
+            self._progress_re = re.compile(self.progress_pattern)
+        else:
+            self._progress_re = None
+
+        watchdog = Thread(target=self._watchProcess, args=(process, now))
+        watchdog.daemon = True
+        watchdog.start()
+
+    def _noteOutput(self, line):
+        if not self._getWatchdogEnabled() or not line:
+            return
+
+        self._last_output = time.time()
+        if self._progress_re:
+            match = self._progress_re.search(line)
+            if match and match.group(0) != self._last_progress_text:
+                self._last_progress_text = match.group(0)
+                self._last_progress = self._last_output
+
+    def _watchProcess(self, process, started):
+        while not self._watchdog_stop.is_set():
+            self._watchdog_stop.wait(1.0)
+            if (self._watchdog_stop.is_set() or
+                    self._pollProcess(process) is not None):
+                break
+
+            now = time.time()
+            reason = None
+            if self.timeout_total and now - started > self.timeout_total:
+                reason = 'not finished after %d seconds' % self.timeout_total
+            elif (self.timeout_no_output and
+                  now - self._last_output > self.timeout_no_output):
+                reason = 'no output for %d seconds' % self.timeout_no_output
+            elif (self.timeout_no_progress and self._progress_re and
+                  now - self._last_progress > self.timeout_no_progress):
+                reason = 'no progress for %d seconds' % (
+                    self.timeout_no_progress)
+
+            if reason:
+                self._kill_reason = reason
+                self.watchdog_trips.append(
+                    'attempt %d : %s' % (self.attempts, reason))
+                self.log_line('Watchdog : %s, killing process %d' % (
+                    reason, process.pid))
+                self._killProcessTree(process)
+                break
+
+    def kill(self, reason=None):
+        """
+        Kills the process and the processes it started, if it is running.
+        A killed process isn't retried.
+
+        Parameters
+        ----------
+        reason : unicode
+            Why the process was killed, added to the log.
+        """
+
+        self._cancelled = True
+        process = self._process
+        if process is None or process.returncode is not None:
+            return
+
+        if reason:
+            self.log_line('Killed : %s' % reason)
+        self._killProcessTree(process)
+
+    def _killProcessTree(self, process):
+        try:
+            if platform.system() == 'Windows':
+                with open(os.devnull, 'w') as devnull:
+                    sp.call(['taskkill', '/T', '/F', '/PID', str(process.pid)],
+                            stdout=devnull, stderr=devnull)
+            elif not self._process_group:
+                # Only the process itself can be reached
+                process.kill()
+            else:
+                # Ask nicely first, then make sure
+                os.killpg(process.pid, signal.SIGTERM)
+                for i in range(50):
+                    if self._pollProcess(process) is not None:
+                        break
+                    time.sleep(0.1)
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            # The process group is already gone
+            pass
+
+    def _sampleIO(self, process):
+        # The counters of a process that has exited but hasn't been reaped
+        # yet are still readable, and include the children it waited for
+        try:
+            with open('/proc/%d/io' % process.pid) as io_file:
+                counters = dict([line.split(':', 1) for line in io_file
+                                 if ':' in line])
+            self._io_sample = (int(counters['rchar']), int(counters['wchar']))
+        except (IOError, KeyError, ValueError):
+            pass
+
+    def _recordResources(self, rusage):
+        # Linux reports the peak resident size in kilobytes, macOS in bytes
+        max_rss = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            max_rss //= 1024
+
+        self.user_time = (self.user_time or 0) + rusage.ru_utime
+        self.system_time = (self.system_time or 0) + rusage.ru_stime
+        self.max_rss = max(self.max_rss or 0, max_rss)
+
+        if self._io_sample:
+            self.read_bytes = (self.read_bytes or 0) + self._io_sample[0]
+            self.write_bytes = (self.write_bytes or 0) + self._io_sample[1]
+            self._io_sample = None
+
+    def _pollProcess(self, process):
+        # Reaps the process with *wait4* where it's available, which also
+        # returns the resources it used. Several threads poll the same process.
+        with self._reap_lock:
+            if process.returncode is None and hasattr(os, 'wait4'):
+                self._sampleIO(process)
+                try:
+                    (pid, wait_status, rusage) = os.wait4(process.pid,
+                                                          os.WNOHANG)
+                except OSError:
+                    return process.poll()
+
+                if pid == process.pid:
+                    self._recordResources(rusage)
+                    if os.WIFSIGNALED(wait_status):
+                        process.returncode = -os.WTERMSIG(wait_status)
+                    else:
+                        process.returncode = os.WEXITSTATUS(wait_status)
+
+            return process.poll()
+
+    def _waitProcess(self, process):
+        if not hasattr(os, 'wait4'):
+            return process.wait()
+
+        while self._pollProcess(process) is None:
+            time.sleep(0.05)
+        return process.returncode
+
+    def _retryAfterWatchdog(self):
+        if (self._cancelled or not self._kill_reason or
+                self.attempts > self.retries):
+            return False
+
+        delay = self.retry_delay * (2 ** (self.attempts - 1))
+        self.log_line('Watchdog : retrying in %g seconds (attempt %d of %d)' % (
+            delay, self.attempts + 1, self.retries + 1))
+        time.sleep(delay)
+
+        self._launch()
+        return True
 
     def _processFinish(self, process_stdout, nbsr=None):
+        # Nothing else collects the exit code of a non-blocking process
+        if self.non_blocking and self._process is not None:
+            self.status = self._waitProcess(self._process)
+
+        self._watchdog_stop.set()
+        if self._retryAfterWatchdog():
+            return
+
+        # A killed process can still exit cleanly after catching the signal
+        if (self._kill_reason or self._cancelled) and self.status == 0:
+            self.status = -1
+
         self.end = datetime.datetime.now()
         self._cleanupWrapper()
+        if self.echo:
+            self._flushEcho()
 
-        if self.non_blocking and nbsr:
-            self._collectOuputNBSRFinish(nbsr, process_stdout)
-
-        if self.finish_callback:
-            self.finish_callback()
+        try:
+            if self.finish_callback:
+                self.finish_callback()
+        finally:
+            self._finished.set()
 
     def _cleanupWrapper(self):
         if self.batch_wrapper and tmp_wrapper:
@@ -555,7 +1015,7 @@ class Process:
         try:
             nbsr = NonBlockingStreamReader(process_stdout)
             i = 0
-            while process.poll() is None:
+            while self._pollProcess(process) is None:
                 try:
                     line = nbsr.readline(30.0) # x secs to let the shell output the result
                 except:
@@ -563,12 +1023,17 @@ class Process:
                     line = 'Exception'
 
                 if not line:
+                    # Once the output has closed, the process only has to exit
+                    if nbsr.ended():
+                        break
                     self.log_line( '%d readline iteration - No more data' % i )
                     i += 1
                 else:
+                    self._noteOutput( line )
                     self.log_line( line )
 
             self._collectOuputNBSRFinish(nbsr, process_stdout)
+            self._waitProcess(process)
 
         except:
             self.log_line('Logging error - info : %s' % sys.exc_info()[0])
@@ -589,6 +1054,7 @@ class Process:
             # of print statements.
             for line in process_stdout:
                 #print( "%s - for loop log line" % str(datetime.datetime.now()) )
+                self._noteOutput(line)
                 self.log_line(line)
 
             # So we go with the, um, uglier option below.
@@ -615,7 +1081,7 @@ class Process:
             self.log_line('Logging error - info : %s' % sys.exc_info()[0])
             #self.log_line('Logging error - line : %s' % line)
 
-        self.status = process.returncode
+        self.status = self._waitProcess(process)
 
         if self.batch_wrapper and tmp_wrapper:
             try:
@@ -675,25 +1141,57 @@ class ProcessList(Process):
     A list of processes with logged output.
     """
 
-    def __init__(self, description, blocking=True, cwd=None, env=None):
+    def __init__(self,
+                 description,
+                 blocking=True,
+                 cwd=None,
+                 env=None,
+                 max_concurrency=1):
         """
         Object description.
 
         Parameters
         ----------
-        parameter : type
-            Parameter description.
-
-        Returns
-        -------
-        type
-             Return value description.
+        description : unicode
+            The description of the list.
+        blocking : bool
+            Whether to stop starting children after one fails. Otherwise the
+            children that don't depend on the failed one still run.
+        max_concurrency : int
+            The number of children that may run at the same time. The default
+            runs them one after another, in order.
         """
 
         Process.__init__(self, description, None, None, cwd, env)
         'Initialize the standard class variables'
         self.processes = []
         self.blocking = blocking
+        self.max_concurrency = max_concurrency
+
+        # The children each child waits for, keyed by child
+        self.dependencies = {}
+
+    def add_process(self, process, depends_on=None):
+        """
+        Adds a child that runs once the children it depends on succeed.
+
+        Parameters
+        ----------
+        process : Process
+            The child process or process list.
+        depends_on : list
+            Children of this list that have to finish successfully first.
+
+        Returns
+        -------
+        Process
+             The child process.
+        """
+
+        self.processes.append(process)
+        if depends_on:
+            self.dependencies[process] = list(depends_on)
+        return process
 
     def generate_report(self, write_dict):
         """
@@ -716,18 +1214,24 @@ class ProcessList(Process):
 
             self.log = []
 
+            # Totals over all children, with the largest peak memory of any
+            self._reset_resources()
+
             for child in self.processes:
                 if isinstance(child, ProcessList):
                     child.generate_report(write_dict)
+                self._add_resources(child)
 
                 key = child.description
                 value = child.status
+                elapsed = child.get_elapsed_seconds()
                 if write_dict['format'] == 'xml':
                     child_result = (
-                        '%s<result description=\'%s\'>%s</result>' % (
-                            indent, key, value))
+                        '%s<result description=\'%s\' elapsed=\'%s\'>%s'
+                        '</result>' % (indent, key, elapsed, value))
                 else:
-                    child_result = ('%s%40s : %s' % (indent, key, value))
+                    child_result = ('%s%40s : %s (%s seconds)' % (
+                        indent, key, value, elapsed))
                 self.log.append(child_result)
 
                 if child.status != 0:
@@ -764,6 +1268,7 @@ class ProcessList(Process):
         self.write_key(write_dict, 'elapsed', self.get_elapsed_seconds())
 
         self.generate_report(write_dict)
+        self.write_resource_keys(write_dict)
 
         self.write_key(write_dict, 'status', self.status)
 
@@ -842,26 +1347,196 @@ class ProcessList(Process):
 
         self.start = datetime.datetime.now()
         self.log = []
+        self._finished.clear()
 
         self.status = 0
+        self._cancelled = False
         if self.processes:
-            for child in self.processes:
-                if child:
-                    try:
-                        child.execute()
-                    except:
-                        print('%s : caught exception in child class %s' % (
-                            self.__class__, child.__class__))
-                        traceback.print_exc()
-                        child.status = -1
-
-                    if self.blocking and child.status != 0:
-                        print('%s : child class %s finished with an error' % (
-                            self.__class__, child.__class__))
-                        self.status = -1
-                        break
+            self._executeChildren([child for child in self.processes if child])
+        if self._cancelled:
+            self.status = -1
 
         self.end = datetime.datetime.now()
+        self._finished.set()
+
+    def kill(self, reason=None):
+        """
+        Kills the running children and the processes they started. Children
+        that haven't started yet aren't started.
+
+        Parameters
+        ----------
+        reason : unicode
+            Why the children were killed, added to their logs.
+        """
+
+        self._cancelled = True
+        for child in self.processes:
+            if child:
+                child.kill(reason)
+
+    def _executeChild(self, child, finished=None):
+        try:
+            # The list may have been killed since the child was scheduled
+            if self._cancelled:
+                child.status = -1
+            else:
+                child.execute()
+                # Non-blocking children have to finish before their
+                # dependents run
+                child.wait()
+        except:
+            print('%s : caught exception in child class %s' % (
+                self.__class__, child.__class__))
+            traceback.print_exc()
+            child.status = -1
+
+        if finished is not None:
+            finished.put(child)
+
+    def _executeChildren(self, children):
+        pending = list(children)
+        running = set()
+        succeeded = set()
+        failed = set()
+        finished = Queue()
+
+        while pending or running:
+            # Start the children whose dependencies have all succeeded, in order
+            if not (self.blocking and failed) and not self._cancelled:
+                for child in list(pending):
+                    if len(running) >= max(1, self.max_concurrency):
+                        break
+
+                    dependencies = [dependency for dependency in
+                                    self.dependencies.get(child, [])
+                                    if dependency in children]
+                    if [d for d in dependencies if d in failed]:
+                        print('%s : skipping child class %s, a dependency '
+                              'failed' % (self.__class__, child.__class__))
+                        pending.remove(child)
+                        failed.add(child)
+                        continue
+                    if [d for d in dependencies if d not in succeeded]:
+                        continue
+
+                    pending.remove(child)
+                    if self.max_concurrency <= 1:
+                        # Handled before the next one starts, as it may fail
+                        self._executeChild(child)
+                        finished.put(child)
+                        break
+                    else:
+                        running.add(child)
+                        worker = Thread(target=self._executeChild,
+                                        args=(child, finished))
+                        worker.daemon = True
+                        worker.start()
+
+            if finished.empty() and not running:
+                if pending and not (self.blocking and failed or
+                                    self._cancelled):
+                    print('%s : children with dependencies that can never '
+                          'run : %s' % (self.__class__, ', '.join(
+                              [str(child.description) for child in pending])))
+                    self.status = -1
+                break
+
+            child = finished.get()
+            running.discard(child)
+            if child.status == 0:
+                succeeded.add(child)
+            else:
+                failed.add(child)
+                print('%s : child class %s finished with an error' % (
+                    self.__class__, child.__class__))
+                if self.blocking:
+                    self.status = -1
+
+
+def _run_watched_sleep(timeout):
+    """
+    Starts a process that prints its id and sleeps for longer than its
+    watchdog's *timeout*, as a batch worker starts a Cycles render with a
+    render timeout.
+
+    Parameters
+    ----------
+    timeout : float
+        The watchdog's total limit, in seconds.
+    """
+
+    def echo_line(line):
+        sys.stdout.write('%s\n' % line)
+        sys.stdout.flush()
+
+    sleeper = Process(description='sleep', cmd=sys.executable,
+                      args=['-u', '-c', 'import os, time; print(os.getpid()); '
+                            'time.sleep(%s)' % (timeout * 2)])
+    sleeper.echo = False
+    sleeper.timeout_total = timeout
+    sleeper.log_callback = echo_line
+    sleeper.execute()
+
+
+def _check_kill(timeout):
+    """
+    Checks that killing a process started in its own process group also kills
+    the watched processes it started, which would otherwise have groups of
+    their own.
+
+    Parameters
+    ----------
+    timeout : float
+        The watchdog's total limit of the processes started by the killed
+        one, in seconds.
+
+    Returns
+    -------
+    bool
+         Whether none of the started processes were left running.
+    """
+
+    sleeper_pids = []
+    started = Event()
+
+    def note_pid(line):
+        if line.strip().isdigit():
+            sleeper_pids.append(int(line))
+            started.set()
+
+    worker = Process(description='start a watched process',
+                     cmd=sys.executable,
+                     args=['-u', os.path.abspath(__file__),
+                           '--watched-sleep', str(timeout)],
+                     non_blocking=True)
+    worker.echo = False
+    worker.own_process_group = True
+    worker.log_callback = note_pid
+    worker.execute()
+
+    if not started.wait(timeout):
+        worker.kill('the watched process didn\'t start')
+        worker.wait()
+        print('process: The watched process didn\'t start')
+        return False
+
+    worker.kill('checking the watched process is killed with it')
+    worker.wait()
+
+    # The orphaned process is reaped by init once it's killed
+    for i in range(50):
+        try:
+            os.kill(sleeper_pids[0], 0)
+        except OSError:
+            print('process: The watched process was killed with its parent')
+            return True
+        time.sleep(0.1)
+
+    print('process: The watched process %d is still running' %
+          sleeper_pids[0])
+    os.kill(sleeper_pids[0], signal.SIGKILL)
+    return False
 
 
 def main():
@@ -886,9 +1561,21 @@ def main():
                                      '[options for the logged process]'))
     p.add_option('--cmd', '-c', default=None)
     p.add_option('--log', '-l', default=None)
+    p.add_option('--check-kill', type='float', default=None,
+                 help=('Check that killing a process group kills the '
+                       'processes started in it with a watchdog of this '
+                       'many seconds'))
+    p.add_option('--watched-sleep', type='float', default=None,
+                 help=optparse.SUPPRESS_HELP)
 
     options, arguments = p.parse_args()
 
+    if options.check_kill:
+        sys.exit(0 if _check_kill(options.check_kill) else 1)
+    if options.watched_sleep:
+        _run_watched_sleep(options.watched_sleep)
+        return
+
     cmd = options.cmd
     log_filename = options.log
 
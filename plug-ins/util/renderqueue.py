@@ -0,0 +1,987 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A render queue. Jobs, a scene description with its includes and a launch
+profile, are submitted to a job store on disk. A daemon hands queued jobs to
+worker agents, each of which runs jobs on a host through a transport, retries
+the ones that fail and moves their outputs into place.
+"""
+
+from __future__ import division
+
+import json
+import optparse
+import os
+import pipes
+import platform
+import posixpath
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from process import Process, ProcessList
+
+__author__ = 'Haarm-Pieter Duiker'
+__copyright__ = 'Copyright (C) 2015 - Duiker Research Corp'
+__license__ = ''
+__maintainer__ = 'Haarm-Pieter Duiker'
+__email__ = 'support@duikerresearch.org'
+__status__ = 'Production'
+
+__all__ = ['FINISHED_STATES',
+           'JobStore',
+           'LocalTransport',
+           'SSHTransport',
+           'StubTransport',
+           'WorkerAgent',
+           'RenderQueue',
+           'submit_job',
+           'cancel_job',
+           'wait_for_jobs',
+           'daemon_running',
+           'main']
+
+FINISHED_STATES = ['done', 'failed', 'cancelled']
+
+
+def _write_json(path, data):
+    partial_path = '%s.%d.%d.partial' % (path, os.getpid(),
+                                         threading.current_thread().ident)
+    with open(partial_path, 'w') as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+    # Windows won't rename over an existing file.
+    if platform.system() == 'Windows' and os.path.exists(path):
+        os.remove(path)
+    os.rename(partial_path, path)
+
+
+def _read_json(path):
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def _stage_file(source, target):
+    target_dir = os.path.dirname(target)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    # Copied rather than linked, as exporters rewrite their files in place
+    shutil.copy2(source, target)
+
+
+class JobStore:
+    """
+    Jobs kept in a directory, one sub-directory per job holding the job's
+    description, its staged inputs and, once it's run, its logs.
+    """
+
+    def __init__(self, store_dir):
+        """
+        Initialize the standard class variables.
+
+        Parameters
+        ----------
+        store_dir : str
+            The store's directory, created when needed.
+        """
+
+        self.store_dir = store_dir
+        self.jobs_dir = os.path.join(store_dir, 'jobs')
+        if not os.path.exists(self.jobs_dir):
+            try:
+                os.makedirs(self.jobs_dir)
+            except OSError:
+                if not os.path.isdir(self.jobs_dir):
+                    raise
+
+    def job_dir(self, job_id):
+        """
+        Returns the directory of a job.
+
+        Parameters
+        ----------
+        job_id : unicode
+            The job.
+
+        Returns
+        -------
+        str
+             The job's directory.
+        """
+
+        return os.path.join(self.jobs_dir, job_id)
+
+    def submit(self, scene, includes=None, outputs=None, profile=None):
+        """
+        Adds a job to the queue. The scene and its includes are staged in the
+        job's directory, so they can be rewritten once the job is submitted.
+
+        Parameters
+        ----------
+        scene : str
+            The scene description.
+        includes : list
+            The files the scene includes, in or below the scene's directory.
+        outputs : dict
+            The files the render writes, by name, and where each is moved
+            once the job is done.
+        profile : dict
+            How the job is launched : *cmd*, *args*, *env*, *retries*,
+            *retry_delay* and the watchdog limits *timeout_total*,
+            *timeout_no_output*, *timeout_no_progress* and
+            *progress_pattern*. *{scene}*, *{output}* and *{dir}* in *args*
+            are replaced with the scene, first output and working directory
+            on the host the job runs on.
+
+        Returns
+        -------
+        unicode
+             The job's id.
+        """
+
+        job_id = '%d_%s' % (int(time.time() * 1000), uuid.uuid4().hex[:8])
+        partial_dir = self.job_dir(job_id) + '.partial'
+        scene_dir = os.path.dirname(os.path.abspath(scene))
+
+        staged_includes = []
+        _stage_file(scene, os.path.join(partial_dir, os.path.basename(scene)))
+        for include in includes or []:
+            relative_path = os.path.relpath(os.path.abspath(include), scene_dir)
+            if relative_path.startswith(os.pardir):
+                raise ValueError('Include outside the scene directory : %s' % (
+                    include))
+            _stage_file(include, os.path.join(partial_dir, relative_path))
+            staged_includes.append(relative_path.replace(os.sep, '/'))
+
+        job = {'id': job_id,
+               'scene': os.path.basename(scene),
+               'includes': staged_includes,
+               'outputs': dict(outputs or {}),
+               'profile': dict(profile or {}),
+               'state': 'queued',
+               'attempts': 0,
+               'submitted': time.time(),
+               'submitter': socket.gethostname(),
+               'history': []}
+        _write_json(os.path.join(partial_dir, 'job.json'), job)
+
+        # The daemon only sees the job once it's complete
+        os.rename(partial_dir, self.job_dir(job_id))
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns a job.
+
+        Parameters
+        ----------
+        job_id : unicode
+            The job.
+
+        Returns
+        -------
+        dict
+             The job, or None if there's no such job.
+        """
+
+        try:
+            return _read_json(os.path.join(self.job_dir(job_id), 'job.json'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def update(self, job):
+        """
+        Writes a job's description. Only the daemon updates jobs once they
+        are submitted.
+
+        Parameters
+        ----------
+        job : dict
+            The job.
+        """
+
+        _write_json(os.path.join(self.job_dir(job['id']), 'job.json'), job)
+
+    def list_jobs(self, states=None):
+        """
+        Returns the jobs in the store, oldest first.
+
+        Parameters
+        ----------
+        states : list
+            Only returns the jobs in these states.
+
+        Returns
+        -------
+        list
+             The jobs.
+        """
+
+        jobs = []
+        for job_id in os.listdir(self.jobs_dir):
+            if job_id.endswith('.partial'):
+                continue
+            job = self.get(job_id)
+            if job and (states is None or job['state'] in states):
+                jobs.append(job)
+        return sorted(jobs, key=lambda job: (job['submitted'], job['id']))
+
+    def cancel(self, job_id):
+        """
+        Asks the daemon to cancel a job, killing it if it is running.
+
+        Parameters
+        ----------
+        job_id : unicode
+            The job.
+        """
+
+        open(os.path.join(self.job_dir(job_id), 'cancel'), 'w').close()
+
+    def cancel_requested(self, job_id):
+        """
+        Returns whether a job was cancelled.
+
+        Parameters
+        ----------
+        job_id : unicode
+            The job.
+
+        Returns
+        -------
+        bool
+             Whether the job was cancelled.
+        """
+
+        return os.path.exists(os.path.join(self.job_dir(job_id), 'cancel'))
+
+    def remove(self, job_id):
+        """
+        Removes a job and its files.
+
+        Parameters
+        ----------
+        job_id : unicode
+            The job.
+        """
+
+        shutil.rmtree(self.job_dir(job_id), True)
+
+
+def _get_job_args(job, work_dir, join=os.path.join):
+    outputs = sorted(job['outputs'].keys())
+    values = {'scene': join(work_dir, job['scene']),
+              'output': join(work_dir, outputs[0]) if outputs else '',
+              'dir': work_dir}
+    return [arg.format(**values) for arg in job['profile'].get('args', [])]
+
+
+def _apply_watchdog(process, profile):
+    # Retries are left to the queue, which may run the job somewhere else
+    process.timeout_total = profile.get('timeout_total')
+    process.timeout_no_output = profile.get('timeout_no_output')
+    process.timeout_no_progress = profile.get('timeout_no_progress')
+    process.progress_pattern = profile.get('progress_pattern')
+
+
+class LocalTransport:
+    """
+    Runs jobs as processes on this host, in the job's directory.
+    """
+
+    def __init__(self):
+        """
+        Initialize the standard class variables.
+        """
+
+        self.host = socket.gethostname()
+
+    def create_process(self, job, job_dir):
+        """
+        Returns a process that runs a job and leaves its outputs in the job's
+        directory.
+
+        Parameters
+        ----------
+        job : dict
+            The job.
+        job_dir : str
+            The job's directory.
+
+        Returns
+        -------
+        Process
+             The process.
+        """
+
+        profile = job['profile']
+        env = dict(os.environ)
+        env.update(profile.get('env', {}))
+
+        process = Process(description='render job %s' % job['id'],
+                          cmd=profile['cmd'],
+                          args=_get_job_args(job, job_dir),
+                          cwd=job_dir,
+                          env=env,
+                          non_blocking=True)
+        process.echo = False
+        process.log_tail_lines = 1000
+        _apply_watchdog(process, profile)
+        return process
+
+
+class SSHTransport:
+    """
+    Runs jobs on another host over ssh. The job's directory is copied to the
+    host, the job is run there and its outputs are copied back. The host needs
+    the executable at the profile's path, and any textures the scene reads at
+    the same paths, through shared storage for example.
+    """
+
+    def __init__(self, host, remote_dir='/tmp/renderqueue', ssh='ssh',
+                 scp='scp', ssh_args=None):
+        """
+        Initialize the standard class variables.
+
+        Parameters
+        ----------
+        host : unicode
+            The host, as given to ssh.
+        remote_dir : unicode
+            The directory on the host jobs are copied to.
+        ssh : unicode
+            The ssh executable.
+        scp : unicode
+            The scp executable.
+        ssh_args : list
+            Extra arguments for ssh and scp, a port or key for example.
+        """
+
+        self.host = host
+        self.remote_dir = remote_dir
+        self.ssh = ssh
+        self.scp = scp
+        self.ssh_args = ssh_args or ['-o', 'BatchMode=yes']
+
+    def _ssh(self, description, command):
+        process = Process(description=description,
+                          cmd=self.ssh,
+                          args=self.ssh_args + [self.host, command])
+        process.echo = False
+        return process
+
+    def _scp(self, description, sources, target):
+        process = Process(description=description,
+                          cmd=self.scp,
+                          args=self.ssh_args + ['-q', '-r'] + sources + [target])
+        process.echo = False
+        return process
+
+    def create_process(self, job, job_dir):
+        """
+        Returns a process list that copies a job to the host, runs it and
+        copies its outputs back to the job's directory.
+
+        Parameters
+        ----------
+        job : dict
+            The job.
+        job_dir : str
+            The job's directory.
+
+        Returns
+        -------
+        ProcessList
+             The process list.
+        """
+
+        profile = job['profile']
+        remote_job_dir = posixpath.join(self.remote_dir, job['id'])
+        remote = lambda path: '%s:%s' % (self.host, path)
+
+        command = ' '.join([pipes.quote(arg) for arg in
+                            [profile['cmd']] +
+                            _get_job_args(job, remote_job_dir, posixpath.join)])
+        environment = ' '.join(['%s=%s' % (key, pipes.quote(str(value)))
+                                for (key, value) in
+                                sorted(profile.get('env', {}).items())])
+        if environment:
+            command = 'env %s %s' % (environment, command)
+
+        steps = ProcessList('render job %s on %s' % (job['id'], self.host))
+        steps.echo = False
+
+        make_dir = self._ssh('make the job directory',
+                             'mkdir -p %s' % pipes.quote(self.remote_dir))
+        upload = self._scp('copy the job to the host', [job_dir],
+                           remote(self.remote_dir))
+        render = self._ssh('render the job', 'cd %s && %s' % (
+            pipes.quote(remote_job_dir), command))
+        render.log_tail_lines = 1000
+        _apply_watchdog(render, profile)
+        download = self._scp('copy the outputs back',
+                             [remote(posixpath.join(remote_job_dir, output))
+                              for output in sorted(job['outputs'].keys())],
+                             job_dir)
+        clean_up = self._ssh('remove the job from the host',
+                             'rm -rf %s' % pipes.quote(remote_job_dir))
+
+        previous = None
+        for step in [make_dir, upload, render, download, clean_up]:
+            steps.add_process(step, [previous] if previous else None)
+            previous = step
+        return steps
+
+
+class StubTransport:
+    """
+    Stands in for a render host in tests and benchmarks. Each job runs a
+    Python process that sleeps and writes placeholder outputs.
+    """
+
+    def __init__(self, seconds=0.5, fail_every=0):
+        """
+        Initialize the standard class variables.
+
+        Parameters
+        ----------
+        seconds : float
+            How long each job takes.
+        fail_every : int
+            Fails every this many jobs, when not 0.
+        """
+
+        self.host = 'stub'
+        self.seconds = seconds
+        self.fail_every = fail_every
+        self.count = 0
+
+    def create_process(self, job, job_dir):
+        """
+        Returns a process that pretends to run a job.
+
+        Parameters
+        ----------
+        job : dict
+            The job.
+        job_dir : str
+            The job's directory.
+
+        Returns
+        -------
+        Process
+             The process.
+        """
+
+        self.count += 1
+        fail = bool(self.fail_every and self.count % self.fail_every == 0)
+
+        code = ('import sys, time\n'
+                'time.sleep(%r)\n'
+                'for path in sys.argv[1:]:\n'
+                '    open(path, "w").write("stub")\n'
+                'sys.exit(%d)\n' % (self.seconds, 1 if fail else 0))
+        outputs = [os.path.join(job_dir, output)
+                   for output in sorted(job['outputs'].keys())]
+
+        process = Process(description='stub job %s' % job['id'],
+                          cmd=sys.executable,
+                          args=['-c', code] + outputs,
+                          non_blocking=True)
+        process.echo = False
+        return process
+
+
+class WorkerAgent:
+    """
+    Runs up to a number of jobs at a time through a transport.
+    """
+
+    def __init__(self, transport, slots=1, name=None):
+        """
+        Initialize the standard class variables.
+
+        Parameters
+        ----------
+        transport : object
+            The transport, *LocalTransport*, *SSHTransport* or
+            *StubTransport*.
+        slots : int
+            The number of jobs the agent runs at a time.
+        name : unicode
+            The agent's name in job histories.
+        """
+
+        self.transport = transport
+        self.slots = max(1, slots)
+        self.name = name or transport.host
+        self.running = {}
+
+    def free_slots(self):
+        """
+        Returns the number of jobs the agent can start.
+
+        Returns
+        -------
+        int
+             The number of free slots.
+        """
+
+        return self.slots - len(self.running)
+
+
+class RenderQueue:
+    """
+    Dispatches the jobs in a store to worker agents.
+    """
+
+    def __init__(self, store_dir, agents, poll_interval=0.5, retry_delay=5.0):
+        """
+        Initialize the standard class variables.
+
+        Parameters
+        ----------
+        store_dir : str
+            The job store's directory.
+        agents : list
+            The worker agents.
+        poll_interval : float
+            The number of seconds between looks at the store.
+        retry_delay : float
+            The number of seconds before a failed job is first retried,
+            unless its profile says otherwise. The delay doubles with every
+            retry.
+        """
+
+        self.store = JobStore(store_dir)
+        self.agents = agents
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts dispatching jobs on a background thread.
+        """
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, kill=False):
+        """
+        Stops dispatching jobs.
+
+        Parameters
+        ----------
+        kill : bool
+            Whether to kill the running jobs. They are otherwise waited for.
+        """
+
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+
+        with self._lock:
+            processes = [process for agent in self.agents
+                         for process in agent.running.values()]
+        for process in processes:
+            if kill:
+                process.kill('render queue stopped')
+            process.wait()
+
+        heartbeat = os.path.join(self.store.store_dir, 'daemon.json')
+        if os.path.exists(heartbeat):
+            os.remove(heartbeat)
+
+    def serve_forever(self):
+        """
+        Dispatches jobs until the queue is stopped.
+        """
+
+        # Jobs that were running when an earlier daemon stopped are run again
+        for job in self.store.list_jobs(['running']):
+            job['state'] = 'queued'
+            job['history'].append({'event': 'requeued after a restart',
+                                   'time': time.time()})
+            self.store.update(job)
+
+        while not self._stopped.is_set():
+            _write_json(os.path.join(self.store.store_dir, 'daemon.json'),
+                        {'pid': os.getpid(),
+                         'host': socket.gethostname(),
+                         'agents': [agent.name for agent in self.agents],
+                         'time': time.time()})
+            try:
+                self._dispatch()
+            except Exception:
+                traceback.print_exc()
+
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _dispatch(self):
+        now = time.time()
+
+        with self._lock:
+            for agent in self.agents:
+                for (job_id, process) in agent.running.items():
+                    if self.store.cancel_requested(job_id):
+                        process.kill('job cancelled')
+
+        for job in self.store.list_jobs(['queued']):
+            if self.store.cancel_requested(job['id']):
+                job['state'] = 'cancelled'
+                job['finished'] = now
+                self.store.update(job)
+                continue
+            if job.get('retry_after', 0) > now:
+                continue
+
+            with self._lock:
+                agents = [agent for agent in self.agents if agent.free_slots()]
+                if not agents:
+                    break
+                # The least busy agent first, to spread jobs over the hosts
+                agent = max(agents, key=lambda agent: agent.free_slots())
+                self._start_job(agent, job)
+
+    def _start_job(self, agent, job):
+        job['state'] = 'running'
+        job['attempts'] += 1
+        job['agent'] = agent.name
+        job['started'] = time.time()
+        self.store.update(job)
+
+        try:
+            process = agent.transport.create_process(
+                job, self.store.job_dir(job['id']))
+        except Exception, e:
+            self._finish_job(agent, job, None, str(e))
+            return
+
+        agent.running[job['id']] = process
+        worker = threading.Thread(target=self._run_job,
+                                  args=(agent, job, process))
+        worker.daemon = True
+        worker.start()
+
+    def _run_job(self, agent, job, process):
+        error = None
+        try:
+            process.execute()
+            process.wait()
+        except Exception, e:
+            error = str(e)
+            process.status = -1
+
+        try:
+            log_name = os.path.join(self.store.job_dir(job['id']),
+                                    'render.%d.log' % job['attempts'])
+            process.write_log_to_disk(log_name, format='txt')
+            job['log'] = log_name
+        except Exception:
+            traceback.print_exc()
+
+        with self._lock:
+            self._finish_job(agent, job, process.status, error)
+            agent.running.pop(job['id'], None)
+        self._wake.set()
+
+    def _finish_job(self, agent, job, status, error=None):
+        job_dir = self.store.job_dir(job['id'])
+        now = time.time()
+
+        missing = [output for output in job['outputs']
+                   if not os.path.exists(os.path.join(job_dir, output))]
+        if status == 0 and missing and not error:
+            error = 'missing outputs : %s' % ', '.join(missing)
+
+        job['history'].append({'attempt': job['attempts'],
+                               'agent': agent.name,
+                               'status': status,
+                               'error': error,
+                               'seconds': now - job['started']})
+
+        profile = job['profile']
+        retries = profile.get('retries', 0)
+        retry_delay = profile.get('retry_delay', self.retry_delay)
+
+        if self.store.cancel_requested(job['id']):
+            job['state'] = 'cancelled'
+        elif status == 0 and not error:
+            # Outputs are moved to where the submitter wants them
+            for (output, target) in job['outputs'].items():
+                if not target:
+                    continue
+                target_dir = os.path.dirname(target)
+                if target_dir and not os.path.exists(target_dir):
+                    os.makedirs(target_dir)
+                if os.path.exists(target):
+                    os.remove(target)
+                shutil.move(os.path.join(job_dir, output), target)
+            job['state'] = 'done'
+            self.completed += 1
+        elif job['attempts'] <= retries:
+            job['state'] = 'queued'
+            job['retry_after'] = now + retry_delay * 2 ** (job['attempts'] - 1)
+            self.retried += 1
+        else:
+            job['state'] = 'failed'
+            self.failed += 1
+
+        if job['state'] != 'queued':
+            job['finished'] = now
+        self.store.update(job)
+
+
+def submit_job(store_dir, scene, includes=None, outputs=None, profile=None):
+    """
+    Adds a job to a render queue's store. See *JobStore.submit*.
+
+    Returns
+    -------
+    unicode
+         The job's id.
+    """
+
+    return JobStore(store_dir).submit(scene, includes, outputs, profile)
+
+
+def cancel_job(store_dir, job_id):
+    """
+    Cancels a job in a render queue's store.
+
+    Parameters
+    ----------
+    store_dir : str
+        The job store's directory.
+    job_id : unicode
+        The job.
+    """
+
+    JobStore(store_dir).cancel(job_id)
+
+
+def wait_for_jobs(store_dir, job_ids, timeout=None, poll_interval=0.5,
+                  callback=None):
+    """
+    Waits for jobs to finish.
+
+    Parameters
+    ----------
+    store_dir : str
+        The job store's directory.
+    job_ids : list
+        The jobs.
+    timeout : float
+        The number of seconds to wait. Waits until every job finishes when
+        None.
+    poll_interval : float
+        The number of seconds between looks at the store.
+    callback : function
+        Called with each job as it finishes.
+
+    Returns
+    -------
+    dict
+         The jobs that finished, by id.
+    """
+
+    store = JobStore(store_dir)
+    pending = list(job_ids)
+    finished = {}
+    start = time.time()
+
+    while True:
+        for job_id in list(pending):
+            job = store.get(job_id)
+            if job is None or job['state'] in FINISHED_STATES:
+                pending.remove(job_id)
+                finished[job_id] = job
+                if callback:
+                    callback(job_id, job)
+
+        if not pending:
+            break
+        if timeout is not None and time.time() - start >= timeout:
+            break
+        time.sleep(poll_interval)
+
+    return finished
+
+
+def daemon_running(store_dir, max_age=10.0):
+    """
+    Returns whether a daemon is dispatching a store's jobs.
+
+    Parameters
+    ----------
+    store_dir : str
+        The job store's directory.
+    max_age : float
+        The number of seconds since the daemon's last heartbeat after which
+        it's assumed to have stopped.
+
+    Returns
+    -------
+    bool
+         Whether a daemon is running.
+    """
+
+    try:
+        heartbeat = _read_json(os.path.join(store_dir, 'daemon.json'))
+    except (IOError, OSError, ValueError):
+        return False
+    return time.time() - heartbeat['time'] < max_age
+
+
+def _parse_agents(options):
+    agents = []
+    for i in range(options.local):
+        agents.append(WorkerAgent(LocalTransport(), name='local%d' % i))
+    for host in options.ssh or []:
+        (host, _, slots) = host.partition(':')
+        agents.append(WorkerAgent(SSHTransport(host, options.remote_dir),
+                                  slots=int(slots or 1)))
+    for i in range(options.stub):
+        agents.append(WorkerAgent(StubTransport(options.stub_seconds),
+                                  name='stub%d' % i))
+    return agents
+
+
+def _benchmark(jobs, seconds, agent_counts):
+    benchmark_dir = tempfile.mkdtemp(prefix='renderqueue_')
+    try:
+        scene = os.path.join(benchmark_dir, 'scene.xml')
+        with open(scene, 'w') as fp:
+            fp.write('<cycles/>\n')
+
+        for agent_count in agent_counts:
+            store_dir = os.path.join(benchmark_dir, 'store%d' % agent_count)
+            agents = [WorkerAgent(StubTransport(seconds), name='stub%d' % i)
+                      for i in range(agent_count)]
+            queue = RenderQueue(store_dir, agents, poll_interval=0.05)
+
+            job_ids = [submit_job(store_dir, scene,
+                                  outputs={'frame.exr': None},
+                                  profile={'cmd': 'stub'})
+                       for i in range(jobs)]
+
+            start = time.time()
+            queue.start()
+            wait_for_jobs(store_dir, job_ids, poll_interval=0.05)
+            elapsed = time.time() - start
+            queue.stop()
+
+            print('%2d agents : %d jobs in %.2f seconds, %.1f jobs a minute' % (
+                agent_count, jobs, elapsed, jobs * 60 / elapsed))
+    finally:
+        shutil.rmtree(benchmark_dir, True)
+
+
+def main():
+    """
+    Runs a render queue daemon, submits, lists or cancels jobs, or measures
+    how throughput scales with the number of agents.
+    """
+
+    p = optparse.OptionParser(
+        description='A render queue',
+        prog='renderqueue',
+        version='renderqueue 0.1',
+        usage=('%prog [options] daemon\n'
+               '       %prog [options] submit scene [-- args]\n'
+               '       %prog [options] status\n'
+               '       %prog [options] cancel job [job ...]\n'
+               '       %prog [options] benchmark'))
+    p.add_option('--store', '-s', default=None)
+    p.add_option('--local', '-l', type='int', default=0,
+                 help='The number of local agents')
+    p.add_option('--ssh', action='append',
+                 help='An ssh host, with the number of slots as host:slots')
+    p.add_option('--remote-dir', default='/tmp/renderqueue')
+    p.add_option('--stub', type='int', default=0,
+                 help='The number of stand-in agents')
+    p.add_option('--stub-seconds', type='float', default=0.5)
+    p.add_option('--cmd', default='cycles')
+    p.add_option('--include', '-i', action='append')
+    p.add_option('--output', '-o', action='append',
+                 help='An output, as name=target')
+    p.add_option('--retries', '-r', type='int', default=1)
+    p.add_option('--jobs', '-j', type='int', default=16)
+
+    options, arguments = p.parse_args()
+
+    if not arguments:
+        p.print_help()
+        return 1
+    command = arguments[0]
+
+    if command == 'benchmark':
+        _benchmark(options.jobs, options.stub_seconds, [1, 2, 4, 8])
+        return 0
+
+    if not options.store:
+        p.print_help()
+        return 1
+
+    if command == 'daemon':
+        agents = _parse_agents(options)
+        if not agents:
+            agents = [WorkerAgent(LocalTransport())]
+        queue = RenderQueue(options.store, agents)
+        print('Render queue : %s, agents : %s' % (
+            options.store, ', '.join([agent.name for agent in agents])))
+        queue.start()
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            queue.stop(kill=True)
+        return 0
+
+    elif command == 'submit':
+        outputs = dict([output.split('=', 1) for output in
+                        options.output or []])
+        job_id = submit_job(options.store, arguments[1], options.include,
+                            outputs, {'cmd': options.cmd,
+                                      'args': arguments[2:],
+                                      'retries': options.retries})
+        print(job_id)
+        return 0
+
+    elif command == 'status':
+        for job in JobStore(options.store).list_jobs():
+            print('%s %-9s attempts %d %s' % (job['id'], job['state'],
+                                               job['attempts'],
+                                               job.get('agent', '')))
+        return 0
+
+    elif command == 'cancel':
+        for job_id in arguments[1:]:
+            cancel_job(options.store, job_id)
+        return 0
+
+    p.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A queue that copies files on a background thread, verifying every copy with a
+checksum and retrying copies that fail.
+"""
+
+from __future__ import division
+
+import hashlib
+import optparse
+import os
+import platform
+import shutil
+import sys
+import threading
+import time
+
+from Queue import Queue
+
+__author__ = 'Haarm-Pieter Duiker'
+__copyright__ = 'Copyright (C) 2015 - Duiker Research Corp'
+__license__ = ''
+__maintainer__ = 'Haarm-Pieter Duiker'
+__email__ = 'support@duikerresearch.org'
+__status__ = 'Production'
+
+__all__ = ['checksum',
+           'copy_file',
+           'CopyQueue',
+           'main']
+
+
+def checksum(file_path, chunk_size=4 * 1024 * 1024):
+    """
+    Returns the sha1 checksum of a file.
+
+    Parameters
+    ----------
+    file_path : str
+        The file to read.
+    chunk_size : int
+        The number of bytes read at a time.
+
+    Returns
+    -------
+    str
+         The hex digest of the file's contents.
+    """
+
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(source, target, remove_source=False):
+    """
+    Copies a file, verifying the copy against the source's checksum. The copy
+    is written next to the target and renamed into place once verified, so
+    the target is never left partially written.
+
+    Parameters
+    ----------
+    source : str
+        The file to copy.
+    target : str
+        The path to copy the file to.
+    remove_source : bool
+        Whether to remove the source once the copy is verified.
+
+    Returns
+    -------
+    str
+         The checksum of the copied file.
+    """
+
+    target_dir = os.path.dirname(target)
+    if target_dir and not os.path.exists(target_dir):
+        try:
+            os.makedirs(target_dir)
+        except OSError:
+            if not os.path.isdir(target_dir):
+                raise
+
+    partial_target = '%s.%d.part' % (target, os.getpid())
+    try:
+        shutil.copy2(source, partial_target)
+
+        source_checksum = checksum(source)
+        target_checksum = checksum(partial_target)
+        if source_checksum != target_checksum:
+            raise IOError('Checksum mismatch copying %s : %s != %s' % (
+                source, source_checksum, target_checksum))
+
+        # Windows won't rename over an existing file.
+        if platform.system() == 'Windows' and os.path.exists(target):
+            os.remove(target)
+        os.rename(partial_target, target)
+    finally:
+        if os.path.exists(partial_target):
+            os.remove(partial_target)
+
+    if remove_source:
+        os.remove(source)
+
+    return target_checksum
+
+
+class CopyQueue:
+    """
+    Copies files on a background thread.
+    """
+
+    def __init__(self, retries=3, retry_delay=2.0, remove_source=False):
+        """
+        Initialize the standard class variables and starts the copy thread.
+
+        Parameters
+        ----------
+        retries : int
+            The number of times a failed copy is retried.
+        retry_delay : float
+            The number of seconds before the first retry. The delay doubles
+            with every retry.
+        remove_source : bool
+            Whether to remove sources once their copies are verified.
+        """
+
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.remove_source = remove_source
+
+        self.copied = []
+        self.failures = []
+
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._copy_files)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, source, target):
+        """
+        Queues a file to be copied.
+
+        Parameters
+        ----------
+        source : str
+            The file to copy.
+        target : str
+            The path to copy the file to.
+        """
+
+        self._queue.put((source, target))
+
+    def pending(self):
+        """
+        Returns the number of copies that haven't finished.
+
+        Returns
+        -------
+        int
+             The number of queued or running copies.
+        """
+
+        return self._queue.unfinished_tasks
+
+    def wait(self):
+        """
+        Waits for all queued copies to finish or fail.
+
+        Returns
+        -------
+        list
+             The *(source, target, error)* tuples of the copies that failed.
+        """
+
+        self._queue.join()
+        with self._lock:
+            return list(self.failures)
+
+    def stop(self):
+        """
+        Waits for all queued copies and stops the copy thread.
+        """
+
+        self._queue.join()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _copy_files(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+
+            (source, target) = item
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(self.retry_delay * 2 ** (attempt - 1))
+                try:
+                    target_checksum = copy_file(source, target,
+                                                self.remove_source)
+                    error = None
+                    break
+                except Exception, e:
+                    error = e
+                    print('Copy attempt %d of %d failed : %s -> %s : %s' % (
+                        attempt + 1, self.retries + 1, source, target, e))
+
+            with self._lock:
+                if error is None:
+                    self.copied.append((source, target, target_checksum))
+                else:
+                    self.failures.append((source, target, str(error)))
+            self._queue.task_done()
+
+
+def main():
+    """
+    Copies files given on the command line through a copy queue.
+    """
+
+    p = optparse.OptionParser(description='A checksummed copy queue',
+                              prog='transfer',
+                              version='transfer 0.1',
+                              usage=('%prog [options] '
+                                     'source [source ...] target_dir'))
+    p.add_option('--retries', '-r', type='int', default=3)
+    p.add_option('--move', '-m', action='store_true', default=False)
+
+    options, arguments = p.parse_args()
+
+    if len(arguments) < 2:
+        p.print_help()
+        return 1
+
+    target_dir = arguments[-1]
+    copy_queue = CopyQueue(retries=options.retries,
+                           remove_source=options.move)
+    for source in arguments[:-1]:
+        copy_queue.put(source,
+                       os.path.join(target_dir, os.path.basename(source)))
+
+    failures = copy_queue.wait()
+    copy_queue.stop()
+
+    for (source, target, copy_checksum) in copy_queue.copied:
+        print('%s -> %s : %s' % (source, target, copy_checksum))
+    for (source, target, error) in failures:
+        print('Failed : %s -> %s : %s' % (source, target, error))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())